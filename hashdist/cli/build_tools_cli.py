@@ -41,23 +41,35 @@ class CreateLinks(object):
 
     If the 'launcher' action is used, then the 'LAUNCHER' environment
     variable should be set; the launcher will be found in $LAUNCHER/bin/launcher.
+
+    The plan of links to create is cached (in ``global/cache``), so that
+    repeating the same rules against unchanged directories does not
+    need to glob them again.
     """
 
     command = 'create-links'
 
     @staticmethod
     def setup(ap):
+        from ..core.links import DEFAULT_LINK_JOBS
         ap.add_argument('--key', default="/", help='read a sub-key from json file')
+        ap.add_argument('-j', '--jobs', type=int, default=DEFAULT_LINK_JOBS,
+                        help='number of directories to populate concurrently '
+                        '(default: %d)' % DEFAULT_LINK_JOBS)
         ap.add_argument('input', help='json parameter file')
 
     @staticmethod
     def run(ctx, args):
         from ..core.links import execute_links_dsl
+        from ..core import DiskCache, null_cache
 
         launcher_prefix = ctx.env.get('LAUNCHER', None)
         launcher = None if launcher_prefix is None else pjoin(launcher_prefix, 'bin', 'launcher')
         doc = fetch_parameters_from_json(args.input, args.key)
-        execute_links_dsl(doc, ctx.env, launcher, logger=ctx.logger)
+        cache = (DiskCache.create_from_config(ctx.config, ctx.logger)
+                 if 'global/cache' in ctx.config else null_cache)
+        execute_links_dsl(doc, ctx.env, launcher, logger=ctx.logger, cache=cache,
+                          jobs=args.jobs)
 
 @register_subcommand
 class BuildUnpackSources(object):
@@ -81,7 +93,8 @@ class BuildUnpackSources(object):
     `tar` ``--strip-components`` flag.
 
     If there are any conflicting files then an error is reported and
-    unpacking stops.
+    unpacking stops, except during incremental builds (``HDIST_INCREMENTAL``
+    set in the environment) where existing files are overwritten.
 
     .. warning::
 
@@ -101,14 +114,15 @@ class BuildUnpackSources(object):
 
     @staticmethod
     def run(ctx, args):
-        from ..core.links import execute_links_dsl
+        from ..core.build_tools import is_incremental_build
         source_cache = SourceCache.create_from_config(ctx.config, ctx.logger)
         doc = fetch_parameters_from_json(args.input, args.key)
         for source_item in doc:
             key = source_item['key']
             target = source_item.get('target', '.')
             strip = source_item.get('strip', 0)
-            source_cache.unpack(key, target, unsafe_mode=True, strip=strip)
+            source_cache.unpack(key, target, unsafe_mode=True, strip=strip,
+                                overwrite=is_incremental_build(ctx.env))
 
 @register_subcommand
 class BuildWriteFiles(object):
@@ -153,6 +167,10 @@ class BuildWriteFiles(object):
       (defaults to False)
 
     Order does not affect hashing. Files will always be encoded in UTF-8.
+
+    Existing files are an error, except during incremental builds
+    (``HDIST_INCREMENTAL`` set in the environment) where they are
+    overwritten if their contents differ.
         
     """
 
@@ -165,9 +183,9 @@ class BuildWriteFiles(object):
 
     @staticmethod
     def run(ctx, args):
-        from ..core.build_tools import execute_files_dsl
+        from ..core.build_tools import execute_files_dsl, is_incremental_build
         doc = fetch_parameters_from_json(args.input, args.key)
-        execute_files_dsl(doc, ctx.env)
+        execute_files_dsl(doc, ctx.env, overwrite=is_incremental_build(ctx.env))
 
 @register_subcommand
 class BuildWhitelist(object):
@@ -186,7 +204,8 @@ class BuildWhitelist(object):
         from ..core.build_tools import build_whitelist, get_import_envvar
         artifacts = get_import_envvar(ctx.env)
         build_store = BuildStore.create_from_config(ctx.config, ctx.logger)
-        sys.stdout.write('%s\n' % pjoin(build_store.get_build_dir(), '**'))
+        for build_root in build_store.get_build_roots():
+            sys.stdout.write('%s\n' % pjoin(build_root, '**'))
         sys.stdout.write('/tmp/**\n')
         sys.stdout.write('/etc/**\n')
         build_whitelist(build_store, artifacts, sys.stdout)
@@ -241,20 +260,54 @@ class BuildPostprocess(object):
         polyglot script fragment to insert a 'multi-line shebang',
         while 'launcher' will use the Hashdist 'launcher' tool. The
         latter looks for the path to the 'launcher' artifact in the
-        LAUNCHER environment variable.
+        LAUNCHER environment variable. The launcher finds the
+        interpreter with a few system calls rather than a shell loop,
+        which makes a difference for scripts that are run very often;
+        when run through a profile, it caches the profile lookup in
+        the ``bin`` directory of the profile.
+
+    --rpath=relative:
+
+        In all ELF executables, RPATH entries pointing into the artifact
+        store are made relative to ``$ORIGIN``. Shared libraries keep
+        their absolute RPATHs, as they may be loaded through the symlinks
+        of a profile. See :mod:`hashdist.core.elf`.
+
+    --drop-unused-rpaths:
+
+        With ``--rpath=relative``, also drop the RPATH entries that do
+        not provide any of the libraries the executable needs directly.
+        Only use this if no library relies on the RPATH of the executable
+        for its own dependencies, and no library is opened by name with
+        ``dlopen``.
 
     --write-protect:
 
         Remove all 'w' mode bits.
 
+    --pyc:
+
+        Byte-compile all ``.py`` files, using a pool of processes. The
+        Python running ``hdist`` is used, and the file names recorded in
+        the compiled files are relative to the path given.
+
+    The path is walked once, and each file is looked at (stat-ed, and
+    opened if it may be a script) only once for all the actions; up to
+    ``--jobs`` files are processed concurrently.
     """
     command = 'build-postprocess'
 
     @staticmethod
     def setup(ap):
+        from ..core.build_tools import DEFAULT_POSTPROCESS_JOBS
         ap.add_argument('--shebang', choices=['multiline', 'launcher', 'none'], default='none')
+        ap.add_argument('--rpath', choices=['relative', 'none'], default='none')
+        ap.add_argument('--drop-unused-rpaths', action='store_true')
         ap.add_argument('--write-protect', action='store_true')
         ap.add_argument('--pyc', action='store_true')
+        ap.add_argument('-j', '--jobs', type=int, default=DEFAULT_POSTPROCESS_JOBS,
+                        help='number of files to process concurrently '
+                        '(default: %d)' % DEFAULT_POSTPROCESS_JOBS)
         ap.add_argument('path', nargs='?', help='dir/file to post-process (dirs are handled '
                         'recursively)')
 
@@ -277,6 +330,12 @@ class BuildPostprocess(object):
         elif args.shebang == 'multiline':
             handlers.append(build_tools.postprocess_multiline_shebang)
 
+        if args.rpath == 'relative':
+            handlers.append(partial(build_tools.postprocess_relative_rpath,
+                                    artifacts_root=ctx.config['builder/artifacts'],
+                                    drop_unused=args.drop_unused_rpaths,
+                                    logger=ctx.logger))
+
         if args.write_protect:
             handlers.append(build_tools.postprocess_write_protect)
 
@@ -287,15 +346,14 @@ class BuildPostprocess(object):
                 ctx.logger.error('path not given and ARTIFACT environment variable not set')
                 raise
 
-        # we traverse post-order so that write-protection of
-        # directories happens very last.  (Although, currently only
-        # files are write-protected so that rm -rf works.)
-        if os.path.isfile(args.path):
-            for handler in handlers:
-                handler(args.path)
-        else:
-            for dirpath, dirnames, filenames in os.walk(args.path, topdown=False):
-                for filename in filenames + [dirpath]:
-                    for handler in handlers:
-                        handler(pjoin(dirpath, filename))
+        files = build_tools.run_postprocess(args.path, handlers, args.jobs)
+        if args.pyc:
+            # after the other handlers, so that scripts are not compiled
+            # while being rewritten
+            root = args.path if os.path.isdir(args.path) else os.path.dirname(args.path)
+            py_files = [f.filename for f in files
+                        if f.kind == build_tools.FILE and f.filename.endswith('.py')]
+            n = build_tools.compile_pyc_files(py_files, root, readonly=args.write_protect,
+                                              logger=ctx.logger)
+            ctx.logger.info('Compiled %d of %d .py files' % (n, len(py_files)))
         
@@ -1,5 +1,6 @@
 import sys
 import os
+import json
 from os.path import join as pjoin, exists as pexists
 from textwrap import dedent
 
@@ -48,15 +49,27 @@ class ClearBuilds(object):
     Resets the build store to scratch, deleting all software ever built in this
     Hashdist setup. Must be used with the --force argument.
 
+    The store is emptied right away; the files are then removed using
+    several threads (8 by default, set with ``-j``). With
+    ``--background``, the command returns as soon as the store is empty
+    and the files are removed by a detached process.
+
     Example::
 
-        $ hdist clearbuilds --force
+        $ hdist clearbuilds --force -j 32
+        $ hdist clearbuilds --force --background
 
     """
 
     @staticmethod
     def setup(ap):
+        from ..core.build_store import DEFAULT_DELETE_JOBS
         ap.add_argument('--force', action='store_true', help='Yes, actually do this')
+        ap.add_argument('-j', '--jobs', type=int, default=DEFAULT_DELETE_JOBS,
+                        help='number of threads removing files (default: %d)' %
+                        DEFAULT_DELETE_JOBS)
+        ap.add_argument('--background', action='store_true',
+                        help='remove the files in a detached process and return at once')
 
     @staticmethod
     def run(ctx, args):
@@ -65,7 +78,7 @@ class ClearBuilds(object):
             ctx.logger.error('Did not use --force flag')
             return 1
         build_store = BuildStore.create_from_config(ctx.config, ctx.logger)
-        build_store.delete_all()
+        build_store.delete_all(jobs=args.jobs, background=args.background)
 
 @register_subcommand
 class ClearSources(object):
@@ -90,3 +103,184 @@ class ClearSources(object):
             return 1
         source_cache = SourceCache.create_from_config(ctx.config, ctx.logger)
         source_cache.delete_all()
+
+@register_subcommand
+class StoreDedup(object):
+    """
+    Hard-links identical files in different artifacts to a single inode.
+    Files that are shared this way are write-protected.
+
+    Artifacts that were deduplicated before are skipped, unless ``--all``
+    is given. Set ``dedup = yes`` in the ``[builder]`` section of the
+    configuration file to deduplicate each artifact as it is built
+    instead. See :mod:`hashdist.core.dedup`.
+
+    Example::
+
+        $ hdist store-dedup
+
+    """
+    command = 'store-dedup'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('--all', action='store_true',
+                        help='also process artifacts that were deduplicated before')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        build_store = BuildStore.create_from_config(ctx.config, ctx.logger)
+        build_store.dedup_store(rescan=args.all)
+
+@register_subcommand
+class BuildReport(object):
+    """
+    Aggregates the build timings of a stack of artifacts.
+
+    Each argument is either an artifact ID, an artifact directory, or
+    a profile directory (in which case all artifacts in the profile
+    are included). The dependencies of the given artifacts (as listed
+    in the "import" section of their ``build.json``) are included
+    recursively. The time spent building each artifact is listed,
+    followed by the critical path, i.e., the chain of dependent builds
+    that bounds the total build time no matter how many builds run
+    in parallel.
+
+    Example::
+
+        $ hdist build-report ~/.hdist/opt/profile/abcd
+
+    """
+    command = 'build-report'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('artifacts', nargs='+', help='artifact IDs or directories')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        from ..core.build_store import BuildSpec
+        from ..core.build_timings import load_build_timings, find_critical_path
+
+        build_store = BuildStore.create_from_config(ctx.config, ctx.logger)
+
+        def resolve(artifact):
+            if os.path.isdir(artifact):
+                return os.path.realpath(artifact)
+            artifact_dir = build_store.resolve(artifact)
+            if artifact_dir is None:
+                ctx.logger.warning('Artifact %s not built' % artifact)
+            return artifact_dir
+
+        roots = []
+        for artifact in args.artifacts:
+            artifact_dir = resolve(artifact)
+            if artifact_dir is None:
+                continue
+            profile_json = pjoin(artifact_dir, 'profile.json')
+            if os.path.exists(profile_json):
+                with open(profile_json) as f:
+                    for item in json.load(f)['artifacts']:
+                        roots.append(item['id'])
+            else:
+                roots.append(artifact_dir)
+
+        timings = {} # artifact_id -> timings document or None
+        dependencies = {} # artifact_id -> [artifact_id]
+        to_visit = list(roots)
+        visited_dirs = set()
+        while to_visit:
+            artifact_dir = resolve(to_visit.pop())
+            if artifact_dir is None or artifact_dir in visited_dirs:
+                continue
+            visited_dirs.add(artifact_dir)
+            with open(pjoin(artifact_dir, 'build.json')) as f:
+                spec = BuildSpec(json.load(f))
+            doc = load_build_timings(artifact_dir)
+            virtuals = doc['virtuals'] if doc is not None else {}
+            deps = []
+            for dep in spec.doc['build']['import']:
+                dep_id = virtuals.get(dep['id'], dep['id'])
+                if dep_id.startswith('virtual:'):
+                    ctx.logger.warning('Do not know what %s resolved to for %s' %
+                                       (dep_id, spec.artifact_id))
+                    continue
+                deps.append(dep_id)
+                to_visit.append(dep_id)
+            timings[spec.artifact_id] = doc
+            dependencies[spec.artifact_id] = deps
+
+        # only keep edges to artifacts that were found
+        for artifact_id, deps in dependencies.items():
+            dependencies[artifact_id] = [dep for dep in deps if dep in dependencies]
+        durations = dict((artifact_id, doc['wall'])
+                         for artifact_id, doc in timings.items() if doc is not None)
+
+        out = ctx.out_stream
+        out.write('%-50s %10s %10s %12s\n' % ('Artifact', 'Wall (s)', 'CPU (s)', 'Max RSS (MB)'))
+        for artifact_id in sorted(timings, key=lambda x: -durations.get(x, 0)):
+            doc = timings[artifact_id]
+            if doc is None:
+                out.write('%-50s %10s\n' % (artifact_id, 'no timings'))
+                continue
+            cpu = sum(step['cpu'] for step in doc['steps'])
+            maxrss = max([0] + [step['maxrss_kb'] for step in doc['steps']])
+            out.write('%-50s %10.1f %10.1f %12.1f\n' % (artifact_id, doc['wall'], cpu,
+                                                         maxrss / 1024.))
+        total, path = find_critical_path(durations, dependencies)
+        out.write('\nTotal build time: %.1f s\n' % sum(durations.values()))
+        out.write('Critical path: %.1f s\n' % total)
+        for artifact_id in path:
+            out.write('  %-48s %10.1f\n' % (artifact_id, durations.get(artifact_id, 0)))
+
+@register_subcommand
+class Log(object):
+    """
+    Prints the build log of an artifact.
+
+    The artifact is given by its ID or its directory. With ``--grep``,
+    only the lines containing the given string are printed, prefixed by
+    their line numbers; only the parts of the compressed log that may
+    contain the string are decompressed (see
+    :mod:`hashdist.core.block_gzip`).
+
+    Example::
+
+        $ hdist log zlib/4niostz3iktlg67najtxuwwgss5vl6k4 --grep error -i
+
+    """
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('artifact', help='artifact ID or directory')
+        ap.add_argument('--grep', help='only print lines containing this string')
+        ap.add_argument('-i', '--ignore-case', action='store_true',
+                        help='ignore case when searching')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        from ..core.block_gzip import iter_blocks, grep
+
+        if os.path.isdir(args.artifact):
+            artifact_dir = args.artifact
+        else:
+            build_store = BuildStore.create_from_config(ctx.config, ctx.logger)
+            artifact_dir = build_store.resolve(args.artifact)
+            if artifact_dir is None:
+                ctx.logger.error('Artifact %s not built' % args.artifact)
+                return 1
+        log_filename = pjoin(artifact_dir, 'build.log.gz')
+        if not os.path.exists(log_filename):
+            ctx.logger.error('%s has no build log' % artifact_dir)
+            return 1
+
+        out = ctx.out_stream
+        if args.grep is None:
+            for first_line, text in iter_blocks(log_filename):
+                out.write(text)
+        else:
+            for line_number, line in grep(log_filename, args.grep, args.ignore_case):
+                out.write('%d:%s\n' % (line_number, line))
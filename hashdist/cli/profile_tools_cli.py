@@ -39,6 +39,11 @@ class CreateProfile(object):
     Virtual artifacts may be needed in the sub-commands of each
     artifact installation; these are read from the HDIST_VIRTUALS
     environment variable.
+
+    With ``--update``, the target is instead a symlink which is
+    switched atomically to an updated copy of the profile, touching only
+    the links of artifacts that were added or removed since the last
+    update (see :func:`hashdist.core.profile.update_profile`).
     '''
     command = 'create-profile'
 
@@ -46,14 +51,19 @@ class CreateProfile(object):
     def setup(ap):
         ap.add_argument('--key', default="/",
                         help='read a sub-key from json file')
+        ap.add_argument('--update', action='store_true',
+                        help='update the profile symlinked at target incrementally')
         ap.add_argument('input', help='json parameter file')
         ap.add_argument('target', help='location of resulting profile directory')
 
     @staticmethod
     def run(ctx, args):
-        from ..core import make_profile, BuildStore
+        from ..core import make_profile, update_profile, BuildStore
         from ..core.run_job import unpack_virtuals_envvar
         virtuals = unpack_virtuals_envvar(ctx.env.get('HDIST_VIRTUALS', ''))
         build_store = BuildStore.create_from_config(ctx.config, ctx.logger)
         doc = fetch_parameters_from_json(args.input, args.key)
-        make_profile(ctx.logger, build_store, doc, args.target, virtuals, ctx.config)
+        if args.update:
+            update_profile(ctx.logger, build_store, doc, args.target, virtuals, ctx.config)
+        else:
+            make_profile(ctx.logger, build_store, doc, args.target, virtuals, ctx.config)
@@ -4,7 +4,7 @@ from .config import load_configuration_from_inifile, DEFAULT_CONFIG_FILENAME
 from .source_cache import (SourceCache, supported_source_archive_types,
                            single_file_key, hdist_pack)
 from .build_store import (BuildStore, BuildSpec, shorten_artifact_id)
-from .profile import make_profile
+from .profile import make_profile, update_profile
 from .hdist_recipe import hdist_cli_build_spec, HDIST_CLI_ARTIFACT_NAME, HDIST_CLI_ARTIFACT_VERSION
 from .cache import DiskCache, null_cache, cached_method
 from .run_job import InvalidJobSpecError, JobFailedError
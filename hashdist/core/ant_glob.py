@@ -2,38 +2,438 @@
 :mod:`hashdist.core.ant_glob` -- ant-inspired globbing
 ======================================================
 
+Several patterns can be globbed together with :func:`ant_iglob_many`.
+The patterns are merged into a tree of path components, so that a
+shared prefix is only traversed once, and path components without
+wildcards are looked up directly (one ``stat``) rather than by
+listing and matching the entire parent directory. This matters for
+rules selecting thousands of explicit paths in large directories such
+as ``/usr/lib``. Directory listings can be shared between calls
+through the `listings` argument, so that each directory is listed at
+most once.
+
+Directories are listed with ``scandir`` if the `scandir
+<https://pypi.python.org/pypi/scandir>`_ package is installed, in
+which case the file types reported by the directory listing (on most
+file systems) are used instead of calling ``stat`` on each entry.
+Otherwise each entry is ``lstat``-ed at most once.
+
+Paths to leave out can be given as a :class:`PathMatcher`, which is
+evaluated during the walk: sub-trees excluded by a pattern ending in
+``/**`` are never entered.
+
+Reference
+---------
 
 """
 
 import os
 import re
+import stat
+import errno
 from os.path import join as pjoin
 
-from glob import glob
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+# Kinds of directory entries
+DIR, FILE, SYMLINK, OTHER = 'dir', 'file', 'symlink', 'other'
+
+_WILDCARD_RE = re.compile(r'[*?[]')
+_SPECIAL_RE = re.compile(r'[*?[{]')
+
+def _is_literal(part):
+    return _WILDCARD_RE.search(part) is None
+
+def _translate_part(part):
+    """Translates a path component with wildcards to a regular expression
+    (without anchors)
+    """
+    i, n = 0, len(part)
+    result = []
+    while i < n:
+        c = part[i]
+        i += 1
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            j = i
+            if j < n and part[j] in '!^':
+                j += 1
+            if j < n and part[j] == ']':
+                j += 1
+            j = part.find(']', j)
+            if j == -1:
+                result.append('\\[')
+            else:
+                chars = part[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if chars[0] in '!^':
+                    chars = '^' + chars[1:]
+                result.append('[%s]' % chars)
+        else:
+            result.append(re.escape(c))
+    return ''.join(result)
+
+def _compile_part(part):
+    return re.compile(_translate_part(part) + '$')
+
+def expand_braces(pattern):
+    """Expands ``{a,b}`` alternatives in `pattern` (possibly nested) into
+    a list of patterns
+
+    Example: ``lib/{libz,libbz2}.{a,so}`` gives four patterns.
+    """
+    start = pattern.find('{')
+    if start == -1:
+        return [pattern]
+    depth = 0
+    alternatives = []
+    last = start + 1
+    for i in range(start, len(pattern)):
+        c = pattern[i]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                alternatives.append(pattern[last:i])
+                break
+        elif c == ',' and depth == 1:
+            alternatives.append(pattern[last:i])
+            last = i + 1
+    else:
+        # unbalanced; take it literally
+        return [pattern]
+    head, tails = pattern[:start], expand_braces(pattern[i + 1:])
+    result = []
+    for alternative in alternatives:
+        for x in expand_braces(alternative):
+            result.extend(head + x + tail for tail in tails)
+    return result
+
+def _split_pattern(pattern, cwd):
+    """Returns the directory to start in (`cwd` or '/') and the components
+    of `pattern`
+    """
+    if isinstance(pattern, (str, unicode)):
+        if pattern.startswith('/'):
+            return '/', pattern[1:].split('/')
+        else:
+            return cwd, pattern.split('/')
+    else:
+        return cwd, list(pattern)
+
+def _pattern_to_regex(root, parts):
+    pieces = []
+    for i, part in enumerate(parts):
+        is_last = i == len(parts) - 1
+        if part == '**':
+            pieces.append('.+' if is_last else '(?:[^/]+/)*')
+        else:
+            pieces.append(_translate_part(part) + ('' if is_last else '/'))
+    if root:
+        pieces.insert(0, re.escape(root if root.endswith('/') else root + '/'))
+    return re.compile(''.join(pieces) + '$')
+
+
+class PathMatcher(object):
+    """
+    Matches paths against a set of patterns without touching the file system
+
+    Paths are matched by their string value, as they would be returned
+    by :func:`ant_iglob` with ``cwd=''``. A pattern ending in ``/**``
+    matches everything beneath a directory, and causes globbing to skip
+    that directory entirely.
+    """
+    def __init__(self):
+        self._patterns = []
+        self._subtrees = []
+        self._paths = set()
+
+    def __nonzero__(self):
+        return bool(self._patterns or self._subtrees or self._paths)
+
+    def add(self, pattern, include_dirs=True):
+        """Adds a pattern (which may contain ``{a,b}``); directories are only
+        matched if `include_dirs` is set (except beneath a ``/**`` pattern)
+        """
+        for expanded in expand_braces(pattern):
+            root, parts = _split_pattern(expanded, '')
+            if parts[-1] == '**' and len(parts) > 1:
+                self._subtrees.append(_pattern_to_regex(root, parts[:-1]))
+            else:
+                self._patterns.append((_pattern_to_regex(root, parts), include_dirs))
+
+    def add_path(self, path):
+        """Adds a single path, taken literally"""
+        self._paths.add(path)
+
+    def prunes(self, path):
+        """Whether everything beneath the directory `path` is matched"""
+        for subtree_re in self._subtrees:
+            if subtree_re.match(path):
+                return True
+        return False
+
+    def match(self, path, is_dir=False):
+        if path in self._paths:
+            return True
+        for pattern_re, include_dirs in self._patterns:
+            if (include_dirs or not is_dir) and pattern_re.match(path):
+                return True
+        if self._subtrees:
+            parent = os.path.dirname(path)
+            while parent and parent != '/':
+                if self.prunes(parent):
+                    return True
+                parent = os.path.dirname(parent)
+        return False
+
+
+class _PatternNode(object):
+    """A node in the tree of path components of a set of patterns
+
+    `terminal` is set if some pattern ends here; `literals` maps
+    components without wildcards to child nodes, `globs` holds
+    ``(regex, child)`` for the components with wildcards, and
+    `recursive` is the child for ``**`` (if any).
+    """
+    def __init__(self):
+        self.terminal = False
+        self.literals = {}
+        self.globs = {}
+        self.recursive = None
+
+    def add(self, parts, literal=False):
+        node = self
+        for i, part in enumerate(parts):
+            if literal:
+                node = node.literals.setdefault(part, _PatternNode())
+            elif part == '**':
+                if i == len(parts) - 1:
+                    raise ValueError('does not make sense with ** at end of pattern with '
+                                     'glob_files')
+                if node.recursive is None:
+                    node.recursive = _PatternNode()
+                node = node.recursive
+            elif '**' in part:
+                raise NotImplementedError('mixing ** and other strings in same path '
+                                          'component not supported')
+            elif _is_literal(part):
+                node = node.literals.setdefault(part, _PatternNode())
+            else:
+                if part not in node.globs:
+                    node.globs[part] = (_compile_part(part), _PatternNode())
+                node = node.globs[part][1]
+        node.terminal = True
+
+    def has_children(self):
+        return bool(self.literals or self.globs or self.recursive is not None)
+
+
+def _get_kind(entry):
+    if entry.is_symlink():
+        return SYMLINK
+    elif entry.is_dir(follow_symlinks=False):
+        return DIR
+    elif entry.is_file(follow_symlinks=False):
+        return FILE
+    else:
+        return OTHER
+
+class _Lister(object):
+    """Lists directories and finds the kinds of entries, each at most once
+    """
+    def __init__(self, listings, listed_dirs):
+        self.listings = listings
+        self.listed_dirs = listed_dirs
+        self.kinds = {}
+
+    def listdir(self, path):
+        try:
+            return self.listings[path]
+        except KeyError:
+            pass
+        self.record(path)
+        if scandir is not None:
+            names = []
+            for entry in scandir(path or '.'):
+                names.append(entry.name)
+                self.kinds[pjoin(path, entry.name)] = _get_kind(entry)
+        else:
+            names = os.listdir(path or '.')
+        self.listings[path] = names
+        return names
+
+    def record(self, path):
+        if self.listed_dirs is not None:
+            self.listed_dirs.add(path or '.')
+
+    def kind(self, path):
+        """Returns the kind of `path` (not following symlinks), or `None`
+        if it does not exist"""
+        try:
+            return self.kinds[path]
+        except KeyError:
+            pass
+        try:
+            mode = os.lstat(path).st_mode
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            kind = None
+        else:
+            if stat.S_ISLNK(mode):
+                kind = SYMLINK
+            elif stat.S_ISDIR(mode):
+                kind = DIR
+            elif stat.S_ISREG(mode):
+                kind = FILE
+            else:
+                kind = OTHER
+        self.kinds[path] = kind
+        return kind
+
+    def isdir(self, path):
+        kind = self.kind(path)
+        return os.path.isdir(path) if kind == SYMLINK else kind == DIR
+
+    def isfile(self, path):
+        kind = self.kind(path)
+        return os.path.isfile(path) if kind == SYMLINK else kind == FILE
+
+
+def _walk_dirs(path, lister, exclude):
+    """Yields `path` and all directories beneath it, not following symlinks
+    (like ``os.walk``) and skipping those pruned by `exclude`
+    """
+    yield path
+    for name in lister.listdir(path):
+        subpath = pjoin(path, name)
+        if lister.kind(subpath) == DIR and not (exclude and exclude.prunes(subpath)):
+            for x in _walk_dirs(subpath, lister, exclude):
+                yield x
+
+def _iglob_node(node, path, lister, include_dirs, exclude):
+    def visit(child, name):
+        subpath = pjoin(path, name)
+        if child.terminal:
+            if include_dirs:
+                found = lister.kind(subpath) is not None
+                is_dir = found and exclude and lister.isdir(subpath)
+            else:
+                found = lister.isfile(subpath)
+                is_dir = False
+            if found and not (exclude and exclude.match(subpath, is_dir)):
+                yield subpath
+        if (child.has_children() and lister.isdir(subpath) and
+            not (exclude and exclude.prunes(subpath))):
+            for x in _iglob_node(child, subpath, lister, include_dirs, exclude):
+                yield x
+
+    if node.literals:
+        # the result depends on the directory contents without listing it
+        lister.record(path)
+        for name, child in node.literals.iteritems():
+            for x in visit(child, name):
+                yield x
+    if node.globs:
+        globs = node.globs.values()
+        for name in lister.listdir(path):
+            for part_re, child in globs:
+                if part_re.match(name):
+                    for x in visit(child, name):
+                        yield x
+    if node.recursive is not None:
+        for dirpath in _walk_dirs(path, lister, exclude):
+            for x in _iglob_node(node.recursive, dirpath, lister, include_dirs, exclude):
+                yield x
+
+def ant_iglob_many(patterns, cwd='', include_dirs=True, listed_dirs=None, listings=None,
+                   exclude=None):
+    """
+    Like :func:`ant_iglob`, but yields the files/directories matching
+    any of `patterns` (each only once).
+
+    Parameters
+    ----------
+
+    patterns : list
+        Glob patterns, each either a str or list (see :func:`ant_iglob`)
+
+    cwd, include_dirs, listed_dirs, exclude :
+        See :func:`ant_iglob`
+
+    listings : dict (optional)
+        Directory listings by path. Pass the same dict to several calls
+        to list each directory only once (the contents of the file
+        system are assumed not to change in the meantime).
+    """
+    # if cwd is '', we want to search in '.' but not prepend output with './'
+    assert cwd != '.'
+    roots = {}
+    for pattern in patterns:
+        literal = False
+        if isinstance(pattern, (str, unicode)):
+            if _SPECIAL_RE.search(pattern) and os.path.lexists(pjoin(cwd, pattern)):
+                # an existing path is taken literally, so that explicit
+                # lists of paths need no escaping
+                expanded = [pattern]
+                literal = True
+            else:
+                expanded = expand_braces(pattern)
+        else:
+            expanded = [pattern]
+        for x in expanded:
+            root, parts = _split_pattern(x, cwd)
+            if len(parts) == 0:
+                raise ValueError('empty glob pattern')
+            if root not in roots:
+                roots[root] = _PatternNode()
+            roots[root].add(parts, literal)
+
+    lister = _Lister({} if listings is None else listings, listed_dirs)
+    seen = set()
+    for root, node in roots.iteritems():
+        for x in _iglob_node(node, root, lister, include_dirs, exclude):
+            if x not in seen:
+                seen.add(x)
+                yield x
 
-def ant_iglob(pattern, cwd='', include_dirs=True):
+def ant_iglob(pattern, cwd='', include_dirs=True, listed_dirs=None, listings=None,
+              exclude=None):
     """
     Generator that iterates over files/directories matching the pattern.
 
-    The syntax is ant-glob-inspired but currently only a small subset
-    is implemented.
+    The syntax is ant-glob-inspired. Within a path component, ``*``
+    matches any string, ``?`` any single character, and ``[abc]`` /
+    ``[!abc]`` one character of (not of) a set, as in the shell.
+    ``{a,b}`` alternatives (possibly nested) may span several components.
+    A pattern that is the path of an existing file or directory is
+    taken literally, so that paths containing these characters (e.g.
+    ``include/foo[1].h``) match themselves.
 
     Examples::
 
         *.txt         # matches "a.txt", "b.txt"
         foo/**/bar    # matches "foo/bar" and "foo/a/b/c/bar"
         foo*/**/*.bin # matches "foo/bar.bin", "foo/a/b/c/bar.bin", "foo3/a.bin"
+        lib/lib?.{a,so*} # matches "lib/libz.a", "lib/libm.so.6"
 
     Illegal patterns::
 
         foo/**.bin  # '**' can only match 0 or more entire directories
-        
+
 
     Issues
     ------
 
      * Does not support escaped / characters
-     * Does not support any regular globbing-patterns besides *
 
     Parameters
     ----------
@@ -51,64 +451,19 @@ def ant_iglob(pattern, cwd='', include_dirs=True):
 
     include_dirs : bool
         Whether to include directories, or only glob files.
-    
-    """
-    def should_include(fname):
-        if include_dirs:
-            return True
-        else:
-            return os.path.isfile(fname)
-        
-    if isinstance(pattern, (str, unicode)):
-        if pattern.startswith('/'):
-            pattern = pattern[1:]
-            cwd = '/'
-        parts = pattern.split('/')
-    else:
-        parts = list(pattern)
 
-    # if cwd is '', we want to search in '.' but not prepend output with './'
-    assert cwd != '.'
-    ret_cwd = cwd
-    if cwd == '':
-        cwd = '.'
-
-    if len(parts) == 0:
-        raise ValueError('empty glob pattern')
-    
-    part = parts[0]
-    is_last = len(parts) == 1
-    if part == '**':
-        # do an os.walk over all sub-directories and re-launch glob_files in each
-        # dirpath
-        if is_last:
-            raise ValueError('does not make sense with ** at end of pattern with '
-                             'glob_files')
-        for dirpath, dirnames, filenames in os.walk(cwd):
-            if cwd == '.' and ret_cwd == '': # fixup relative path printing
-                if len(dirpath) == 1:
-                    dirpath = ''
-                else:
-                    assert dirpath[:2] == './'
-                    dirpath = dirpath[2:]
-            for x in ant_iglob(parts[1:], dirpath, include_dirs):
-                yield x
-    elif '**' in part:
-        raise NotImplementedError('mixing ** and other strings in same path component not supported')
-    else:
-        # convert glob to a regex and recurse to next level within os.listdir
-        part = re.escape(part)
-        part = part.replace('\\*', '.*') + '$'
-        part_re = re.compile(part)
-        if is_last:
-            for name in os.listdir(cwd):
-                path = pjoin(ret_cwd, name)
-                if part_re.match(name) and should_include(path):
-                    yield path
-        else:
-            for name in os.listdir(cwd):
-                path = pjoin(ret_cwd, name)
-                if part_re.match(name) and os.path.isdir(path):
-                    for x in ant_iglob(parts[1:], path, include_dirs):
-                        yield x
-        
+    listed_dirs : set (optional)
+        If given, every directory that is listed, or in which a path is
+        looked up, while globbing is added to it. The result of the glob
+        only depends on the contents of these directories (see
+        :mod:`hashdist.core.links`).
+
+    listings : dict (optional)
+        See :func:`ant_iglob_many`.
+
+    exclude : PathMatcher (optional)
+        Paths matched by `exclude` are not returned, and directories
+        it prunes are not entered.
+
+    """
+    return ant_iglob_many([pattern], cwd, include_dirs, listed_dirs, listings, exclude)
@@ -0,0 +1,350 @@
+"""
+:mod:`hashdist.core.artifact_cache` --- Binary artifact cache
+=============================================================
+
+Since an artifact ID is determined by the build spec alone, a built
+artifact can be shared between machines: if some other machine (e.g.,
+a CI runner) has already built ``zlib/4niostz3iktlg67najtxuwwgss5vl6k4``
+there is no need to build it again. The artifact cache is a directory,
+or a directory served over HTTP, containing::
+
+    zlib/4niostz3iktlg67najtxuwwgss5vl6k4.tar.gz
+    zlib/4niostz3iktlg67najtxuwwgss5vl6k4.json
+    ...
+
+The tarball contains the artifact directory. The JSON file is the
+manifest, and is always uploaded after the tarball::
+
+    {
+      "artifact_id" : "zlib/4niostz3iktlg67najtxuwwgss5vl6k4",
+      "artifact_dir" : "/home/dagss/.hdist/opt/zlib/4nio",
+      "sha256" : "...",
+      "size" : 171242
+    }
+
+**artifact_dir**:
+    Where the artifact was originally built; any occurrences of this path
+    in the artifact are rewritten to the new location when the artifact is
+    pulled.
+
+**sha256**, **size**:
+    Checksum and size of the tarball, verified on download.
+
+Configuration
+-------------
+
+The cache is configured using ``builder/artifact-cache`` in the
+configuration file, either as a local path (or ``file:`` URL) or as
+an ``http://`` or ``https://`` URL. If it is set,
+:meth:`~hashdist.core.build_store.BuildStore.ensure_present` first
+tries to pull a missing artifact from the cache, and pushes artifacts
+it had to build to the cache afterwards. Pushing to an HTTP cache is
+done using ``PUT`` requests. Failing to push is not an error.
+
+Relocation
+----------
+
+Artifacts frequently contain the absolute path they were installed to
+(in scripts, ``.pc`` files, binaries and so on). If the artifact is
+pulled to a different path than it was built in, these occurrences are
+rewritten using :mod:`hashdist.core.relocate`. If the new path is too
+long to be patched into binary files, the artifact is not used and is
+built from source instead.
+
+Reference
+---------
+
+"""
+
+import os
+from os.path import join as pjoin
+import errno
+import json
+import shutil
+import tarfile
+import tempfile
+import hashlib
+import zlib
+import urllib2
+
+from .common import json_formatting_options
+from .fileutils import silent_makedirs, silent_unlink
+from .relocate import relocate_artifact, RelocationError
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ArtifactCacheError(Exception):
+    pass
+
+
+def create_artifact_cache(url, logger):
+    """Creates an artifact cache given its location (see module docstring)
+
+    Returns :data:`null_artifact_cache` if `url` is empty.
+    """
+    if not url:
+        return null_artifact_cache
+    elif url.startswith('http://') or url.startswith('https://'):
+        return HttpArtifactCache(url, logger)
+    else:
+        if url.startswith('file:'):
+            url = url[len('file:'):]
+        return DirectoryArtifactCache(os.path.expanduser(url), logger)
+
+
+def _split_artifact_id(artifact_id):
+    name, digest = artifact_id.split('/')
+    return name, digest
+
+
+class ArtifactCache(object):
+    """
+    Base class for artifact caches; subclasses implement storing and
+    retrieving files by relative path.
+    """
+    def __init__(self, logger):
+        self.logger = logger
+
+    def _get_file(self, relpath, dest_file):
+        """Copies the file at `relpath` into the file object `dest_file`;
+        returns `False` if it does not exist"""
+        raise NotImplementedError()
+
+    def _put_file(self, relpath, filename):
+        raise NotImplementedError()
+
+    def get_manifest(self, artifact_id):
+        """Returns the manifest of the artifact, or `None` if it is not cached
+        """
+        name, digest = _split_artifact_id(artifact_id)
+        f = tempfile.TemporaryFile()
+        try:
+            if not self._get_file('%s/%s.json' % (name, digest), f):
+                return None
+            f.seek(0)
+            return json.load(f)
+        finally:
+            f.close()
+
+    def pull(self, build_store, build_spec):
+        """Downloads and registers an artifact in `build_store`
+
+        Returns
+        -------
+
+        artifact_dir : str or None
+            The registered artifact directory, or `None` if the artifact is
+            not available from the cache (or could not be relocated).
+        """
+        artifact_id = build_spec.artifact_id
+        name, digest = _split_artifact_id(artifact_id)
+        temp_dir = tempfile.mkdtemp(prefix='artifact-cache-', dir=build_store.get_build_dir())
+        try:
+            tarball = pjoin(temp_dir, 'artifact.tar.gz')
+            try:
+                manifest = self.get_manifest(artifact_id)
+                if manifest is None:
+                    return None
+                with open(tarball, 'wb') as f:
+                    self.logger.info('Downloading %s from artifact cache' % artifact_id)
+                    found = self._get_file('%s/%s.tar.gz' % (name, digest), f)
+            except (IOError, OSError, ValueError, ArtifactCacheError), e:
+                self.logger.warning('Could not read from artifact cache: %s' % e)
+                return None
+            if not found:
+                self.logger.warning('Artifact cache has manifest but no tarball for %s' %
+                                    artifact_id)
+                return None
+            if (os.stat(tarball).st_size != manifest['size'] or
+                file_sha256(tarball) != manifest['sha256']):
+                self.logger.warning('Checksum mismatch for %s in artifact cache, ignoring' %
+                                    artifact_id)
+                return None
+
+            artifact_dir = build_store.make_artifact_dir(build_spec)
+            try:
+                try:
+                    unpack_artifact(tarball, artifact_dir)
+                except (ArtifactCacheError, tarfile.TarError, IOError, EOFError, zlib.error), e:
+                    self.logger.warning('Could not unpack %s from artifact cache: %s; '
+                                        'building from source' % (artifact_id, e))
+                    shutil.rmtree(artifact_dir)
+                    return None
+                old_artifact_dir = manifest['artifact_dir'].encode('utf-8')
+                try:
+                    relocated = relocate_artifact(artifact_dir, old_artifact_dir, artifact_dir)
+                except RelocationError, e:
+                    self.logger.warning('Could not relocate %s: %s; building from source' %
+                                        (artifact_id, e))
+                    relocated = False
+                else:
+                    if not relocated:
+                        self.logger.info('%s can not be relocated to %s; building from source' %
+                                         (artifact_id, artifact_dir))
+                if not relocated:
+                    shutil.rmtree(artifact_dir)
+                    return None
+            except:
+                shutil.rmtree(artifact_dir)
+                raise
+        finally:
+            shutil.rmtree(temp_dir)
+        return build_store.register_artifact(build_spec, artifact_dir)
+
+    def push(self, build_store, artifact_id, artifact_dir):
+        """Uploads an artifact to the cache
+
+        Failures are logged as warnings only.
+        """
+        name, digest = _split_artifact_id(artifact_id)
+        temp_dir = tempfile.mkdtemp(prefix='artifact-cache-', dir=build_store.get_build_dir())
+        try:
+            tarball = pjoin(temp_dir, 'artifact.tar.gz')
+            pack_artifact(artifact_dir, tarball)
+            manifest = {'artifact_id': artifact_id,
+                        'artifact_dir': artifact_dir,
+                        'sha256': file_sha256(tarball),
+                        'size': os.stat(tarball).st_size}
+            manifest_filename = pjoin(temp_dir, 'artifact.json')
+            with open(manifest_filename, 'w') as f:
+                json.dump(manifest, f, **json_formatting_options)
+            self.logger.info('Uploading %s to artifact cache' % artifact_id)
+            self._put_file('%s/%s.tar.gz' % (name, digest), tarball)
+            self._put_file('%s/%s.json' % (name, digest), manifest_filename)
+        except (IOError, OSError, ArtifactCacheError), e:
+            self.logger.warning('Could not upload %s to artifact cache: %s' % (artifact_id, e))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+class DirectoryArtifactCache(ArtifactCache):
+    """Artifact cache in a local (or network-mounted) directory
+    """
+    def __init__(self, path, logger):
+        ArtifactCache.__init__(self, logger)
+        self.path = path
+
+    def _get_file(self, relpath, dest_file):
+        try:
+            f = open(pjoin(self.path, relpath), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        with f:
+            shutil.copyfileobj(f, dest_file, CHUNK_SIZE)
+        return True
+
+    def _put_file(self, relpath, filename):
+        dest = pjoin(self.path, relpath)
+        silent_makedirs(os.path.dirname(dest))
+        # copy to temporary name and rename for atomicity
+        fd, temp = tempfile.mkstemp(prefix='.uploading-', dir=os.path.dirname(dest))
+        try:
+            with os.fdopen(fd, 'wb') as dst:
+                with open(filename, 'rb') as src:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            os.chmod(temp, 0o644)
+            os.rename(temp, dest)
+        except:
+            silent_unlink(temp)
+            raise
+
+
+class HttpArtifactCache(ArtifactCache):
+    """Artifact cache served over HTTP(S); uploads are done with ``PUT``
+    """
+    def __init__(self, url, logger):
+        ArtifactCache.__init__(self, logger)
+        self.url = url.rstrip('/')
+
+    def _get_file(self, relpath, dest_file):
+        try:
+            response = urllib2.urlopen('%s/%s' % (self.url, relpath))
+        except urllib2.HTTPError, e:
+            if e.code == 404:
+                return False
+            raise ArtifactCacheError('GET %s failed: %s' % (e.geturl(), e))
+        except urllib2.URLError, e:
+            raise ArtifactCacheError('could not reach %s: %s' % (self.url, e.reason))
+        try:
+            shutil.copyfileobj(response, dest_file, CHUNK_SIZE)
+        finally:
+            response.close()
+        return True
+
+    def _put_file(self, relpath, filename):
+        with open(filename, 'rb') as f:
+            # httplib streams file objects; it can not take the length of one
+            request = urllib2.Request('%s/%s' % (self.url, relpath), f,
+                                      {'Content-Length': str(os.fstat(f.fileno()).st_size)})
+            request.get_method = lambda: 'PUT'
+            try:
+                urllib2.urlopen(request).close()
+            except urllib2.HTTPError, e:
+                raise ArtifactCacheError('PUT %s failed: %s' % (e.geturl(), e))
+            except urllib2.URLError, e:
+                raise ArtifactCacheError('could not reach %s: %s' % (self.url, e.reason))
+
+
+class NullArtifactCache(object):
+    """Artifact cache that never has anything, used when none is configured
+    """
+    def pull(self, build_store, build_spec):
+        return None
+
+    def push(self, build_store, artifact_id, artifact_dir):
+        pass
+
+null_artifact_cache = NullArtifactCache()
+
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def pack_artifact(artifact_dir, tarball):
+    with tarfile.open(tarball, 'w:gz') as tar:
+        for name in sorted(os.listdir(artifact_dir)):
+            tar.add(pjoin(artifact_dir, name), arcname=name)
+
+def unpack_artifact(tarball, artifact_dir):
+    """Unpacks a tarball created by :func:`pack_artifact` into `artifact_dir`
+
+    Members that would be written outside of `artifact_dir` are refused,
+    including those written through a symlink unpacked earlier; members
+    are checked one by one as they are extracted, against what is on
+    disk. Symlinks themselves are unpacked as they are (artifacts may
+    well link to absolute paths), but never followed.
+    """
+    root = os.path.realpath(artifact_dir)
+
+    def is_inside(path):
+        return path == root or path.startswith(root + os.sep)
+
+    def checked_members(tar):
+        for member in tar:
+            parts = member.name.split('/')
+            if os.path.isabs(member.name) or '..' in parts:
+                raise ArtifactCacheError('unsafe path in artifact tarball: %s' % member.name)
+            dest = pjoin(artifact_dir, member.name)
+            if (not is_inside(os.path.realpath(os.path.dirname(dest))) or
+                os.path.islink(dest)):
+                raise ArtifactCacheError('artifact tarball writes through a symlink: %s' %
+                                         member.name)
+            if member.islnk() and (os.path.isabs(member.linkname) or not is_inside(
+                    os.path.realpath(pjoin(artifact_dir, member.linkname)))):
+                raise ArtifactCacheError('unsafe hard link in artifact tarball: %s' % member.name)
+            yield member
+
+    with tarfile.open(tarball, 'r:gz') as tar:
+        # extractall takes the members lazily, so each is checked after
+        # the ones before it have been extracted
+        tar.extractall(artifact_dir, checked_members(tar))
@@ -0,0 +1,255 @@
+"""
+:mod:`hashdist.core.block_gzip` --- Block-compressed, searchable logs
+=====================================================================
+
+Build logs are compressed while they are written, as a sequence of
+independent gzip members of about 64 KiB of text each. Blocks always
+end at a line boundary (unless a single line is longer than a block).
+A concatenation of gzip members is a valid gzip file, so the result
+can be read with ``zcat`` or :func:`gzip.open` as usual.
+
+Next to the compressed file, an index (``build.log.idx`` for
+``build.log.gz``) lists the blocks::
+
+    {
+      "version" : 1,
+      "bloom_bits" : 16384,
+      "blocks" : [
+        {"offset" : 0, "size" : 4398, "line" : 1, "bloom" : "eJzt..."},
+        ...
+      ]
+    }
+
+**offset**, **size**:
+    Location of the gzip member in the compressed file.
+
+**line**:
+    Line number of the first line in the block.
+
+**bloom**:
+    A Bloom filter (zlib-compressed and base64-encoded) of all
+    trigrams occurring within runs of word characters in the
+    lower-cased text of the block.
+
+To search for a string, only the blocks whose filter contains all
+trigrams of the words of the search string need to be decompressed;
+see :func:`grep`. Limiting the filter to trigrams within words keeps
+the cost of building it during the build low, while common searches
+(``error``, ``undefined reference``, a file name) are still narrowed
+down to few blocks.
+
+Reference
+---------
+
+"""
+
+import re
+import json
+import zlib
+import gzip
+import errno
+import base64
+
+from .common import json_formatting_options
+
+INDEX_VERSION = 1
+BLOCK_SIZE = 64 * 1024
+BLOOM_BITS = 16384
+
+# wbits value selecting the gzip container in zlib
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+_WORD_RE = re.compile(r'\w{3,}')
+
+
+def get_index_filename(filename):
+    """Returns the index filename belonging to `filename`, e.g.,
+    ``build.log.idx`` for ``build.log.gz``
+    """
+    if filename.endswith('.gz'):
+        filename = filename[:-len('.gz')]
+    return filename + '.idx'
+
+def _trigrams(text):
+    """Returns the set of trigrams within runs of word characters of `text`
+    """
+    result = set()
+    for word in set(_WORD_RE.findall(text.lower())):
+        result.update([word[i:i + 3] for i in xrange(len(word) - 2)])
+    return result
+
+def _bloom_positions(trigram):
+    h = zlib.crc32(trigram) & 0xffffffff
+    return h % BLOOM_BITS, (h >> 16) % BLOOM_BITS
+
+def make_bloom(text):
+    """Makes the (uncompressed) Bloom filter of a block of text
+    """
+    bits = bytearray(BLOOM_BITS // 8)
+    for trigram in _trigrams(text):
+        for pos in _bloom_positions(trigram):
+            bits[pos >> 3] |= 1 << (pos & 7)
+    return bits
+
+def bloom_may_contain(bits, needle):
+    """Whether a block with the Bloom filter `bits` may contain `needle`
+
+    `False` means that the block definitely does not contain `needle`
+    (in any case).
+    """
+    for trigram in _trigrams(needle):
+        for pos in _bloom_positions(trigram):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+    return True
+
+
+class BlockGzipWriter(object):
+    """
+    File-like object writing block-compressed text and its index
+
+    The compressed file is written as the blocks fill up; the index is
+    written by :meth:`close`.
+
+    Parameters
+    ----------
+
+    filename : str
+        The compressed file to write
+
+    index_filename : str (optional)
+        Defaults to :func:`get_index_filename` of `filename`
+
+    block_size : int (optional)
+        Approximate number of (uncompressed) bytes per block
+    """
+    def __init__(self, filename, index_filename=None, block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.index_filename = (index_filename if index_filename is not None
+                               else get_index_filename(filename))
+        self.block_size = block_size
+        self.blocks = []
+        self._f = open(filename, 'wb')
+        self._offset = 0
+        self._line = 1
+        self._buf = []
+        self._buflen = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self._buf.append(data)
+        self._buflen += len(data)
+        if self._buflen >= self.block_size:
+            self._flush_blocks(final=False)
+
+    def flush(self):
+        # blocks are only written when full, to keep the compression ratio
+        self._f.flush()
+
+    def _flush_blocks(self, final):
+        data = ''.join(self._buf)
+        pos = 0
+        while len(data) - pos >= self.block_size:
+            end = data.rfind('\n', pos, pos + self.block_size) + 1
+            if end == 0:
+                # no line break within a block; cut at next one, or the
+                # hard limit of a few blocks
+                end = data.find('\n', pos + self.block_size, pos + 4 * self.block_size) + 1
+                if end == 0:
+                    if len(data) - pos < 4 * self.block_size and not final:
+                        break
+                    end = pos + 4 * self.block_size
+            self._write_block(data[pos:end])
+            pos = end
+        if final and pos < len(data):
+            self._write_block(data[pos:])
+            pos = len(data)
+        rest = data[pos:]
+        self._buf = [rest] if rest else []
+        self._buflen = len(rest)
+
+    def _write_block(self, text):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, _GZIP_WBITS)
+        compressed = compressor.compress(text) + compressor.flush()
+        self._f.write(compressed)
+        bloom = base64.b64encode(zlib.compress(str(make_bloom(text))))
+        self.blocks.append({'offset': self._offset, 'size': len(compressed),
+                            'line': self._line, 'bloom': bloom})
+        self._offset += len(compressed)
+        self._line += text.count('\n')
+
+    def close(self):
+        if self._f is None:
+            return
+        self._flush_blocks(final=True)
+        self._f.close()
+        self._f = None
+        doc = {'version': INDEX_VERSION, 'bloom_bits': BLOOM_BITS, 'blocks': self.blocks}
+        with open(self.index_filename, 'w') as f:
+            json.dump(doc, f, **json_formatting_options)
+            f.write('\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_index(index_filename):
+    """Loads an index written by :class:`BlockGzipWriter`, or returns `None`
+    if it does not exist or is of an unknown version
+    """
+    try:
+        f = open(index_filename)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    with f:
+        doc = json.load(f)
+    if doc.get('version') != INDEX_VERSION or doc.get('bloom_bits') != BLOOM_BITS:
+        return None
+    return doc
+
+def iter_blocks(filename, needle=None, index_filename=None):
+    """Yields ``(first_line_number, text)`` for the blocks of `filename`
+
+    If `needle` is given, blocks that can not contain it (in any case)
+    are skipped without being decompressed. Files without an index
+    (e.g., regular gzip files) are treated as a single block.
+    """
+    if index_filename is None:
+        index_filename = get_index_filename(filename)
+    index = load_index(index_filename)
+    if index is None:
+        with gzip.open(filename) as f:
+            yield 1, f.read()
+        return
+    with open(filename, 'rb') as f:
+        for block in index['blocks']:
+            if needle is not None:
+                bits = bytearray(zlib.decompress(base64.b64decode(block['bloom'])))
+                if not bloom_may_contain(bits, needle):
+                    continue
+            f.seek(block['offset'])
+            yield block['line'], zlib.decompress(f.read(block['size']), _GZIP_WBITS)
+
+def grep(filename, needle, ignore_case=False, index_filename=None):
+    """Yields ``(line_number, line)`` for the lines of `filename` containing
+    the string `needle`
+
+    Lines are returned without the trailing newline.
+    """
+    folded_needle = needle.lower() if ignore_case else needle
+    for first_line, text in iter_blocks(filename, needle, index_filename):
+        haystack = text.lower() if ignore_case else text
+        if folded_needle not in haystack:
+            continue
+        lines = text.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        for i, line in enumerate(lines):
+            if folded_needle in (line.lower() if ignore_case else line):
+                yield first_line + i, line
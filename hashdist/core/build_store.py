@@ -42,6 +42,22 @@ later. Thus, the example above could be stored on disk as
 in the (rather unlikely) case of a collision. There is a symlink
 from the full ID to the shortened form. See also Discussion below.
 
+Next to each symlink in the db, a ``.layout.json`` file records which
+of the ``bin``, ``include`` and ``lib*`` sub-directories the artifact
+has (see :func:`probe_import_layout`), so that setting up the
+environment of a job importing many artifacts does not have to probe
+each of them.
+
+Looking up many artifacts at once (:meth:`BuildStore.load_index`,
+:meth:`BuildStore.status_many`) goes through an in-memory index of the
+db, which is loaded one shard (``digest[:2]`` directory) at a time; a
+single lookup uses the index if its shard is loaded, and otherwise
+reads the one symlink. A snapshot of the index is kept in ``artifacts.index`` in the db
+directory; shards whose modification time has not changed since the
+snapshot are not re-scanned. The symlinks remain the authoritative
+database: whenever the index misses or points to a missing directory,
+the symlink is consulted.
+
 Build specifications and inferring artifact IDs
 -----------------------------------------------
 
@@ -128,7 +144,72 @@ are set:
 
 The build specification is available under ``$BUILD/build.json``, and
 stdout and stderr are redirected to ``$BUILD/build.log``. These two
-files will also be present in ``$ARTIFACT`` after the build.
+files will also be present in ``$ARTIFACT`` after the build (the log as
+the block-compressed ``build.log.gz`` and its index ``build.log.idx``,
+see :mod:`hashdist.core.block_gzip`), together with
+``build-timings.json`` (see :mod:`hashdist.core.build_timings`) and
+``relocations.json`` (see :mod:`hashdist.core.relocate`).
+
+Build directory placement
+'''''''''''''''''''''''''
+
+Configure and compile steps are often bound by file system
+performance, so it pays to build on a ramdisk or a fast local disk
+rather than in ``builder/build-temp``. ``builder/build-roots`` takes a
+colon-separated list of directories to try first, e.g.::
+
+    [builder]
+    build-roots = /dev/shm/hdist-bld:/scratch/hdist-bld
+
+Each build directory goes in the first of these with room for the
+build, falling back to ``builder/build-temp``. The size of a build is
+estimated from the disk usage of the build directory at the end of
+the last build of the same name and version (1 GiB if it was never
+built); it is only measured if ``builder/build-roots`` is set. The
+whole tree must be placed up front, since builds record their own
+build directory path; a build running out of space once started is
+not moved.
+
+Incremental builds
+''''''''''''''''''
+
+When working on a package, rebuilding from a pristine build directory
+after every small change to the spec is slow. With ``incremental=True``
+(``--incremental`` in stack scripts), the build happens in
+``<name>-<version>-incremental`` in a build root instead, which is kept
+after the build and reused by the next build of the same name and
+version. Sources and inline files are unpacked on top of what is
+already there, leaving unchanged files untouched, so that ``make``
+and friends only redo what is needed. The build directory is reused
+in place, rather than copied from a snapshot, since build trees
+commonly record their own absolute path (CMake caches, libtool
+archives, ...).
+
+Incremental artifacts get a ``build-flags.json`` marking them as not
+reproducible, and are never pushed to the artifact cache. They are
+registered under the ID of the spec like any other artifact, so that
+dependent builds find them, but a later build that is not incremental
+does not accept them: the artifact is unregistered, removed and built
+again from a pristine build directory.
+
+Only one process at a time builds in an incremental build directory;
+builds of different specs with the same name and version share it, so
+this is a separate ``flock`` on ``locks/<name>-<version>-incremental.lock``
+(see below).
+
+Concurrent builds
+'''''''''''''''''
+
+Several processes may use the same store at once. Registering a built
+artifact is an atomic rename, so it needs no locking, but two
+processes asked for the same missing artifact would both build it.
+Therefore :meth:`BuildStore.ensure_present` takes an exclusive
+``flock`` on ``locks/<digest>.lock`` in the db directory before
+pulling or building; the second process waits and then finds the
+artifact registered. Artifacts that are already present are returned
+without touching the lock. See
+``hashdist/core/test/test_build_store_concurrency.py`` for a stress
+test which can also be run as a benchmark.
 
 
 Discussion
@@ -179,16 +260,52 @@ import sys
 import re
 import errno
 import json
+import time
 from logging import DEBUG
 
 from .hasher import Hasher
 from .common import (InvalidBuildSpecError, BuildFailedError,
                      json_formatting_options, SHORT_ARTIFACT_ID_LEN,
                      working_directory)
-from .fileutils import silent_unlink, rmtree_up_to, silent_makedirs, gzip_compress, write_protect
+from .fileutils import (silent_unlink, rmtree_up_to, silent_makedirs, write_protect,
+                        atomic_write, get_disk_usage, get_free_space, Trash, TRASH_DIRNAME,
+                        empty_trash, empty_trash_in_background, file_lock)
+from .build_timings import BuildTimings, BUILD_TIMINGS_FILENAME
+from .block_gzip import BlockGzipWriter
+from .dedup import DedupIndex, DEDUP_INDEX_DIRNAME
+from .artifact_cache import create_artifact_cache, null_artifact_cache
+from .cache import DiskCache, null_cache
+from .relocate import record_relocations
 from . import run_job
 
 
+# Suffix of the import layout record stored next to each db symlink
+IMPORT_LAYOUT_SUFFIX = '.layout.json'
+
+# Written to incrementally built artifacts
+BUILD_FLAGS_FILENAME = 'build-flags.json'
+
+# Snapshot of the artifact index, relative to the db dir
+INDEX_FILENAME = 'artifacts.index'
+
+# Directory of build locks, relative to the db dir
+LOCKS_DIRNAME = 'locks'
+
+# DiskCache domain for the disk usage of build dirs, keyed by (name, version)
+BUILD_SIZES_DOMAIN = 'hashdist.core.build_store.build_sizes'
+
+# Assumed disk usage of builds that were never done before
+DEFAULT_BUILD_SIZE_ESTIMATE = 1024**3
+
+# Number of threads removing trees in delete_all
+DEFAULT_DELETE_JOBS = 8
+
+# Seconds between progress reports of delete_all
+DELETE_PROGRESS_INTERVAL = 2
+
+# Shards modified less than this many seconds before being scanned are
+# always re-scanned
+INDEX_MTIME_SLACK = 2
 
 class BuildSpec(object):
     """Wraps the document corresponding to a build.json
@@ -260,6 +377,38 @@ def assert_safe_name(x):
     return x
 
 
+def probe_import_layout(artifact_dir):
+    """Finds the sub-directories of an artifact that are used when importing
+    it into a job environment (see :func:`hashdist.core.run_job.get_imports_env`)
+
+    Returns
+    -------
+
+    layout : dict
+        ``{"bin": bool, "include": bool, "libdirs": [name, ...]}``, where
+        `libdirs` lists the entries of `artifact_dir` matching ``lib*``.
+    """
+    names = os.listdir(artifact_dir)
+    return {'bin': 'bin' in names and os.path.exists(pjoin(artifact_dir, 'bin')),
+            'include': 'include' in names and os.path.exists(pjoin(artifact_dir, 'include')),
+            'libdirs': sorted(x for x in names if x.startswith('lib'))}
+
+def is_reproducible(artifact_dir):
+    """Whether the artifact was built from scratch, rather than incrementally
+    (see ``build-flags.json``)
+    """
+    return not os.path.exists(pjoin(artifact_dir, BUILD_FLAGS_FILENAME))
+
+def format_size(nbytes):
+    """Formats a number of bytes for humans, e.g., ``'1.5 GiB'``"""
+    for unit in ('bytes', 'KiB', 'MiB', 'GiB'):
+        if nbytes < 1024 or unit == 'GiB':
+            break
+        nbytes /= 1024.
+    if unit == 'bytes':
+        return '%d bytes' % nbytes
+    return '%.1f %s' % (nbytes, unit)
+
 def shorten_artifact_id(artifact_id, length=SHORT_ARTIFACT_ID_LEN):
     """Shortens the hash part of the artifact_id to the desired length
     """
@@ -306,29 +455,68 @@ class BuildStore(object):
         Example: ``{name}-{version}/{shorthash}``
 
     logger : Logger
+
+    artifact_cache : ArtifactCache (optional)
+        Remote cache of binary artifacts to consult before building, and
+        upload built artifacts to (see :mod:`hashdist.core.artifact_cache`).
+
+    build_roots : list of str (optional)
+        Directories to try to place build directories in before
+        `temp_build_dir`, e.g., on a ramdisk or a fast local disk (see
+        :meth:`choose_build_root`). Like `temp_build_dir`, each should be
+        dedicated to Hashdist, as :meth:`delete_all` empties them.
+
+    cache : DiskCache (optional)
+        Used to remember the disk usage of previous builds.
+
+    dedup : bool (optional)
+        Whether to hard-link files of new artifacts to identical files
+        in other artifacts (see :mod:`hashdist.core.dedup`).
     """
 
 
     def __init__(self, temp_build_dir, db_dir, artifact_root, artifact_path_pattern, logger,
-                 create_dirs=False, short_hash_len=SHORT_ARTIFACT_ID_LEN):
+                 create_dirs=False, short_hash_len=SHORT_ARTIFACT_ID_LEN,
+                 artifact_cache=null_artifact_cache, build_roots=(), cache=null_cache,
+                 dedup=False):
         if not os.path.isdir(db_dir) and not create_dirs:
             raise ValueError('"%s" is not an existing directory' % db_dir)
         if not '{shorthash}' in artifact_path_pattern:
             raise ValueError('artifact_path_pattern must contain at least "{shorthash}"')
         self.temp_build_dir = os.path.realpath(temp_build_dir)
+        self.build_roots = []
+        for d in [os.path.realpath(os.path.expanduser(x)) for x in build_roots]:
+            if d != self.temp_build_dir and d not in self.build_roots:
+                self.build_roots.append(d)
+        self.build_roots.append(self.temp_build_dir)
+        self.cache = cache
+        self.dedup = dedup
         self.ba_db_dir = pjoin(os.path.realpath(db_dir), "artifacts")
         self.artifact_root = os.path.realpath(artifact_root)
         self.artifact_path_pattern = artifact_path_pattern
         self.logger = logger
         self.short_hash_len = short_hash_len
+        self.artifact_cache = artifact_cache
+        self.index_filename = pjoin(os.path.realpath(db_dir), INDEX_FILENAME)
+        self.locks_dir = pjoin(os.path.realpath(db_dir), LOCKS_DIRNAME)
+        self.invalidate_index()
         if create_dirs:
             for d in [self.temp_build_dir, self.ba_db_dir, self.artifact_root]:
                 silent_makedirs(d)
 
     @staticmethod
     def create_from_config(config, logger, **kw):
-        """Creates a SourceCache from the settings in the configuration
+        """Creates a BuildStore from the settings in the configuration
         """
+        if 'artifact_cache' not in kw:
+            kw['artifact_cache'] = create_artifact_cache(config.get('builder/artifact-cache'),
+                                                         logger)
+        if 'build_roots' not in kw:
+            kw['build_roots'] = [x for x in config.get('builder/build-roots', '').split(':') if x]
+        if 'dedup' not in kw:
+            kw['dedup'] = config.get('builder/dedup', False)
+        if 'cache' not in kw and 'global/cache' in config:
+            kw['cache'] = DiskCache.create_from_config(config, logger)
         return BuildStore(config['builder/build-temp'],
                           config['global/db'],
                           config['builder/artifacts'],
@@ -339,73 +527,401 @@ class BuildStore(object):
     def get_build_dir(self):
         return self.temp_build_dir
 
-    def delete_all(self):
-        for dirpath, dirnames, filenames in os.walk(self.ba_db_dir):
-            for link in filenames:
-                link = pjoin(dirpath, link)
-                if not os.path.islink(link):
-                    self.logger.warning("%s is not a symlink" % link)
+    def get_build_roots(self):
+        """Returns all directories build directories may be placed in, in
+        order of preference; the last one is always `temp_build_dir`
+        """
+        return list(self.build_roots)
+
+    def delete_all(self, jobs=DEFAULT_DELETE_JOBS, background=False):
+        """Removes all artifacts, the db and all build directories
+
+        The db and everything to remove is first moved into trash
+        directories (see :class:`~hashdist.core.fileutils.Trash`), one
+        rename each, so that the store is consistently empty right
+        away. The trees are then removed using `jobs` threads, in a
+        detached process if `background` is set. Any leftovers of an
+        interrupted earlier call are removed as well.
+
+        Returns
+        -------
+
+        freed : int or None
+            Number of bytes freed, or `None` if removal was left to a
+            background process
+        """
+        db_dir = os.path.dirname(self.ba_db_dir)
+        trashed_db = Trash(db_dir).move(self.ba_db_dir)
+        silent_makedirs(self.ba_db_dir)
+        silent_unlink(self.index_filename)
+        self.invalidate_index()
+
+        artifact_trash = Trash(self.artifact_root)
+        # entries would keep the contents of the artifacts alive
+        artifact_trash.move(pjoin(self.artifact_root, DEDUP_INDEX_DIRNAME))
+        if trashed_db is not None:
+            for dirpath, dirnames, filenames in os.walk(trashed_db):
+                # links are relative to where they were in the db
+                orig_dirpath = os.path.normpath(pjoin(self.ba_db_dir,
+                                                      os.path.relpath(dirpath, trashed_db)))
+                for link in filenames:
+                    if link.endswith(IMPORT_LAYOUT_SUFFIX):
+                        continue
+                    orig_link = pjoin(orig_dirpath, link)
+                    link = pjoin(dirpath, link)
+                    if not os.path.islink(link):
+                        self.logger.warning("%s is not a symlink" % orig_link)
+                        continue
+                    artifact_dir = os.path.realpath(pjoin(orig_dirpath, os.readlink(link)))
+                    if not artifact_dir.startswith(self.artifact_root + os.sep):
+                        self.logger.warning("%s escapes %s, doing nothing with it" %
+                                            (artifact_dir, self.artifact_root))
+                        continue
+                    if artifact_trash.move(artifact_dir) is None:
+                        self.logger.warning("%s referenced in db but does not exist" % artifact_dir)
+
+        for root in self.build_roots:
+            if not os.path.isdir(root):
+                continue
+            build_trash = Trash(root)
+            for x in os.listdir(root):
+                if x != TRASH_DIRNAME:
+                    build_trash.move(pjoin(root, x))
+
+        roots = [db_dir, self.artifact_root] + self.build_roots
+        if background:
+            empty_trash_in_background(roots, jobs)
+            self.logger.info('Store emptied; removing files in the background')
+            return None
+        freed = empty_trash(roots, jobs, self._make_deletion_progress_reporter())
+        self.logger.info('Freed %s' % format_size(freed))
+        return freed
+
+    def _make_deletion_progress_reporter(self):
+        state = {'last': time.time()}
+        def progress(done, total, freed):
+            now = time.time()
+            if done == total or now - state['last'] >= DELETE_PROGRESS_INTERVAL:
+                state['last'] = now
+                self.logger.info('Removed %d of %d trees (%s freed)' %
+                                 (done, total, format_size(freed)))
+        return progress
+
+    def _get_artifact_link(self, artifact_id):
+        name, digest = artifact_id.split('/')
+        return pjoin(self.ba_db_dir, digest[:2], digest[2:])
+
+    def invalidate_index(self):
+        """Forgets the in-memory index of artifacts
+
+        Should be called if the db has been modified in ways not
+        noticed by the index, e.g., if another process removed
+        artifacts while this one keeps running.
+        """
+        self._index_shards = {} # { shard : { digest-rest : artifact_dir } }
+        self._index_snapshot = None
+        self._index_dirty = False
+
+    def _load_index_snapshot(self):
+        if self._index_snapshot is None:
+            try:
+                with open(self.index_filename) as f:
+                    self._index_snapshot = json.load(f)['shards']
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._index_snapshot = {}
+            except (ValueError, KeyError):
+                self.logger.warning('Ignoring corrupt artifact index %s' % self.index_filename)
+                self._index_snapshot = {}
+        return self._index_snapshot
+
+    def _get_index_shard(self, shard, revalidate=False):
+        """Returns the index entries of the shard, scanning it if needed
+
+        If `revalidate` is set, a shard already in memory is re-scanned
+        if it has been modified since, so that the result is complete
+        (rather than having to fall back to the symlinks on misses).
+        """
+        cached = self._index_shards.get(shard)
+        if cached is not None and not revalidate:
+            return cached[1]
+        shard_dir = pjoin(self.ba_db_dir, shard)
+        try:
+            mtime = os.stat(shard_dir).st_mtime
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # don't cache; the shard will appear once something is registered
+            self._index_shards.pop(shard, None)
+            return {}
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        snapshot = self._load_index_snapshot().get(shard)
+        if snapshot is not None and snapshot['mtime'] == mtime:
+            entries = dict((rest, os.path.normpath(pjoin(shard_dir, target)))
+                           for rest, target in snapshot['entries'].iteritems())
+        else:
+            if mtime > time.time() - INDEX_MTIME_SLACK:
+                # further changes within the resolution of the filesystem
+                # timestamps would go unnoticed, so don't trust it later
+                mtime = None
+            entries = {}
+            for rest in os.listdir(shard_dir):
+                if rest.endswith(IMPORT_LAYOUT_SUFFIX) or rest.startswith('.'):
                     continue
-                artifact_dir = os.path.realpath(pjoin(dirpath, link))
-                if not artifact_dir.startswith(self.artifact_root):
-                    self.logger.warning("%s escapes %s, doing nothing with it" %
-                                        (artifact_dir, self.artifact_root))
                 try:
-                    shutil.rmtree(artifact_dir)
+                    target = os.readlink(pjoin(shard_dir, rest))
                 except OSError, e:
-                    if e.errno != errno.ENOENT:
+                    if e.errno not in (errno.ENOENT, errno.EINVAL):
                         raise
-                    else:
-                        self.logger.warning("%s referenced in db but does not exist" % artifact_dir)
+                else:
+                    entries[rest] = os.path.realpath(pjoin(shard_dir, target))
+            self._index_dirty = True
+        self._index_shards[shard] = (mtime, entries)
+        return entries
+
+    def _get_loaded_index_shard(self, shard):
+        """Returns the index entries of the shard if it is in memory, or
+        `None`; looking up a single artifact is cheaper than scanning
+        """
+        cached = self._index_shards.get(shard)
+        return None if cached is None else cached[1]
 
-        for x in os.listdir(self.ba_db_dir):
-            shutil.rmtree(pjoin(self.ba_db_dir, x))
+    def load_index(self):
+        """Loads the index of all artifacts in the db, and refreshes the
+        snapshot of it stored on disk if it was out of date
 
-        for x in os.listdir(self.temp_build_dir):
-            shutil.rmtree(pjoin(self.temp_build_dir, x))
+        Calling this is never needed for correctness; it is done
+        before looking up many artifacts at once.
+        """
+        for shard in os.listdir(self.ba_db_dir):
+            self._get_index_shard(shard)
+        if self._index_dirty:
+            self.save_index()
 
-    def _get_artifact_link(self, artifact_id):
-        name, digest = artifact_id.split('/')
-        return pjoin(self.ba_db_dir, digest[:2], digest[2:])
+    def save_index(self):
+        """Writes the snapshot of the index to disk
 
-    def resolve(self, artifact_id):
-        """Given an artifact_id, resolve the short path for it, or return
-        None if the artifact isn't built.
+        Shards that were modified very recently when scanned are stored
+        without a modification time, and so are re-scanned the next time.
         """
-        link = self._get_artifact_link(artifact_id)
-        # automatically heal the link database if an artifact has been manually removed
+        shards = dict(self._load_index_snapshot())
+        for shard, (mtime, entries) in self._index_shards.iteritems():
+            shard_dir = pjoin(self.ba_db_dir, shard)
+            shards[shard] = {
+                'mtime': mtime,
+                'entries': dict((rest, os.path.relpath(a_dir, shard_dir))
+                                for rest, a_dir in entries.iteritems())}
+        try:
+            with atomic_write(self.index_filename) as f:
+                json.dump({'shards': shards}, f)
+        except (IOError, OSError), e:
+            # e.g., a read-only db; the index is only an optimization
+            self.logger.debug('Could not write artifact index: %s' % e)
+            return
+        self._index_snapshot = shards
+        self._index_dirty = False
+
+    def _resolve_link(self, link):
         try:
             a_dir = os.readlink(link)
         except OSError, e:
             if e.errno == errno.ENOENT:
-                a_dir = None
+                return None
             else:
                 raise
-        else:
-            a_dir = os.path.realpath(pjoin(os.path.dirname(link), a_dir))
-            if not os.path.exists(a_dir):
-                self.logger.warning('Artifact %s has been manually removed; removing entry' %
-                                    artifact_id)
-                os.unlink(link)
-                a_dir = None
+        return os.path.realpath(pjoin(os.path.dirname(link), a_dir))
+
+    def resolve(self, artifact_id):
+        """Given an artifact_id, resolve the short path for it, or return
+        None if the artifact isn't built.
+        """
+        name, digest = artifact_id.split('/')
+        # shards are only scanned by bulk lookups (load_index, status_many)
+        entries = self._get_loaded_index_shard(digest[:2])
+        if entries is not None:
+            a_dir = entries.get(digest[2:])
+            if a_dir is not None and os.path.exists(a_dir):
+                return a_dir
+        # Not indexed, not in the index (registered by another process after
+        # the shard was indexed), or the index is stale; go to the link itself
+        link = self._get_artifact_link(artifact_id)
+        a_dir = self._resolve_link(link)
+        # automatically heal the link database if an artifact has been manually removed
+        if a_dir is not None and not os.path.exists(a_dir):
+            self.logger.warning('Artifact %s has been manually removed; removing entry' %
+                                artifact_id)
+            os.unlink(link)
+            silent_unlink(link + IMPORT_LAYOUT_SUFFIX)
+            a_dir = None
+        if entries is not None:
+            if a_dir is None:
+                entries.pop(digest[2:], None)
+            else:
+                entries[digest[2:]] = a_dir
         return a_dir
 
+    def get_import_layout(self, artifact_id, artifact_dir):
+        """Returns the import layout of an artifact (see :func:`probe_import_layout`)
+
+        The layout is recorded in the db when the artifact is registered;
+        for artifacts registered without one, `artifact_dir` (as returned
+        by :meth:`resolve`) is probed instead.
+        """
+        try:
+            with open(self._get_artifact_link(artifact_id) + IMPORT_LAYOUT_SUFFIX) as f:
+                return json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            # truncated or otherwise corrupted
+            pass
+        return probe_import_layout(artifact_dir)
+
     def is_present(self, build_spec):
         build_spec = as_build_spec(build_spec)
         return self.resolve(build_spec.artifact_id) is not None
 
-    def ensure_present(self, build_spec, config, virtuals=None, keep_build='never'):
+    def status_many(self, specs_or_ids):
+        """Finds out which of many artifacts are present in the store
+
+        Unlike :meth:`is_present`, the db is queried with a single
+        directory scan of each shard involved (at most), and the db is not
+        healed.
+
+        Parameters
+        ----------
+
+        specs_or_ids : list
+            Build specs or artifact IDs
+
+        Returns
+        -------
+
+        status : dict
+            Maps each artifact ID to `True` if it is present, `False` otherwise
+        """
+        by_shard = {}
+        for x in specs_or_ids:
+            artifact_id = x if isinstance(x, basestring) else as_build_spec(x).artifact_id
+            name, digest = artifact_id.split('/')
+            by_shard.setdefault(digest[:2], []).append((artifact_id, digest[2:]))
+        status = {}
+        for shard, items in by_shard.iteritems():
+            entries = self._get_index_shard(shard, revalidate=True)
+            for artifact_id, rest in items:
+                a_dir = entries.get(rest)
+                status[artifact_id] = a_dir is not None and os.path.exists(a_dir)
+        if self._index_dirty:
+            self.save_index()
+        return status
+
+    def ensure_present(self, build_spec, config, virtuals=None, keep_build='never',
+                       incremental=False):
+        """Makes sure the artifact is present, building it if necessary
+
+        Artifacts are taken from the artifact cache if possible, and
+        artifacts built are pushed to it, except for incremental builds
+        (see :class:`ArtifactBuilder`) which are never pushed. New
+        artifacts are deduplicated if `dedup` was set for the store.
+
+        Returns
+        -------
+
+        artifact_id, artifact_dir : str
+        """
         if virtuals is None:
             virtuals = {}
         if keep_build not in ('never', 'error', 'always'):
             raise ValueError("invalid keep_build value")
         build_spec = as_build_spec(build_spec)
         artifact_dir = self.resolve(build_spec.artifact_id)
-        if artifact_dir is None:
-            builder = ArtifactBuilder(self, build_spec, virtuals)
-            artifact_dir = builder.build(config, keep_build)
+        if artifact_dir is not None and (incremental or is_reproducible(artifact_dir)):
+            return build_spec.artifact_id, artifact_dir
+        with self.build_lock(build_spec):
+            # somebody else may have finished it while we waited
+            artifact_dir = self.resolve(build_spec.artifact_id)
+            if (artifact_dir is not None and not incremental and
+                not is_reproducible(artifact_dir)):
+                self.logger.info('%s was built incrementally; rebuilding it' %
+                                 shorten_artifact_id(build_spec.artifact_id))
+                self.unregister_artifact(build_spec.artifact_id)
+                shutil.rmtree(artifact_dir)
+                artifact_dir = None
+            if artifact_dir is None:
+                artifact_dir = self.artifact_cache.pull(self, build_spec)
+                if artifact_dir is not None and self.dedup:
+                    self.dedup_artifact(artifact_dir)
+            if artifact_dir is None:
+                builder = ArtifactBuilder(self, build_spec, virtuals, incremental)
+                artifact_dir = builder.build(config, keep_build)
+                if not incremental:
+                    self.artifact_cache.push(self, build_spec.artifact_id, artifact_dir)
+                if self.dedup:
+                    self.dedup_artifact(artifact_dir)
         return build_spec.artifact_id, artifact_dir
 
+    def build_lock(self, build_spec):
+        """Context manager holding the lock on building `build_spec`
+
+        The lock is a ``flock`` on ``locks/<digest>.lock`` in the db
+        directory, so that processes building the same artifact at the
+        same time (e.g., concurrent CI jobs) wait for each other instead
+        of duplicating the work. Registration itself does not depend on
+        the lock.
+        """
+        def on_wait():
+            self.logger.info('Waiting for another process building %s' %
+                             shorten_artifact_id(build_spec.artifact_id))
+        return file_lock(pjoin(self.locks_dir, '%s.lock' % build_spec.digest), on_wait)
+
+    def incremental_build_lock(self, build_spec):
+        """Context manager holding the lock on the incremental build
+        directory of `build_spec` (see :meth:`make_incremental_build_dir`)
+
+        The directory is shared by all specs with the same name and
+        version, which :meth:`build_lock` does not cover.
+        """
+        name = '%s-%s-incremental' % (build_spec.doc['name'], build_spec.doc['version'])
+        def on_wait():
+            self.logger.info('Waiting for another process building in %s' % name)
+        return file_lock(pjoin(self.locks_dir, '%s.lock' % name), on_wait)
+
+    def get_dedup_index(self):
+        return DedupIndex(self.artifact_root, self.logger)
+
+    def dedup_artifact(self, artifact_dir):
+        """Hard-links the files of an artifact to identical files in the
+        rest of the store (see :mod:`hashdist.core.dedup`)
+        """
+        linked, saved = self.get_dedup_index().dedup_artifact(artifact_dir)
+        if linked:
+            self.logger.info('Deduplicated %d files, freed %s' % (linked, format_size(saved)))
+
+    def dedup_store(self, rescan=False):
+        """Deduplicates all artifacts that were not deduplicated before (or
+        all of them, if `rescan` is set), and prunes the index
+
+        Returns the number of bytes freed.
+        """
+        index = self.get_dedup_index()
+        saved = index.dedup_artifacts(self.list_artifact_dirs(), rescan)
+        pruned = index.prune()
+        self.logger.info('Freed %s; pruned %d unused index entries' %
+                         (format_size(saved), pruned))
+        return saved
+
+    def list_artifact_dirs(self):
+        """Returns the directories of all artifacts in the db"""
+        dirs = []
+        for shard in sorted(os.listdir(self.ba_db_dir)):
+            dirs.extend(self._get_index_shard(shard, revalidate=True).itervalues())
+        if self._index_dirty:
+            self.save_index()
+        return sorted(d for d in dirs if os.path.isdir(d))
+
     def make_artifact_dir(self, build_spec):
         """
         Makes a directory to put the result of the artifact build in.
@@ -447,26 +963,78 @@ class BuildStore(object):
         link = self._get_artifact_link(build_spec.artifact_id)
         rel_artifact_dir = os.path.relpath(artifact_dir, os.path.dirname(link))
         silent_makedirs(os.path.dirname(link))
+        # The layout record must be in place before the artifact becomes
+        # visible through the link
+        layout_filename = link + IMPORT_LAYOUT_SUFFIX
+        with atomic_write(layout_filename) as f:
+            json.dump(probe_import_layout(artifact_dir), f, **json_formatting_options)
         try:
             os.symlink(rel_artifact_dir, link)
         except OSError, e:
             shutil.rmtree(artifact_dir)
             if e.errno == errno.EEXIST:
-                return os.path.realpath(link)
+                artifact_dir = os.path.realpath(link)
             else:
                 raise
-        else:
-            return artifact_dir
+        digest = build_spec.digest
+        entries = self._get_loaded_index_shard(digest[:2])
+        if entries is not None:
+            entries[digest[2:]] = artifact_dir
+        return artifact_dir
+
+    def unregister_artifact(self, artifact_id):
+        """Removes an artifact from the db, leaving its directory alone
+        """
+        link = self._get_artifact_link(artifact_id)
+        silent_unlink(link)
+        silent_unlink(link + IMPORT_LAYOUT_SUFFIX)
+        name, digest = artifact_id.split('/')
+        entries = self._get_loaded_index_shard(digest[:2])
+        if entries is not None:
+            entries.pop(digest[2:], None)
                    
+    def estimate_build_size(self, build_spec):
+        """Returns the disk usage of the build directory of the last build
+        of the same name and version, or `DEFAULT_BUILD_SIZE_ESTIMATE`
+        """
+        return self.cache.get(BUILD_SIZES_DOMAIN, (build_spec.name, build_spec.version),
+                              DEFAULT_BUILD_SIZE_ESTIMATE)
+
+    def record_build_size(self, build_spec, size):
+        self.cache.put(BUILD_SIZES_DOMAIN, (build_spec.name, build_spec.version), size)
+
+    def choose_build_root(self, build_spec):
+        """Picks the build root to place a build directory for `build_spec` in
+
+        The first root in :meth:`get_build_roots` with enough free space for
+        the estimated size of the build (see :meth:`estimate_build_size`)
+        is used. Roots that do not exist are created; roots that can not be
+        created or are full are skipped, falling back to `temp_build_dir`.
+        """
+        estimate = self.estimate_build_size(build_spec)
+        for root in self.build_roots[:-1]:
+            try:
+                silent_makedirs(root)
+                free = get_free_space(root)
+            except OSError, e:
+                self.logger.debug('Skipping build root %s: %s' % (root, e))
+                continue
+            if free >= estimate:
+                return root
+            self.logger.debug('Skipping build root %s: %d bytes free, build needs about %d' %
+                              (root, free, estimate))
+        return self.build_roots[-1]
+
     def make_build_dir(self, build_spec):
         """Creates a temporary build directory
 
         Just to get a nicer name than mkdtemp would. The caller is responsible
-        for removal.
+        for removal. The directory is placed in the root returned by
+        :meth:`choose_build_root`.
         """
         name = '%s-%s-%s' % (build_spec.doc['name'], build_spec.doc['version'],
                              build_spec.digest[:self.short_hash_len])
-        build_dir = orig_build_dir = pjoin(self.temp_build_dir, name)
+        build_dir = orig_build_dir = pjoin(self.choose_build_root(build_spec), name)
         i = 0
         # Try to make build_dir, if not then increment a -%d suffix until we
         # find a free slot
@@ -483,59 +1051,127 @@ class BuildStore(object):
         self.logger.debug('Created build dir: %s' % build_dir)
         return build_dir
         
+    def make_incremental_build_dir(self, build_spec):
+        """Returns the build directory used for incremental builds of
+        `build_spec`, creating it if necessary
+
+        The directory only depends on the name and version of the build,
+        so that it is reused by later builds of changed specs. It is
+        never removed automatically. The caller should hold
+        :meth:`incremental_build_lock` while using it.
+        """
+        name = '%s-%s-incremental' % (build_spec.doc['name'], build_spec.doc['version'])
+        for root in self.build_roots:
+            build_dir = pjoin(root, name)
+            if os.path.isdir(build_dir):
+                break
+        else:
+            build_dir = pjoin(self.choose_build_root(build_spec), name)
+            silent_makedirs(build_dir)
+        self.logger.debug('Using incremental build dir: %s' % build_dir)
+        return build_dir
+
     def remove_build_dir(self, build_dir):
         self.logger.debug('Removing build dir: %s' % build_dir)
         shutil.rmtree(build_dir)
  
 class ArtifactBuilder(object):
-    def __init__(self, build_store, build_spec, virtuals):
+    """
+    Builds a single artifact.
+
+    If `incremental` is set, the build happens in a build directory
+    that is kept between builds of the same name and version (see
+    :meth:`BuildStore.make_incremental_build_dir`), so that build
+    systems can skip the work that is already done. Sources and files
+    are unpacked on top of the existing tree, leaving unchanged files
+    (and their timestamps) alone; ``HDIST_INCREMENTAL=1`` is set in the
+    build environment. The result depends on what was left in the
+    build directory, so such artifacts are marked as not reproducible
+    in ``build-flags.json``.
+    """
+    def __init__(self, build_store, build_spec, virtuals, incremental=False):
         self.build_store = build_store
         self.logger = build_store.logger.get_sub_logger(build_spec.doc['name'])
         self.build_spec = build_spec
         self.artifact_id = build_spec.artifact_id
         self.virtuals = virtuals
+        self.incremental = incremental
+        self.timings = BuildTimings()
 
     def build(self, config, keep_build):
         assert isinstance(config, dict), "caller not refactored"
         artifact_dir = self.build_store.make_artifact_dir(self.build_spec)
         try:
             self.build_to(artifact_dir, config, keep_build)
+            with self.timings.step('relocations'):
+                record_relocations(artifact_dir)
+            # saved before registering, so that registered artifacts
+            # always have their timings
+            self.timings.save(pjoin(artifact_dir, BUILD_TIMINGS_FILENAME),
+                              artifact_id=self.artifact_id, virtuals=self.virtuals)
         except:
             shutil.rmtree(artifact_dir)
             raise
-        artifact_dir = self.build_store.register_artifact(self.build_spec, artifact_dir)
-        return artifact_dir
+        return self.build_store.register_artifact(self.build_spec, artifact_dir)
 
     def build_to(self, artifact_dir, config, keep_build):
         if keep_build not in ('never', 'always', 'error'):
             raise ValueError("keep_build not in ('never', 'always', 'error')")
-        build_dir = self.build_store.make_build_dir(self.build_spec)
+        if self.incremental:
+            with self.build_store.incremental_build_lock(self.build_spec):
+                build_dir = self.build_store.make_incremental_build_dir(self.build_spec)
+                return self.build_in(build_dir, artifact_dir, config, keep_build)
+        else:
+            build_dir = self.build_store.make_build_dir(self.build_spec)
+            return self.build_in(build_dir, artifact_dir, config, keep_build)
+
+    def build_in(self, build_dir, artifact_dir, config, keep_build):
         should_keep = False # failures in init are bugs in hashdist itself, no need to keep dir
         try:
             env = {}
             env['ARTIFACT'] = artifact_dir
             env['BUILD'] = build_dir
+            if self.incremental:
+                env['HDIST_INCREMENTAL'] = '1'
             self.serialize_build_spec(build_dir)
 
             should_keep = (keep_build == 'always')
             try:
                 self.run_build_commands(build_dir, artifact_dir, env, config)
                 self.serialize_build_spec(artifact_dir)
+                # the estimate only matters when there is a choice of roots
+                if len(self.build_store.build_roots) > 1:
+                    self.build_store.record_build_size(self.build_spec,
+                                                       get_disk_usage(build_dir))
+                if self.incremental:
+                    self.write_build_flags(artifact_dir, build_dir)
             except:
                 should_keep = (keep_build in ('always', 'error'))
                 raise
         finally:
-            if not should_keep:
+            if not should_keep and not self.incremental:
                 self.build_store.remove_build_dir(build_dir)
         return artifact_dir
 
     def serialize_build_spec(self, d):
         fname = pjoin(d, 'build.json')
+        # left write-protected by a previous incremental build
+        silent_unlink(fname)
         with file(fname, 'w') as f:
             json.dump(self.build_spec.doc, f, **json_formatting_options)
             f.write('\n')
         write_protect(fname)
 
+    def write_build_flags(self, artifact_dir, build_dir):
+        self.logger.warning('%s was built incrementally in %s and is not reproducible' %
+                            (self.artifact_id, build_dir))
+        fname = pjoin(artifact_dir, BUILD_FLAGS_FILENAME)
+        with file(fname, 'w') as f:
+            json.dump({'incremental': True, 'reproducible': False, 'build_dir': build_dir},
+                      f, **json_formatting_options)
+            f.write('\n')
+        write_protect(fname)
+
     def run_build_commands(self, build_dir, artifact_dir, env, config):
         artifact_display_name = self.build_spec.digest[:SHORT_ARTIFACT_ID_LEN] + '..'
 
@@ -543,6 +1179,10 @@ class ArtifactBuilder(object):
 
         logger = self.logger
         log_filename = pjoin(build_dir, 'build.log')
+        log_gz_filename = pjoin(artifact_dir, 'build.log.gz')
+        # the log is compressed as it is written; the uncompressed copy is
+        # for following the build and for inspecting failed builds
+        log_gz = BlockGzipWriter(log_gz_filename)
         with file(log_filename, 'w') as log_file:
             if logger.level > DEBUG:
                 logger.info('Building %s, follow log with:' % artifact_display_name)
@@ -550,11 +1190,14 @@ class ArtifactBuilder(object):
             else:
                 logger.info('Building %s' % artifact_display_name)
             logger.push_stream(log_file, raw=True)
+            logger.push_stream(log_gz, raw=True)
             try:
-                run_job.run_job(logger, self.build_store, job_spec,
-                                env, self.virtuals, build_dir, config)
+                with self.timings.step('script'):
+                    run_job.run_job(logger, self.build_store, job_spec,
+                                    env, self.virtuals, build_dir, config, self.timings)
             except:
                 exc_type, exc_value, exc_tb = sys.exc_info()
+                log_gz.close()
                 # Python 2 'wrapped exception': We raise an exception with the same traceback
                 # but changing the type, and embedding the original type name in the message
                 # string. This is primarily done in order to communicate the build_dir to
@@ -562,7 +1205,9 @@ class ArtifactBuilder(object):
                 raise BuildFailedError("%s: %s" % (exc_type.__name__, exc_value), build_dir), None, exc_tb
             finally:
                 logger.pop_stream()
-        log_gz_filename = pjoin(artifact_dir, 'build.log.gz')
-        gzip_compress(pjoin(build_dir, 'build.log'), log_gz_filename)
+                logger.pop_stream()
+        with self.timings.step('compress-log'):
+            log_gz.close()
         write_protect(log_gz_filename)
+        write_protect(log_gz.index_filename)
 
@@ -0,0 +1,218 @@
+"""
+:mod:`hashdist.core.build_timings` --- Build timing and profiling
+=================================================================
+
+Every build records how much time and resources each of its steps
+consumed, and stores the result as ``build-timings.json`` in the
+artifact. Example::
+
+    {
+      "artifact_id" : "zlib/4niostz3iktlg67najtxuwwgss5vl6k4",
+      "virtuals" : {"virtual:unix" : "unix/7bjnosd4kcvbzuz3rggekk2bjpm6bnxn"},
+      "wall" : 41.8,
+      "steps" : [
+        {
+          "name" : "script",
+          "wall" : 41.5, "cpu" : 38.2, "maxrss_kb" : 81234,
+          "read_bytes" : 0, "write_bytes" : 1916928,
+          "steps" : [
+            {"name" : "command", "command" : ["hdist", "build-unpack-sources"], ...},
+            {"name" : "command", "command" : ["make", "-j4"], ...}
+          ]
+        },
+        {"name" : "compress-log", ...},
+        {"name" : "relocations", ...}
+      ]
+    }
+
+**wall**:
+    Wall-clock time in seconds.
+
+**cpu**:
+    User and system CPU time in seconds, both of the Hashdist process
+    itself and of any child processes waited for during the step.
+
+**maxrss_kb**:
+    Peak resident set size in kilobytes. The operating system only
+    tracks the peak over *all* waited-for children, so this is the
+    high-water mark at the end of the step, not the peak of the step
+    itself.
+
+**read_bytes**, **write_bytes**:
+    Block I/O performed during the step (as counted by ``getrusage``;
+    reads served from the page cache are not included).
+
+The :func:`find_critical_path` function is used by ``hdist
+build-report`` to find the chain of dependent builds that bounds the
+total build time of a stack.
+
+Reference
+---------
+
+"""
+
+import os
+from os.path import join as pjoin
+import time
+import json
+import errno
+import contextlib
+import resource
+
+from .common import json_formatting_options
+from .fileutils import write_protect
+
+BUILD_TIMINGS_FILENAME = 'build-timings.json'
+
+# getrusage counts block I/O in units of 512 bytes
+_BLOCK_SIZE = 512
+
+def _get_usage():
+    self_ru = resource.getrusage(resource.RUSAGE_SELF)
+    child_ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return dict(
+        wall=time.time(),
+        cpu=self_ru.ru_utime + self_ru.ru_stime + child_ru.ru_utime + child_ru.ru_stime,
+        maxrss_kb=max(self_ru.ru_maxrss, child_ru.ru_maxrss),
+        read_bytes=(self_ru.ru_inblock + child_ru.ru_inblock) * _BLOCK_SIZE,
+        write_bytes=(self_ru.ru_oublock + child_ru.ru_oublock) * _BLOCK_SIZE)
+
+
+class BuildTimings(object):
+    """
+    Records a tree of timed steps.
+
+    Steps are entered using the :meth:`step` context manager; steps
+    entered while another step is active are recorded as its children.
+    """
+    def __init__(self):
+        self.steps = []
+        self._stack = [self.steps]
+
+    @contextlib.contextmanager
+    def step(self, name, **attrs):
+        """Context manager timing the enclosed block as the step `name`
+
+        Any keyword arguments are stored in the step record as is and
+        should be JSON-serializable. If an exception is raised the step
+        is still recorded, with ``"failed": true``.
+        """
+        record = dict(attrs)
+        record['name'] = name
+        children = []
+        self._stack[-1].append(record)
+        self._stack.append(children)
+        before = _get_usage()
+        try:
+            yield record
+        except:
+            record['failed'] = True
+            raise
+        finally:
+            after = _get_usage()
+            self._stack.pop()
+            for key in ('wall', 'cpu', 'read_bytes', 'write_bytes'):
+                record[key] = after[key] - before[key]
+            record['maxrss_kb'] = after['maxrss_kb']
+            if children:
+                record['steps'] = children
+
+    def get_total_wall(self):
+        return sum(step['wall'] for step in self.steps)
+
+    def as_document(self, **attrs):
+        doc = dict(attrs)
+        doc['steps'] = self.steps
+        doc['wall'] = self.get_total_wall()
+        return doc
+
+    def save(self, filename, **attrs):
+        """Writes the recorded steps to `filename` as JSON
+
+        Any keyword arguments are added to the top-level of the document.
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.as_document(**attrs), f, **json_formatting_options)
+            f.write('\n')
+        write_protect(filename)
+
+
+class NullTimings(object):
+    """Drop-in for :class:`BuildTimings` that does not record anything
+    """
+    @contextlib.contextmanager
+    def step(self, name, **attrs):
+        yield {}
+
+null_timings = NullTimings()
+
+
+def load_build_timings(artifact_dir):
+    """Loads ``build-timings.json`` from `artifact_dir`, or returns `None`
+    if the artifact was built without timings
+    """
+    try:
+        f = open(pjoin(artifact_dir, BUILD_TIMINGS_FILENAME))
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    with f:
+        return json.load(f)
+
+def find_critical_path(durations, dependencies):
+    """Finds the chain of dependent items with the largest total duration
+
+    Parameters
+    ----------
+
+    durations : dict
+        Maps each item to its duration. Items missing from the dict
+        count as zero.
+
+    dependencies : dict
+        Maps each item to a list of items it depends on. Every item
+        to consider must be a key.
+
+    Returns
+    -------
+
+    total : float
+        Sum of the durations along the critical path
+
+    path : list
+        The items on the critical path, in the order they must be
+        built (dependencies first)
+    """
+    finish = {}
+    pred = {}
+
+    def visit(item, visiting):
+        if item in finish:
+            return finish[item]
+        if item in visiting:
+            raise ValueError('dependency graph has a cycle through %r' % item)
+        visiting.add(item)
+        best, best_dep = 0, None
+        for dep in dependencies.get(item, ()):
+            t = visit(dep, visiting)
+            if t > best:
+                best, best_dep = t, dep
+        visiting.remove(item)
+        finish[item] = best + durations.get(item, 0)
+        pred[item] = best_dep
+        return finish[item]
+
+    for item in sorted(dependencies):
+        visit(item, set())
+
+    if not finish:
+        return 0, []
+    end = max(sorted(finish), key=finish.__getitem__)
+    path = []
+    item = end
+    while item is not None:
+        path.append(item)
+        item = pred[item]
+    path.reverse()
+    return finish[end], path
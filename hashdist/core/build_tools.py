@@ -14,13 +14,21 @@ import json
 from string import Template
 from textwrap import dedent
 import re
+import stat
+import itertools
+import multiprocessing
+import py_compile
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
 from .common import json_formatting_options
 from .build_store import BuildStore
 from .profile import make_profile
-from .fileutils import rmdir_empty_up_to, write_protect
+from .fileutils import remove_files_and_empty_dirs, write_protect, write_if_changed
+from ..hdist_logging import null_logger
+from . import elf
 
-def execute_files_dsl(files, env):
+def execute_files_dsl(files, env, overwrite=False):
     """
     Executes the mini-language used in the "files" section of the build-spec.
     See :class:`.BuildWriteFiles`.
@@ -35,6 +43,11 @@ def execute_files_dsl(files, env):
 
     env : dict
         Environment to use for variable substitutation
+
+    overwrite : bool
+        Whether to overwrite existing files (files that already have the
+        right contents are left untouched); otherwise an existing file is
+        an error
     """
     def subs(x):
         return Template(x).substitute(env)
@@ -57,20 +70,32 @@ def execute_files_dsl(files, env):
             mode = 0o755
         else:
             mode = 0o644
-        fd = os.open(pjoin(dirname, basename), os.O_EXCL | os.O_CREAT | os.O_WRONLY, mode)
-        with os.fdopen(fd, 'w') as f:
-            if 'text' in file_spec:
-                text = os.linesep.join(file_spec['text'])
-                if file_spec.get('expandvars', False):
-                    text = subs(text)
+        if 'text' in file_spec:
+            text = os.linesep.join(file_spec['text'])
+            if file_spec.get('expandvars', False):
+                text = subs(text)
+        else:
+            text = json.dumps(file_spec['object'], **json_formatting_options)
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if overwrite:
+            write_if_changed(pjoin(dirname, basename), text, mode)
+        else:
+            fd = os.open(pjoin(dirname, basename), os.O_EXCL | os.O_CREAT | os.O_WRONLY, mode)
+            with os.fdopen(fd, 'w') as f:
                 f.write(text)
-            else:
-                json.dump(file_spec['object'], f, **json_formatting_options)
 
 def get_import_envvar(env):
     return env['HDIST_IMPORT'].split()
 
+def is_incremental_build(env):
+    """Whether the build environment `env` belongs to an incremental build
+    (see :class:`~hashdist.core.build_store.ArtifactBuilder`)
+    """
+    return env.get('HDIST_INCREMENTAL', '') == '1'
+
 def build_whitelist(build_store, artifact_ids, stream):
+    build_store.load_index()
     for artifact_id in artifact_ids:
         path = build_store.resolve(artifact_id)
         if path is None:
@@ -79,107 +104,282 @@ def build_whitelist(build_store, artifact_ids, stream):
         #with open(pjoin(path, 'artifact.json')) as f:
         #    doc = json.load(f)
 
-def recursive_list_files(dir):
-    result = set()
-    for root, dirs, files in os.walk(dir):
-        for fname in files:
-            result.add(pjoin(root, fname))
-    return result
-
 def push_build_profile(config, logger, virtuals, buildspec_filename, manifest_filename, target_dir):
-    files_before_profile = recursive_list_files(target_dir)
-    
     with open(buildspec_filename) as f:
         imports = json.load(f).get('build', {}).get('import', [])
     build_store = BuildStore.create_from_config(config, logger)
-    make_profile(logger, build_store, imports, target_dir, virtuals, config)
-
-    files_after_profile = recursive_list_files(target_dir)
-    installed_files = files_after_profile.difference(files_before_profile)
+    # make_profile keeps track of what it creates
+    installed_files = make_profile(logger, build_store, imports, target_dir, virtuals, config)
     with open(manifest_filename, 'w') as f:
-        json.dump({'installed-files': sorted(list(installed_files))}, f)
+        json.dump({'installed-files': sorted(installed_files)}, f)
 
 def pop_build_profile(manifest_filename, root):
     with open(manifest_filename) as f:
         installed_files = json.load(f)['installed-files']
-    for fname in installed_files:
-        os.unlink(fname)
-        rmdir_empty_up_to(os.path.dirname(fname), root)
+    remove_files_and_empty_dirs(installed_files, os.path.abspath(root))
 
 
 #
 # Tools to use on individual files for postprocessing
 #
 
-def is_executable(filename):
-    return os.stat(filename).st_mode & 0o111 != 0
+# Number of threads running postprocess handlers
+DEFAULT_POSTPROCESS_JOBS = 8
+
+# Number of leading bytes of each file available for classification
+HEAD_SIZE = 64
+
+# Kinds of files, as given by PostprocessFile.kind
+FILE = 'file'
+SYMLINK = 'symlink'
+OTHER = 'other'
+
+class PostprocessFile(object):
+    """
+    A file found while postprocessing, classified once so that the
+    handlers need not stat or open it again.
+
+    Attributes
+    ----------
+
+    filename : str
 
-def postprocess_launcher_shebangs(filename, launcher_program):
-    if not os.path.isfile(filename):
+    kind : str
+        One of ``FILE``, ``SYMLINK`` or ``OTHER`` (device files, sockets
+        etc.). Handlers that replace a file should update it.
+
+    mode : int
+        The ``st_mode`` found by ``os.lstat``.
+    """
+    def __init__(self, filename, st):
+        self.filename = filename
+        self.mode = st.st_mode
+        if stat.S_ISREG(st.st_mode):
+            self.kind = FILE
+        elif stat.S_ISLNK(st.st_mode):
+            self.kind = SYMLINK
+        else:
+            self.kind = OTHER
+        self._head = None
+
+    @property
+    def is_executable(self):
+        return self.kind == FILE and self.mode & 0o111 != 0
+
+    @property
+    def head(self):
+        """The first bytes of the file (empty unless it is a regular file);
+        read on first use
+        """
+        if self._head is None:
+            if self.kind != FILE:
+                self._head = ''
+            else:
+                with open(self.filename, 'rb') as f:
+                    self._head = f.read(HEAD_SIZE)
+        return self._head
+
+    @property
+    def is_script(self):
+        return self.is_executable and self.head[:2] == '#!'
+
+    @property
+    def is_elf(self):
+        return self.kind == FILE and self.head[:4] == '\x7fELF'
+
+def classify_file(filename):
+    return PostprocessFile(filename, os.lstat(filename))
+
+def walk_postprocess_files(path):
+    """
+    Yields a :class:`PostprocessFile` for every file (that is, everything
+    but directories) beneath `path`, or for `path` itself if it is not a
+    directory. Each entry is stat-ed once; symlinks to directories are
+    not followed.
+    """
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        yield PostprocessFile(path, st)
         return
-    if 'bin' not in filename:
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        for name in sorted(os.listdir(dirpath)):
+            filename = pjoin(dirpath, name)
+            st = os.lstat(filename)
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(filename)
+            else:
+                yield PostprocessFile(filename, st)
+
+def _run_handlers(f, handlers):
+    for handler in handlers:
+        handler(f)
+    return f
+
+def run_postprocess(path, handlers, jobs=DEFAULT_POSTPROCESS_JOBS):
+    """
+    Walks `path` once and calls each of `handlers` (in order) on every
+    file found, passing a :class:`PostprocessFile`. Different files are
+    handled concurrently by up to `jobs` threads; the work is mostly
+    waiting for the file system.
+
+    Returns the list of files found, for further passes.
+    """
+    run = partial(_run_handlers, handlers=handlers)
+    files = walk_postprocess_files(path)
+    if not handlers:
+        return list(files)
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        results = pool.imap_unordered(run, files, chunksize=16)
+    else:
+        pool = None
+        results = itertools.imap(run, files)
+    try:
+        return list(results)
+    finally:
+        # joined before returning, so that no threads are left running
+        # when compile_pyc_files forks its worker processes
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _compile_pyc(args):
+    filename, display_filename, readonly = args
+    try:
+        py_compile.compile(filename, dfile=display_filename, doraise=True)
+    except py_compile.PyCompileError, e:
+        return filename, e.msg
+    if readonly:
+        write_protect(filename + ('c' if __debug__ else 'o'))
+    return filename, None
+
+def compile_pyc_files(filenames, root, jobs=None, readonly=False, logger=null_logger):
+    """
+    Byte-compiles the given ``.py`` files using a pool of `jobs`
+    processes (default: one per CPU).
+
+    The file name stored in each compiled file is made relative to
+    `root`, rather than the absolute path in the build, so that
+    tracebacks do not refer to the location the artifact was built
+    in. Files that fail to compile (e.g., test data or code for
+    another Python version) are logged and skipped. If `readonly` is
+    set, the compiled files are write-protected.
+
+    Returns the number of files compiled.
+    """
+    tasks = [(filename, os.path.relpath(filename, root), readonly)
+             for filename in filenames]
+    if not tasks:
+        return 0
+    jobs = jobs or multiprocessing.cpu_count()
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = pool.map(_compile_pyc, tasks, chunksize=max(1, len(tasks) // (4 * jobs)))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(_compile_pyc, tasks)
+    n = 0
+    for filename, error in results:
+        if error is None:
+            n += 1
+        else:
+            logger.warning('Not compiling %s: %s' % (filename, error.strip()))
+    return n
+
+def postprocess_launcher_shebangs(f, launcher_program):
+    if not f.is_script or 'bin' not in f.filename:
         return
-    
-    if is_executable(filename):
-        with open(filename) as f:
-            is_script = (f.read(2) == '#!')
-            if is_script:
-                script_no_hashexclam = f.read()
-
-    if is_script:
-        script_filename = filename + '.real'
-        dirname = os.path.dirname(filename)
-        rel_launcher = os.path.relpath(launcher_program, dirname)
-        # Set up:
-        #   thescript      # symlink to ../../path/to/launcher
-        #   thescript.real # non-executable script with modified shebang
-        lines = script_no_hashexclam.splitlines(True) # keepends=True
-        cmd = lines[0].split()
-        interpreters = '${PROFILE_BIN_DIR}/%s:${ORIGIN}/%s' % (
-            os.path.basename(cmd[0]), os.path.relpath(cmd[0], dirname))
-        cmd[0] = interpreters
-        lines[0] = '#!%s\n' % ' '.join(cmd)
-        with open(script_filename, 'w') as f:
-            f.write(''.join(lines))
-        write_protect(script_filename)
-        os.unlink(filename)
-        os.symlink(rel_launcher, filename)
-
-def postprocess_multiline_shebang(filename):
+    filename = f.filename
+    with open(filename) as fh:
+        fh.read(2)
+        script_no_hashexclam = fh.read()
+
+    script_filename = filename + '.real'
+    dirname = os.path.dirname(filename)
+    rel_launcher = os.path.relpath(launcher_program, dirname)
+    # Set up:
+    #   thescript      # symlink to ../../path/to/launcher
+    #   thescript.real # non-executable script with modified shebang
+    lines = script_no_hashexclam.splitlines(True) # keepends=True
+    cmd = lines[0].split()
+    interpreters = '${PROFILE_BIN_DIR}/%s:${ORIGIN}/%s' % (
+        os.path.basename(cmd[0]), os.path.relpath(cmd[0], dirname))
+    cmd[0] = interpreters
+    lines[0] = '#!%s\n' % ' '.join(cmd)
+    with open(script_filename, 'w') as fh:
+        fh.write(''.join(lines))
+    write_protect(script_filename)
+    os.unlink(filename)
+    os.symlink(rel_launcher, filename)
+    f.kind = SYMLINK
+
+def postprocess_multiline_shebang(f):
     """
     Try to rewrite the shebang of scripts. This function deals with
     detecting whether the script is a shebang, and if so, rewrite it.
     """
-    if not os.path.isfile(filename) or not is_executable(filename):
+    if not f.is_script:
         return
 
-    with open(filename) as f:
-        if f.read(2) != '#!':
-            # no shebang
-            return
-
-        scriptlines = f.readlines()
+    with open(f.filename) as fh:
+        fh.read(2)
+        scriptlines = fh.readlines()
         scriptlines[0] = '#!' + scriptlines[0]
 
     try:
-        mod_scriptlines = make_relative_multiline_shebang(filename, scriptlines)
+        mod_scriptlines = make_relative_multiline_shebang(f.filename, scriptlines)
     except UnknownShebangError:
         # just leave unsupported scripts as is
         pass
     else:
         if mod_scriptlines != scriptlines:
-            with open(filename, 'w') as f:
-                f.write(''.join(mod_scriptlines))
+            with open(f.filename, 'w') as fh:
+                fh.write(''.join(mod_scriptlines))
         
 
-def postprocess_write_protect(filename):
+def postprocess_relative_rpath(f, artifacts_root, drop_unused=False, logger=null_logger):
+    """
+    Make the RPATHs of ELF executables relative to ``$ORIGIN`` where they
+    point into `artifacts_root`, optionally dropping entries not used by
+    the file. Shared libraries are left alone. See :mod:`hashdist.core.elf`.
+    """
+    if not f.is_elf:
+        return
+    def transform(value, dynamic):
+        if not elf.is_executable(dynamic):
+            return value
+        return elf.make_relative_rpath(f.filename, value, dynamic.needed, artifacts_root,
+                                       drop_unused)
+    writable = f.mode & stat.S_IWUSR
+    if not writable:
+        os.chmod(f.filename, f.mode | stat.S_IWUSR)
+    try:
+        changes = elf.rewrite_rpaths(f.filename, transform)
+    except elf.InvalidElfError, e:
+        logger.warning('Not rewriting RPATH of %s: %s' % (f.filename, e))
+    except ValueError, e:
+        logger.warning('Leaving RPATH unchanged: %s' % e)
+    else:
+        for old, new in changes:
+            logger.debug('RPATH of %s: %s -> %s' % (f.filename, old, new))
+    finally:
+        if not writable:
+            os.chmod(f.filename, f.mode)
+
+def postprocess_write_protect(f):
     """
     Write protect files. Leave directories alone because the inability
     to rm -rf is very annoying.
     """
-    if not os.path.isfile(filename):
+    if f.kind != FILE or not f.mode & 0o222:
         return
-    write_protect(filename)
+    os.chmod(f.filename, f.mode & ~0o222)
+    f.mode &= ~0o222
 
 
 #
@@ -20,8 +20,11 @@ SCHEMA = {
         },
     'builder': {
         'build-temp': ('dir', '~/.hdist/bld'),
+        'build-roots': ('str', ''),
         'artifacts': ('dir', '~/.hdist/opt'),
         'artifact-dir-pattern': ('str', '{name}/{shorthash}'),
+        'artifact-cache': ('str', ''),
+        'dedup': ('bool', 'no'),
         }
     }
 
@@ -43,6 +46,8 @@ def load_configuration_from_inifile(filename):
                     value = pjoin(base_dir, value)
             elif type == 'str':
                 pass
+            elif type == 'bool':
+                value = value.lower() in ('1', 'yes', 'true', 'on')
             else:
                 assert False
             result['%s/%s' % (section, key)] = value
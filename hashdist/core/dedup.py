@@ -0,0 +1,241 @@
+"""
+:mod:`hashdist.core.dedup` --- Sharing identical files between artifacts
+========================================================================
+
+Artifacts in a store frequently contain identical files: headers
+shared between versions of a library, license files, Python sources
+and so on. Since artifacts are immutable once built, such files can
+be hard-linked to a single inode, saving both disk space and page
+cache.
+
+The content index lives in ``.dedup-index`` in the artifact root (it
+must be on the same file system as the artifacts). It holds one hard
+link to each distinct file seen, named by a key derived from the
+contents (and the properties that hard links share)::
+
+    .dedup-index/3f/a9c1...e2-444
+    .dedup-index/deduplicated
+
+Deduplicating an artifact hashes each eligible file and looks its key
+up in the index. If the key is new, the file is linked into the index;
+otherwise the file is atomically replaced by a link to the inode in
+the index. Thus every artifact is only processed once, and the cost is
+proportional to the size of the new artifact, not of the store.
+``deduplicated`` lists the artifact directories (relative to the
+artifact root) that have been processed.
+
+Only regular, non-empty files without setuid/setgid bits are
+considered, and the files must agree on permissions (part of the key).
+Since modifying a shared inode would modify all artifacts sharing it,
+files that are still writable (builds only write-protect their files
+with ``hdist build-postprocess --write-protect``) are write-protected
+before their contents are hashed; artifacts must not be modified once
+built anyway. The modification time is part of the key of ``.py``
+files, since Python uses it to validate byte-compiled files.
+
+Entries in the index whose link count has dropped to one are no longer
+used by any artifact and are removed by :meth:`DedupIndex.prune`.
+
+Reference
+---------
+
+"""
+
+import os
+from os.path import join as pjoin
+import errno
+import stat
+import hashlib
+
+from .fileutils import silent_makedirs, atomic_write
+
+DEDUP_INDEX_DIRNAME = '.dedup-index'
+DEDUPLICATED_FILENAME = 'deduplicated'
+CHUNK_SIZE = 64 * 1024
+
+# Errors from os.link meaning the file can not be shared, but which
+# should not stop deduplication of other files
+_LINK_ERRNOS = (errno.EMLINK, errno.EXDEV, errno.EACCES, errno.EPERM)
+
+
+def is_eligible(st):
+    """Whether a file with the ``lstat`` result `st` may be deduplicated"""
+    return (stat.S_ISREG(st.st_mode) and st.st_size > 0 and
+            not st.st_mode & (stat.S_ISUID | stat.S_ISGID))
+
+def get_content_key(filename, st):
+    """Returns the key of a file in the index: the SHA-256 of its contents,
+    and its permission bits (and modification time for ``.py`` files)
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    key = '%s-%o' % (h.hexdigest(), stat.S_IMODE(st.st_mode))
+    if filename.endswith('.py'):
+        key += '-%d' % int(st.st_mtime)
+    return key
+
+
+class DedupIndex(object):
+    """
+    The content index of an artifact root (see module docstring)
+
+    Parameters
+    ----------
+
+    artifact_root : str
+        Root of the artifacts; the index is stored in ``.dedup-index``
+        within it
+
+    logger : Logger
+    """
+    def __init__(self, artifact_root, logger):
+        self.artifact_root = artifact_root
+        self.path = pjoin(artifact_root, DEDUP_INDEX_DIRNAME)
+        self.logger = logger
+
+    def _get_entry(self, key):
+        return pjoin(self.path, key[:2], key[2:])
+
+    def get_deduplicated(self):
+        """Returns the set of artifact directories already deduplicated"""
+        try:
+            f = open(pjoin(self.path, DEDUPLICATED_FILENAME))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return set()
+        with f:
+            return set(pjoin(self.artifact_root, line.rstrip('\n')) for line in f)
+
+    def _mark_deduplicated(self, artifact_dir):
+        silent_makedirs(self.path)
+        # a single short append is atomic, so concurrent builds may do this
+        with open(pjoin(self.path, DEDUPLICATED_FILENAME), 'a') as f:
+            f.write(os.path.relpath(artifact_dir, self.artifact_root) + '\n')
+
+    def dedup_file(self, filename, st):
+        """Links `filename` (with ``lstat`` result `st`) to the index
+
+        Returns
+        -------
+
+        saved : int
+            Number of bytes freed by replacing the file with a link to an
+            identical file
+        """
+        if st.st_mode & 0o222:
+            # protected before hashing, so that the contents compared are
+            # the ones that end up shared
+            os.chmod(filename, stat.S_IMODE(st.st_mode) & ~0o222)
+            st = os.lstat(filename)
+        entry = self._get_entry(get_content_key(filename, st))
+        try:
+            entry_st = os.lstat(entry)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            silent_makedirs(os.path.dirname(entry))
+            try:
+                os.link(filename, entry)
+                return 0
+            except OSError, e:
+                if e.errno in _LINK_ERRNOS:
+                    return 0
+                elif e.errno != errno.EEXIST:
+                    raise
+            # somebody else added it in the meantime
+            entry_st = os.lstat(entry)
+        if (entry_st.st_dev, entry_st.st_ino) == (st.st_dev, st.st_ino):
+            return 0
+        if entry_st.st_size != st.st_size or entry_st.st_mode != st.st_mode:
+            self.logger.warning('Ignoring modified entry %s in deduplication index' % entry)
+            return 0
+        temp = pjoin(os.path.dirname(filename), '.dedup-%d-%s' % (os.getpid(),
+                                                                 os.path.basename(filename)))
+        try:
+            os.link(entry, temp)
+        except OSError, e:
+            if e.errno in _LINK_ERRNOS:
+                return 0
+            raise
+        try:
+            os.rename(temp, filename)
+        except:
+            os.unlink(temp)
+            raise
+        return st.st_blocks * 512 if st.st_nlink == 1 else 0
+
+    def dedup_artifact(self, artifact_dir):
+        """Deduplicates all eligible files of an artifact against the index
+
+        Returns
+        -------
+
+        linked, saved : int
+            Number of files that were replaced by links, and the number
+            of bytes freed
+        """
+        linked = saved = 0
+        for dirpath, dirnames, filenames in os.walk(artifact_dir):
+            for name in filenames:
+                filename = pjoin(dirpath, name)
+                st = os.lstat(filename)
+                if not is_eligible(st):
+                    continue
+                n = self.dedup_file(filename, st)
+                if n > 0:
+                    linked += 1
+                    saved += n
+        self._mark_deduplicated(artifact_dir)
+        return linked, saved
+
+    def dedup_artifacts(self, artifact_dirs, rescan=False):
+        """Deduplicates each of `artifact_dirs` not deduplicated before
+        (or all of them, if `rescan` is set)
+
+        Returns the number of bytes freed.
+        """
+        done = set() if rescan else self.get_deduplicated()
+        todo = [d for d in artifact_dirs if d not in done]
+        total_saved = 0
+        for artifact_dir in todo:
+            linked, saved = self.dedup_artifact(artifact_dir)
+            total_saved += saved
+            self.logger.debug('%s: linked %d files, freed %d bytes' %
+                              (artifact_dir, linked, saved))
+        return total_saved
+
+    def prune(self):
+        """Removes entries no longer used by any artifact, and forgets
+        about removed artifacts
+
+        Returns the number of entries removed.
+        """
+        if not os.path.isdir(self.path):
+            return 0
+        done = self.get_deduplicated()
+        with atomic_write(pjoin(self.path, DEDUPLICATED_FILENAME)) as f:
+            for artifact_dir in sorted(done):
+                if os.path.isdir(artifact_dir):
+                    f.write(os.path.relpath(artifact_dir, self.artifact_root) + '\n')
+        removed = 0
+        for shard in sorted(os.listdir(self.path)):
+            shard_dir = pjoin(self.path, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in os.listdir(shard_dir):
+                entry = pjoin(shard_dir, name)
+                if os.lstat(entry).st_nlink == 1:
+                    os.unlink(entry)
+                    removed += 1
+            try:
+                os.rmdir(shard_dir)
+            except OSError, e:
+                if e.errno != errno.ENOTEMPTY:
+                    raise
+        return removed
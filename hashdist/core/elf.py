@@ -0,0 +1,301 @@
+"""
+:mod:`hashdist.core.elf` --- Reading and rewriting RPATHs of ELF files
+=======================================================================
+
+Binaries built against other artifacts get an absolute RPATH for each of
+them (see ``HDIST_LDFLAGS`` in :mod:`hashdist.core.run_job`). This ties
+the binaries to the location of the artifact store, and the dynamic
+loader tries every entry in turn, for every library needed, each time a
+process starts.
+
+This module reads the dynamic section of ELF files (32- and 64-bit, of
+either byte order) in pure Python, and rewrites the ``DT_RPATH`` and
+``DT_RUNPATH`` strings in place. The string table cannot grow without
+moving other parts of the file, so a new value may not be longer than
+the old one; as in :mod:`hashdist.core.relocate`, it is padded with NUL
+characters so that the size of the file and all offsets are unchanged.
+
+:func:`make_relative_rpath` computes the new value used by ``hdist
+build-postprocess --rpath=relative``: entries within the artifact store
+are made relative to ``$ORIGIN`` (the directory of the ELF file).
+
+This is only safe for executables. The loader takes ``$ORIGIN`` of an
+executable from ``/proc/self/exe``, in which symlinks are resolved, but
+that of a shared library from the path it was loaded through; so a
+library reached through the symlinks of a profile would look for its
+dependencies relative to the profile. Use :func:`is_executable` to tell
+the two apart.
+
+Entries that do not contain any of the libraries the file needs
+(``DT_NEEDED``) can optionally be dropped as well. This is not the
+default: libraries found through an RPATH (unlike a RUNPATH) search it
+for their own dependencies too, and libraries opened with ``dlopen`` by
+name are not listed at all.
+
+Reference
+---------
+
+"""
+
+import os
+from os.path import join as pjoin
+import struct
+
+ELF_MAGIC = '\x7fELF'
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+
+SHT_DYNSYM = 11
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+
+class InvalidElfError(Exception):
+    pass
+
+# (header after e_ident, program header, dynamic entry, section header),
+# without byte order
+_FORMATS = {
+    1: ('HHIIIIIHHHHHH', 'IIIIIIII', 'iI', 'IIIIIIIIII'),
+    2: ('HHIQQQIHHHHHH', 'IIQQQQQQ', 'qQ', 'IIQQQQIIQQ'),
+    }
+
+class ElfDynamic(object):
+    """
+    The dynamic section of an ELF file, as read by :func:`read_dynamic`
+
+    Attributes
+    ----------
+
+    needed : list of str
+        The ``DT_NEEDED`` entries, in order.
+
+    soname : str or None
+
+    rpaths : list of (tag, offset, value)
+        The ``DT_RPATH`` and ``DT_RUNPATH`` entries, with the file offset
+        of each string.
+
+    has_interpreter : bool
+        Whether the file has a ``PT_INTERP`` program header, i.e., can be
+        run (which is also true for some shared libraries, e.g. libc).
+    """
+    def __init__(self, needed, soname, rpaths, has_interpreter=False):
+        self.needed = needed
+        self.soname = soname
+        self.rpaths = rpaths
+        self.has_interpreter = has_interpreter
+        # set by read_dynamic, for _get_string_references
+        self._string_refs = None
+        self._symtabs = []
+
+def _read_at(f, offset, size):
+    f.seek(offset)
+    buf = f.read(size)
+    if len(buf) != size:
+        raise InvalidElfError('unexpected end of file')
+    return buf
+
+def read_dynamic(f):
+    """
+    Reads the dynamic section of the ELF file `f` (an open file object)
+
+    Only the headers, the dynamic section and the string table are read.
+    Returns `None` for ELF files without a dynamic section (e.g., static
+    executables and object files).
+    """
+    ident = _read_at(f, 0, 16)
+    if ident[:4] != ELF_MAGIC:
+        raise InvalidElfError('not an ELF file')
+    elf_class, byte_order = ord(ident[4]), ord(ident[5])
+    if elf_class not in _FORMATS or byte_order not in (1, 2):
+        raise InvalidElfError('unsupported ELF class or byte order')
+    prefix = '<' if byte_order == 1 else '>'
+    header_fmt, phdr_fmt, dyn_fmt, shdr_fmt = [prefix + fmt for fmt in _FORMATS[elf_class]]
+
+    header = struct.unpack(header_fmt, _read_at(f, 16, struct.calcsize(header_fmt)))
+    phoff, shoff, phentsize, phnum, shentsize, shnum = (header[4], header[5], header[8],
+                                                        header[9], header[10], header[11])
+    if phoff == 0 or phnum == 0:
+        return None
+    if phentsize < struct.calcsize(phdr_fmt):
+        raise InvalidElfError('invalid program header size')
+    phdrs = _read_at(f, phoff, phentsize * phnum)
+
+    loads = []
+    dynamic = None
+    has_interpreter = False
+    for i in range(phnum):
+        phdr = struct.unpack_from(phdr_fmt, phdrs, i * phentsize)
+        if elf_class == 1:
+            p_type, p_offset, p_vaddr, _, p_filesz = phdr[:5]
+        else:
+            p_type, _, p_offset, p_vaddr, _, p_filesz = phdr[:6]
+        if p_type == PT_LOAD:
+            loads.append((p_vaddr, p_offset, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+        elif p_type == PT_INTERP:
+            has_interpreter = True
+    if dynamic is None:
+        return None
+
+    entries = []
+    dyn_size = struct.calcsize(dyn_fmt)
+    buf = _read_at(f, dynamic[0], dynamic[1] - dynamic[1] % dyn_size)
+    for i in range(0, len(buf), dyn_size):
+        tag, value = struct.unpack_from(dyn_fmt, buf, i)
+        if tag == DT_NULL:
+            break
+        entries.append((tag, value))
+    tags = dict(entries)
+    if DT_STRTAB not in tags or DT_STRSZ not in tags:
+        raise InvalidElfError('dynamic section without string table')
+
+    # the string table is given by its address in memory
+    strtab_addr = tags[DT_STRTAB]
+    for vaddr, offset, filesz in loads:
+        if vaddr <= strtab_addr < vaddr + filesz:
+            strtab_offset = strtab_addr - vaddr + offset
+            break
+    else:
+        raise InvalidElfError('string table not in any loaded segment')
+    strtab = _read_at(f, strtab_offset, tags[DT_STRSZ])
+
+    def get_string(index):
+        end = strtab.find('\0', index)
+        if index >= len(strtab) or end == -1:
+            raise InvalidElfError('invalid string table index')
+        return strtab[index:end]
+
+    needed = [get_string(value) for tag, value in entries if tag == DT_NEEDED]
+    soname = get_string(tags[DT_SONAME]) if DT_SONAME in tags else None
+    rpaths = [(tag, strtab_offset + value, get_string(value))
+              for tag, value in entries if tag in (DT_RPATH, DT_RUNPATH)]
+    result = ElfDynamic(needed, soname, rpaths, has_interpreter)
+
+    # remember where other references into the string table are, in case
+    # an RPATH string is to be changed
+    result._string_refs = set(strtab_offset + value for tag, value in entries
+                              if tag in _STRING_TAGS)
+    if shoff != 0 and shentsize >= struct.calcsize(shdr_fmt):
+        shdrs = _read_at(f, shoff, shentsize * shnum)
+        for i in range(shnum):
+            shdr = struct.unpack_from(shdr_fmt, shdrs, i * shentsize)
+            sh_type, sh_offset, sh_size, sh_entsize = shdr[1], shdr[4], shdr[5], shdr[9]
+            if sh_type == SHT_DYNSYM and sh_entsize > 0:
+                result._symtabs.append((sh_offset, sh_size, sh_entsize, prefix + 'I',
+                                        strtab_offset))
+    return result
+
+# dynamic entries whose value is an offset in the string table
+_STRING_TAGS = (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH,
+                0x7ffffffd, 0x7fffffff) # DT_AUXILIARY, DT_FILTER
+
+def _get_string_references(f, dynamic):
+    """Returns the file offsets of the strings referred to by the dynamic
+    section and the dynamic symbol table
+    """
+    refs = set(dynamic._string_refs)
+    for offset, size, entsize, name_fmt, strtab_offset in dynamic._symtabs:
+        buf = _read_at(f, offset, size - size % entsize)
+        for i in range(0, len(buf), entsize):
+            refs.add(strtab_offset + struct.unpack_from(name_fmt, buf, i)[0])
+    return refs
+
+def rewrite_rpaths(filename, transform):
+    """
+    Rewrites the RPATH and RUNPATH of an ELF file in place
+
+    Parameters
+    ----------
+
+    filename : str
+
+    transform : callable
+        Called as ``transform(value, dynamic)`` for each entry, where
+        `dynamic` is the :class:`ElfDynamic` of the file; returns the new
+        value.
+
+    Returns
+    -------
+
+    changes : list of (old_value, new_value)
+        The entries that were changed.
+
+    Raises :exc:`ValueError` if a new value is longer than the old one,
+    or if the linker has shared the end of the old value with another
+    string (e.g., a symbol name); the file is then left unchanged.
+    """
+    with open(filename, 'r+b') as f:
+        dynamic = read_dynamic(f)
+        if dynamic is None:
+            return []
+        writes = []
+        for tag, offset, value in dynamic.rpaths:
+            new_value = transform(value, dynamic)
+            if new_value == value:
+                continue
+            if len(new_value) > len(value):
+                raise ValueError('new RPATH "%s" of %s is longer than "%s"' %
+                                 (new_value, filename, value))
+            writes.append((offset, value, new_value))
+        if writes:
+            refs = _get_string_references(f, dynamic)
+            for offset, value, new_value in writes:
+                if any(offset < ref < offset + len(value) for ref in refs):
+                    raise ValueError('RPATH "%s" of %s shares characters with another string' %
+                                     (value, filename))
+        for offset, value, new_value in writes:
+            f.seek(offset)
+            f.write(new_value + '\0' * (len(value) - len(new_value)))
+    return [(value, new_value) for offset, value, new_value in writes]
+
+def _expand_origin(entry, origin):
+    return entry.replace('${ORIGIN}', origin).replace('$ORIGIN', origin)
+
+def is_executable(dynamic):
+    """
+    Whether the ELF file with the :class:`ElfDynamic` `dynamic` is an
+    executable rather than a shared library
+
+    Executables have an interpreter (the dynamic loader) and, unlike
+    the shared libraries that can also be run, no ``DT_SONAME``.
+    """
+    return dynamic.has_interpreter and dynamic.soname is None
+
+def make_relative_rpath(filename, value, needed, root, drop_unused=False):
+    """
+    Returns `value` (an RPATH of the ELF file `filename`) with the
+    entries inside `root` made relative to ``$ORIGIN``, and duplicate
+    entries dropped
+
+    Only meant for executables; see the module documentation. If
+    `drop_unused` is set, entries that do not contain any of the
+    libraries in `needed` are dropped too.
+    """
+    origin = os.path.dirname(os.path.realpath(filename))
+    root = os.path.realpath(root)
+    entries = []
+    for entry in value.split(':'):
+        if entry == '':
+            continue
+        path = os.path.realpath(_expand_origin(entry, origin))
+        if drop_unused and not any(os.path.exists(pjoin(path, lib)) for lib in needed):
+            continue
+        if os.path.isabs(entry) and (path + os.sep).startswith(root + os.sep):
+            relpath = os.path.relpath(path, origin)
+            entry = '$ORIGIN' if relpath == '.' else '$ORIGIN/' + relpath
+        if entry not in entries:
+            entries.append(entry)
+    if not entries:
+        # an empty entry would mean the current directory
+        return '$ORIGIN'
+    return ':'.join(entries)
@@ -1,16 +1,34 @@
 import os
 import errno
 import shutil
-import gzip
+import tempfile
+import contextlib
+import stat
+import itertools
+import fcntl
+from multiprocessing.pool import ThreadPool
+
+# Name of the directory, in each root passed to Trash, that trees are
+# moved into before being removed
+TRASH_DIRNAME = '.trash'
 
 def silent_copy(src, dst):
+    """Like ``shutil.copy``; returns whether `dst` was created (rather
+    than overwritten)
+    """
+    created = not os.path.lexists(dst)
     try:
         shutil.copy(src, dst)
     except OSError, e:
         if e.errno != errno.EEXIST:
             raise
+        return False
+    return created
 
 def silent_relative_symlink(src, dst):
+    """Creates a relative symlink to `src` at `dst` unless `dst` exists;
+    returns whether it was created
+    """
     dstdir = os.path.dirname(dst)
     rel_src = os.path.relpath(src, dstdir)
     try:
@@ -18,13 +36,20 @@ def silent_relative_symlink(src, dst):
     except OSError, e:
         if e.errno != errno.EEXIST:
             raise
+        return False
+    return True
 
 def silent_absolute_symlink(src, dst):
+    """Creates an absolute symlink to `src` at `dst` unless `dst` exists;
+    returns whether it was created
+    """
     try:
         os.symlink(os.path.abspath(src), dst)
     except OSError, e:
         if e.errno != errno.EEXIST:
             raise
+        return False
+    return True
 
 def silent_makedirs(path):
     """like os.makedirs, but does not raise error in the event that the directory already exists"""
@@ -76,14 +101,34 @@ def rmdir_empty_up_to(path, parent):
             break
         path, child = os.path.split(path)
 
-def gzip_compress(source_filename, dest_filename):
-    chunk_size = 16 * 1024
-    with file(source_filename, 'rb') as src:
-        with gzip.open(dest_filename, 'wb') as dst:
-            while True:
-                chunk = src.read(chunk_size)
-                if not chunk: break
-                dst.write(chunk)
+def remove_files_and_empty_dirs(filenames, parent):
+    """Removes the given files (ignoring those that do not exist), and
+    then any directories that became empty, up until and excluding
+    `parent`
+
+    Directories are removed bottom-up, and each directory is only
+    attempted once no matter how many files it contained.
+    """
+    if not os.path.isabs(parent):
+        raise ValueError('only absolute paths supported')
+    by_depth = {}
+    for filename in filenames:
+        silent_unlink(filename)
+        path = os.path.dirname(filename)
+        by_depth.setdefault(path.count(os.sep), set()).add(path)
+    depth = max(by_depth) if by_depth else -1
+    while depth >= 0:
+        for path in by_depth.pop(depth, ()):
+            if not path.startswith(parent + os.sep):
+                continue
+            try:
+                os.rmdir(path)
+            except OSError, e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                    raise
+                continue
+            by_depth.setdefault(depth - 1, set()).add(os.path.dirname(path))
+        depth -= 1
 
 def atomic_symlink(source, dest):
     """Overwrites a destination symlink atomically without raising error
@@ -108,6 +153,269 @@ def atomic_symlink(source, dest):
         os.unlink(templink)
         raise
 
+@contextlib.contextmanager
+def atomic_write(filename, mode=0o644):
+    """Context manager yielding a file object whose contents replace
+    `filename` atomically once the block exits without an exception
+    (by writing to a temporary file in the same directory and renaming it)
+    """
+    fd, tempname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                    prefix='.%s-' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            yield f
+        os.chmod(tempname, mode)
+        os.rename(tempname, filename)
+    except:
+        silent_unlink(tempname)
+        raise
+
+@contextlib.contextmanager
+def file_lock(filename, on_wait=None):
+    """Context manager holding an exclusive ``flock`` on `filename`
+
+    The file is created if needed, and removed again when the lock is
+    released, so that lock files do not pile up.
+
+    Parameters
+    ----------
+
+    filename : str
+
+    on_wait : callable (optional)
+        Called (without arguments) before blocking if somebody else
+        holds the lock.
+    """
+    silent_makedirs(os.path.dirname(filename))
+    while True:
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if on_wait is not None:
+                    on_wait()
+                    on_wait = None
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # the previous holder may have removed the file after we opened
+            # it, in which case we locked a stale inode
+            try:
+                st = os.stat(filename)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                fst = os.fstat(fd)
+                if (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+                    break
+        except:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield
+    finally:
+        os.unlink(filename)
+        os.close(fd)
+
+def write_if_changed(filename, contents, mode=0o644):
+    """Writes `contents` to `filename` unless it already has exactly those
+    contents, so that the modification time of unchanged files is kept
+    (which matters to ``make``)
+
+    Returns whether the file was written.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == contents:
+                return False
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    silent_unlink(filename)
+    fd = os.open(filename, os.O_EXCL | os.O_CREAT | os.O_WRONLY, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(contents)
+    return True
+
+def get_disk_usage(path):
+    """Returns the number of bytes allocated on disk for the tree at `path`
+
+    Hard links are counted once and symlinks are not followed.
+    """
+    seen = set()
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if st.st_nlink > 1:
+                if (st.st_dev, st.st_ino) in seen:
+                    continue
+                seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+def get_free_space(path):
+    """Returns the number of bytes available to unprivileged users on the
+    file system containing `path`
+    """
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+class Trash(object):
+    """Moves trees out of the way with a single rename each
+
+    Trees are moved into a fresh directory under ``<root>/.trash``; `root`
+    must be on the same file system as the trees. The contents can then be
+    removed at leisure using :func:`empty_trash`.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.path = None
+        self.count = 0
+
+    def move(self, path):
+        """Moves `path` into the trash
+
+        Returns the new location, or `None` if `path` does not exist.
+        """
+        if self.path is None:
+            trash_dir = os.path.join(self.root, TRASH_DIRNAME)
+            silent_makedirs(trash_dir)
+            self.path = tempfile.mkdtemp(dir=trash_dir)
+        dest = os.path.join(self.path, str(self.count))
+        try:
+            os.rename(path, dest)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        self.count += 1
+        return dest
+
+def remove_tree(path):
+    """Like ``shutil.rmtree``, but returns the number of bytes freed
+
+    Each entry is only ``lstat``-ed once. Files with other hard links
+    left do not count as freed. Directories are visited using an
+    explicit stack, so that the depth of the tree is not limited by the
+    recursion limit.
+    """
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        os.unlink(path)
+        return st.st_blocks * 512 if st.st_nlink == 1 else 0
+    freed = 0
+    # (dirpath, st, emptied); a directory is pushed again to be removed
+    # once everything in it has been
+    stack = [(path, st, False)]
+    while stack:
+        dirpath, st, emptied = stack.pop()
+        if emptied:
+            os.rmdir(dirpath)
+            freed += st.st_blocks * 512
+            continue
+        stack.append((dirpath, st, True))
+        for name in os.listdir(dirpath):
+            filename = os.path.join(dirpath, name)
+            st = os.lstat(filename)
+            if stat.S_ISDIR(st.st_mode):
+                stack.append((filename, st, False))
+            else:
+                os.unlink(filename)
+                if st.st_nlink == 1:
+                    freed += st.st_blocks * 512
+    return freed
+
+def remove_trees(paths, jobs=1, progress=None):
+    """Removes the trees at `paths`, using up to `jobs` threads
+
+    Deleting is dominated by waiting for the file system (particularly
+    on network file systems), so the threads do not contend for the GIL.
+
+    Parameters
+    ----------
+
+    paths : list of str
+
+    jobs : int
+        Maximum number of trees to remove concurrently.
+
+    progress : callable (optional)
+        Called as ``progress(done, total, freed)`` each time a tree has been
+        removed, where `freed` is the number of bytes freed so far.
+
+    Returns
+    -------
+
+    freed : int
+        Number of bytes freed
+    """
+    if jobs > 1 and len(paths) > 1:
+        pool = ThreadPool(min(jobs, len(paths)))
+        results = pool.imap_unordered(remove_tree, paths)
+    else:
+        pool = None
+        results = itertools.imap(remove_tree, paths)
+    freed = 0
+    try:
+        for done, n in enumerate(results, 1):
+            freed += n
+            if progress is not None:
+                progress(done, len(paths), freed)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return freed
+
+def empty_trash(roots, jobs=1, progress=None):
+    """Removes everything moved to the trash of each of `roots` by
+    :class:`Trash`, including leftovers of interrupted earlier runs
+
+    See :func:`remove_trees` for the parameters; returns the number of bytes freed.
+    """
+    trash_dirs = [os.path.join(root, TRASH_DIRNAME) for root in roots]
+    trash_dirs = [d for d in trash_dirs if os.path.isdir(d)]
+    batches = [os.path.join(d, x) for d in trash_dirs for x in sorted(os.listdir(d))]
+    paths = [os.path.join(batch, x) for batch in batches for x in sorted(os.listdir(batch))]
+    freed = remove_trees(paths, jobs, progress)
+    for d in batches + trash_dirs:
+        try:
+            os.rmdir(d)
+        except OSError, e:
+            # ENOTEMPTY: somebody else is trashing things concurrently
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY):
+                raise
+    return freed
+
+def empty_trash_in_background(roots, jobs=1):
+    """Runs :func:`empty_trash` in a detached process and returns at once
+
+    The process is double-forked into a session of its own, so that it
+    is neither killed along with the terminal of the caller nor left
+    behind as a zombie. Its output goes to ``/dev/null``.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            if os.fork() == 0:
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                empty_trash(roots, jobs)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
 def write_protect(filename):
     mode = os.stat(filename).st_mode
     os.chmod(filename, mode & ~0o222)
@@ -0,0 +1,287 @@
+/*
+ * The Hashdist launcher; see hashdist.core.links.make_launcher and
+ * hashdist.core.build_tools.postprocess_launcher_shebangs.
+ *
+ * The launcher is invoked through a chain of symlinks ending in the
+ * launcher itself. The chain is followed (with lstat/readlink only), and
+ * the first link P in it for which one of the following files exist
+ * decides what to run:
+ *
+ *   P.link  Contains the path of a program, relative to the directory of P.
+ *           The program is run with argv[0] set to the path the launcher
+ *           was invoked as, so that it looks for its files relative to
+ *           the profile rather than the artifact it lives in.
+ *
+ *   P.real  A script, starting with a shebang line of the form
+ *
+ *             #!${PROFILE_BIN_DIR}/python:${ORIGIN}/../../python/bin/python [arg]
+ *
+ *           The first of the ':'-separated interpreters that exists is run
+ *           on the script. ${ORIGIN} is the (physical) directory of P, and
+ *           ${PROFILE_BIN_DIR} the "bin" directory of the profile the
+ *           launcher was invoked from: for each link in the chain, the
+ *           directories from the link up to the root are searched for
+ *           "profile.json".
+ *
+ * The profile search is cached: if the (physical) directory of the first
+ * link is the "bin" directory of a profile (marked by "is-profile-bin")
+ * and has a file "launcher.cache", that file holds the profile found for
+ * links in that directory. It is only written when the profile was found
+ * from the first link itself, is only used while the profile still
+ * exists, and is never created by the launcher, only rewritten. Files in
+ * artifacts are thus never touched.
+ */
+#define _XOPEN_SOURCE 700
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <sys/types.h>
+#include <unistd.h>
+
+#define MAX_LINKS 40
+#define MAX_INTERPRETER_ARGS 1
+#define CACHE_FILENAME "launcher.cache"
+#define PROFILE_BIN_MARKER "is-profile-bin"
+
+static const char *program_name = "launcher";
+
+static void fail(const char *msg, const char *arg)
+{
+    fprintf(stderr, "%s: %s%s%s\n", program_name, msg, arg ? ": " : "", arg ? arg : "");
+    exit(127);
+}
+
+static int exists(const char *path)
+{
+    struct stat st;
+    return stat(path, &st) == 0;
+}
+
+/* dst = dirname(path) */
+static void get_dirname(const char *path, char *dst)
+{
+    const char *slash = strrchr(path, '/');
+    if (slash == NULL) {
+        strcpy(dst, ".");
+    } else if (slash == path) {
+        strcpy(dst, "/");
+    } else {
+        memcpy(dst, path, slash - path);
+        dst[slash - path] = '\0';
+    }
+}
+
+static int join(char *dst, const char *a, const char *b)
+{
+    int n = snprintf(dst, PATH_MAX, "%s/%s", a, b);
+    return n > 0 && n < PATH_MAX;
+}
+
+/* Finds the program we were invoked as; like the shell, searches PATH
+   if argv[0] contains no slash */
+static void find_self(const char *argv0, char *dst)
+{
+    const char *path, *p, *end;
+    char dir[PATH_MAX];
+    if (strchr(argv0, '/') != NULL) {
+        if (strlen(argv0) >= PATH_MAX) fail("path too long", argv0);
+        strcpy(dst, argv0);
+        return;
+    }
+    path = getenv("PATH");
+    for (p = path; p != NULL && *p != '\0'; p = end) {
+        end = strchr(p, ':');
+        if (end == NULL) end = p + strlen(p);
+        if ((size_t)(end - p) < sizeof(dir)) {
+            memcpy(dir, end == p ? "." : p, end == p ? 1 : end - p);
+            dir[end == p ? 1 : end - p] = '\0';
+            if (join(dst, dir, argv0) && access(dst, X_OK) == 0) return;
+        }
+        if (*end == ':') end++;
+    }
+    fail("cannot find myself in PATH", argv0);
+}
+
+/* Reads the first line of a file (without the newline) */
+static int read_first_line(const char *filename, char *dst, size_t size)
+{
+    ssize_t n;
+    char *newline;
+    int fd = open(filename, O_RDONLY);
+    if (fd == -1) return 0;
+    n = read(fd, dst, size - 1);
+    close(fd);
+    if (n < 0) return 0;
+    dst[n] = '\0';
+    newline = strchr(dst, '\n');
+    if (newline != NULL) *newline = '\0';
+    return 1;
+}
+
+static int find_profile_from(const char *dir, char *profile)
+{
+    char d[PATH_MAX], marker[PATH_MAX];
+    if (realpath(dir, d) == NULL) return 0;
+    while (1) {
+        if (join(marker, strcmp(d, "/") == 0 ? "" : d, "profile.json") && exists(marker)) {
+            strcpy(profile, d);
+            return 1;
+        }
+        if (strcmp(d, "/") == 0) return 0;
+        get_dirname(d, marker);
+        strcpy(d, marker);
+    }
+}
+
+static int read_cache(const char *cache_filename, char *profile)
+{
+    char marker[PATH_MAX];
+    if (!read_first_line(cache_filename, profile, PATH_MAX) || profile[0] != '/')
+        return 0;
+    return join(marker, profile, "profile.json") && exists(marker);
+}
+
+static void write_cache(const char *cache_dir, const char *cache_filename, const char *profile)
+{
+    char tmp[PATH_MAX];
+    int fd, ok;
+    size_t len = strlen(profile);
+    if (snprintf(tmp, sizeof(tmp), "%s/.%s.%ld", cache_dir, CACHE_FILENAME,
+                 (long)getpid()) >= (int)sizeof(tmp))
+        return;
+    fd = open(tmp, O_WRONLY | O_CREAT | O_EXCL, 0644);
+    if (fd == -1) return;
+    ok = write(fd, profile, len) == (ssize_t)len && write(fd, "\n", 1) == 1;
+    ok = close(fd) == 0 && ok;
+    if (!ok || rename(tmp, cache_filename) != 0) unlink(tmp);
+}
+
+int main(int argc, char **argv)
+{
+    char self[PATH_MAX];
+    char links[MAX_LINKS + 1][PATH_MAX];
+    char buf[PATH_MAX], dir[PATH_MAX], target[PATH_MAX];
+    char cache_dir[PATH_MAX], cache_filename[PATH_MAX], marker[PATH_MAX];
+    char profile[PATH_MAX], origin[PATH_MAX], interpreter[PATH_MAX];
+    char line[2 * PATH_MAX];
+    char *spec, *arg, *candidate, *next;
+    char **new_argv;
+    int nlinks = 0, i, j, have_profile = 0, use_cache = 0;
+    ssize_t n;
+    struct stat st;
+
+    if (argc < 1) fail("no argv[0]", NULL);
+    program_name = argv[0];
+    find_self(argv[0], self);
+
+    /* follow the chain of links */
+    strcpy(links[0], self);
+    while (1) {
+        const char *p = links[nlinks];
+        char *sidecar = buf;
+
+        if (snprintf(sidecar, PATH_MAX, "%s.link", p) < PATH_MAX && exists(sidecar)) {
+            if (!read_first_line(sidecar, line, sizeof(line))) fail("cannot read", sidecar);
+            get_dirname(p, dir);
+            if (line[0] == '/') {
+                strcpy(target, line);
+            } else if (!join(target, dir, line)) {
+                fail("path too long", line);
+            }
+            argv[0] = self;
+            execv(target, argv);
+            fail("cannot execute", target);
+        }
+
+        if (snprintf(sidecar, PATH_MAX, "%s.real", p) < PATH_MAX && exists(sidecar)) {
+            break;
+        }
+
+        if (lstat(p, &st) != 0) fail("cannot stat", p);
+        if (!S_ISLNK(st.st_mode) || nlinks == MAX_LINKS)
+            fail("no .link or .real file found for", self);
+        n = readlink(p, buf, sizeof(buf) - 1);
+        if (n < 0) fail("cannot read link", p);
+        buf[n] = '\0';
+        if (buf[0] == '/') {
+            strcpy(links[nlinks + 1], buf);
+        } else {
+            get_dirname(p, dir);
+            if (!join(links[nlinks + 1], dir, buf)) fail("path too long", buf);
+        }
+        nlinks++;
+    }
+
+    /* a script: links[nlinks] + ".real" */
+    get_dirname(links[nlinks], dir);
+    if (realpath(dir, origin) == NULL) fail("cannot resolve", dir);
+    if (snprintf(buf, PATH_MAX, "%s.real", links[nlinks]) >= PATH_MAX)
+        fail("path too long", links[nlinks]);
+    if (!read_first_line(buf, line, sizeof(line)) || strncmp(line, "#!", 2) != 0)
+        fail("no shebang in", buf);
+
+    /* in shebangs the remainder is a single argument */
+    spec = line + 2;
+    while (*spec == ' ' || *spec == '\t') spec++;
+    arg = spec + strcspn(spec, " \t");
+    if (*arg != '\0') {
+        *arg++ = '\0';
+        while (*arg == ' ' || *arg == '\t') arg++;
+        n = strlen(arg);
+        while (n > 0 && (arg[n - 1] == ' ' || arg[n - 1] == '\t' || arg[n - 1] == '\r'))
+            arg[--n] = '\0';
+    }
+
+    if (strstr(spec, "${PROFILE_BIN_DIR}") != NULL) {
+        get_dirname(links[0], dir);
+        if (realpath(dir, cache_dir) != NULL && join(marker, cache_dir, PROFILE_BIN_MARKER)
+            && exists(marker) && join(cache_filename, cache_dir, CACHE_FILENAME)
+            && exists(cache_filename)) {
+            use_cache = 1;
+            have_profile = read_cache(cache_filename, profile);
+        }
+        for (i = 0; !have_profile && i <= nlinks; i++) {
+            get_dirname(links[i], dir);
+            have_profile = find_profile_from(dir, profile);
+            /* a profile found from a later link only holds for this chain */
+            if (have_profile && use_cache && i == 0)
+                write_cache(cache_dir, cache_filename, profile);
+        }
+    }
+
+    for (candidate = spec; candidate != NULL; candidate = next) {
+        const char *rest, *base;
+        next = strchr(candidate, ':');
+        if (next != NULL) *next++ = '\0';
+        if (strncmp(candidate, "${PROFILE_BIN_DIR}", 18) == 0) {
+            if (!have_profile) continue;
+            base = profile;
+            rest = candidate + 18;
+            if (snprintf(interpreter, PATH_MAX, "%s/bin%s", base, rest) >= PATH_MAX) continue;
+        } else if (strncmp(candidate, "${ORIGIN}", 9) == 0) {
+            rest = candidate + 9;
+            if (snprintf(interpreter, PATH_MAX, "%s%s", origin, rest) >= PATH_MAX) continue;
+        } else {
+            if (strlen(candidate) >= PATH_MAX) continue;
+            strcpy(interpreter, candidate);
+        }
+        if (access(interpreter, X_OK) != 0) continue;
+
+        new_argv = malloc((argc + 2 + MAX_INTERPRETER_ARGS) * sizeof(char *));
+        if (new_argv == NULL) fail("out of memory", NULL);
+        j = 0;
+        new_argv[j++] = interpreter;
+        if (*arg != '\0') new_argv[j++] = arg;
+        new_argv[j++] = buf; /* the .real script */
+        for (i = 1; i < argc; i++) new_argv[j++] = argv[i];
+        new_argv[j] = NULL;
+        execv(interpreter, new_argv);
+        fail("cannot execute", interpreter);
+    }
+    fail("no interpreter found for", self);
+    return 127;
+}
@@ -39,7 +39,10 @@ happens.
   * *absolute_symlink* creates absolute symlinks
   * *relative_symlink* creates relative symlinks
   * *copy* copies contents and mode (``shutil.copy``)
-  * *exclude* makes sure matching files are not considered in rules below
+  * *exclude* makes sure matching files are not considered in rules below.
+    The patterns are matched against paths while globbing the rules
+    below, rather than globbed themselves; a pattern ending in ``/**``
+    excludes everything beneath a directory, which is then not walked
   * *launcher*, see :func:`make_launcher`
 
 **select**, **prefix**:
@@ -69,26 +72,113 @@ happens.
 **overwrite**:
   If present and `True`, overwrite target.
 
+Link plan cache
+---------------
+
+Turning the rules into actions requires globbing the file system,
+which for large trees (or thousands of explicit paths, as with host
+packages) costs more than creating the links. If a cache is passed to
+:func:`execute_links_dsl`, the resulting actions are stored in it,
+keyed by the rules, the current directory and the values of the
+variables used by the rules. Together with the plan, the inode number,
+modification time and status change time of every directory listed
+while globbing is stored; a later run with the same key replays the
+plan without globbing if none of these directories have changed (any
+file being added, removed or renamed in a directory updates its
+times). The status change time can not be set by users, so that
+directories whose modification time was reset (e.g., by ``tar`` or
+``rsync``) are not mistaken for unchanged ones.
+
+A plan is not stored if any of the directories changed very recently,
+since a change within the resolution of the file system timestamps
+could then go unnoticed.
+
+Reference
+---------
+
 
 """
 
-import sys
 import os
 from os.path import join as pjoin
 import shutil
 import errno
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+import time
+import itertools
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from string import Template
 
 from .fileutils import (silent_makedirs, silent_unlink, silent_relative_symlink,
                         silent_absolute_symlink, silent_copy)
-from ..hdist_logging import null_logger
+from .cache import null_cache
+from ..hdist_logging import null_logger, DEBUG
+
+from .ant_glob import ant_iglob_many, PathMatcher
+
+
+# DiskCache domain of link plans, see module docstring
+LINK_PLANS_DOMAIN = 'hashdist.core.links.plans'
+
+# Plans are not stored if a listed directory changed less than this
+# many seconds ago
+RACY_INTERVAL = 2
+
+# Number of directories populated concurrently by execute_links_dsl
+DEFAULT_LINK_JOBS = 8
+
+# Number of failed actions listed in the log
+MAX_REPORTED_FAILURES = 10
 
-from .ant_glob import ant_iglob
+# Source of the launcher program, see compile_launcher
+LAUNCHER_SOURCE = pjoin(os.path.dirname(os.path.abspath(__file__)), 'launcher.c')
 
+# Compilers tried if $CC is not set
+FALLBACK_COMPILERS = ['/usr/bin/cc', '/usr/bin/gcc', '/usr/bin/clang']
 
 def expandtemplate(s, env):
     return Template(s).substitute(env)
 
+def compile_launcher(target, cc=None):
+    """Compiles the launcher (``launcher.c``, next to this module) to `target`
+
+    The compiler is `cc`, ``$CC`` or the first one of
+    :data:`FALLBACK_COMPILERS` found. The result is put in place
+    atomically.
+
+    This is meant for the build of the launcher artifact. Since the
+    result depends on the compiler found, which is not part of any
+    artifact hash, it is never called implicitly: the ``launcher``
+    action and ``hdist build-postprocess --shebang=launcher`` require
+    the launcher artifact.
+    """
+    candidates = [cc or os.environ.get('CC')] + FALLBACK_COMPILERS
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        compiler = candidate if os.path.isabs(candidate) else find_executable(candidate)
+        if compiler is not None and os.path.exists(compiler):
+            break
+    else:
+        raise OSError(errno.ENOENT, 'No C compiler found to build the launcher '
+                      '(tried %s)' % ', '.join(c for c in candidates if c))
+    fd, tmp = tempfile.mkstemp(prefix='.launcher-', dir=os.path.dirname(target) or '.')
+    os.close(fd)
+    try:
+        p = subprocess.Popen([compiler, '-O2', '-o', tmp, LAUNCHER_SOURCE],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out, _ = p.communicate()
+        if p.wait() != 0:
+            raise OSError(errno.EINVAL, 'Compiling the launcher failed: %s' % out.strip())
+        os.chmod(tmp, 0o755)
+        os.rename(tmp, target)
+    except:
+        silent_unlink(tmp)
+        raise
+
 def make_launcher(src, dst, launcher_program):
     """
     The 'launcher' action. This is a general tool for processing
@@ -105,6 +195,8 @@ def make_launcher(src, dst, launcher_program):
 
     other (incl. scripts):
         Symlink relatively to it.
+
+    Returns the list of paths created.
     """
     dstdir = os.path.dirname(dst)
 
@@ -122,13 +214,17 @@ def make_launcher(src, dst, launcher_program):
         if launcher_program is None or not os.path.exists(launcher_program):
             raise TypeError('Did not provide path to "launcher" program')
         dst_launcher = pjoin(dstdir, 'launcher')
+        created = []
         if not os.path.exists(dst_launcher):
             shutil.copy(launcher_program, dst_launcher)
+            created.append(dst_launcher)
         with open(dst + '.link', 'w') as f:
             f.write(os.path.relpath(src, dstdir))
         os.symlink('launcher', dst)
+        return created + [dst + '.link', dst]
     else:
         os.symlink(os.path.relpath(src, dstdir), dst)
+    return [dst]
         
 
 _ACTIONS = {'symlink': silent_absolute_symlink,
@@ -150,55 +246,64 @@ def _put_actions(makedirs_cache, action_name, overwrite, source, dest, actions):
         raise ValueError('Unknown action: %s' % action_name)
 
     
-def _glob_actions(rule, excluded, makedirs_cache, env, actions):
+def _in_cwd(path, cwd):
+    """Makes a relative `path` (from a rule) relative to `cwd` instead of
+    the current directory"""
+    return pjoin(cwd, path) if cwd else path
+
+def _glob_actions(rule, excluded, makedirs_cache, env, actions, listed_dirs=None,
+                  listings=None, cwd=''):
     select = rule['select']
     if not isinstance(select, (list, tuple)):
         select = [select]
-    selected = set()
-    for pattern in select:
-        pattern = expandtemplate(pattern, env)
-        selected.update(ant_iglob(pattern, '', include_dirs=rule.get('dirs', False)))
-    selected.difference_update(excluded)
+    select = [_in_cwd(expandtemplate(pattern, env), cwd) for pattern in select]
+    action_name = rule['action']
+    if action_name == 'exclude':
+        # evaluated while globbing for the rules below
+        for pattern in select:
+            excluded.add(pattern, include_dirs=rule.get('dirs', False))
+        return
+    selected = list(ant_iglob_many(select, '', include_dirs=rule.get('dirs', False),
+                                   listed_dirs=listed_dirs, listings=listings,
+                                   exclude=excluded))
     if len(selected) == 0:
         return
-    selected = list(selected)
     selected.sort() # easier on the unit tests...
 
-    action_name = rule['action']
-    if action_name == 'exclude':
-        excluded.update(selected)
-    else:
-        if 'prefix' not in rule:
-            raise ValueError('When using select one must also supply prefix')
-        target_prefix = expandtemplate(rule['target'], env)
-        prefix = expandtemplate(rule['prefix'], env)
-        if prefix != '' and not prefix.endswith(os.path.sep):
-            prefix += os.path.sep
-
-        for p in selected:
-            if not p.startswith(prefix):
-                raise ValueError('%s does not start with %s' % (p, prefix))
-            remainder = p[len(prefix):]
-            target = pjoin(target_prefix, remainder)
-            _put_actions(makedirs_cache, action_name, rule.get('overwrite', False),
-                         p, target, actions)
-
-def _single_action(rule, excluded, makedirs_cache, env, actions):
-    source = expandtemplate(rule['source'], env)
-    if source in excluded:
-        return
+    if 'prefix' not in rule:
+        raise ValueError('When using select one must also supply prefix')
+    target_prefix = _in_cwd(expandtemplate(rule['target'], env), cwd)
+    prefix = _in_cwd(expandtemplate(rule['prefix'], env), cwd)
+    if prefix != '' and not prefix.endswith(os.path.sep):
+        prefix += os.path.sep
+
+    for p in selected:
+        if not p.startswith(prefix):
+            raise ValueError('%s does not start with %s' % (p, prefix))
+        remainder = p[len(prefix):]
+        target = pjoin(target_prefix, remainder)
+        _put_actions(makedirs_cache, action_name, rule.get('overwrite', False),
+                     p, target, actions)
+
+def _single_action(rule, excluded, makedirs_cache, env, actions, listed_dirs=None, cwd=''):
+    source = _in_cwd(expandtemplate(rule['source'], env), cwd)
+    if excluded:
+        if listed_dirs is not None:
+            listed_dirs.add(os.path.dirname(source) or '.')
+        if excluded.match(source, os.path.isdir(source)):
+            return
     if rule['action'] == 'exclude':
-        excluded.add(source)
+        excluded.add_path(source)
     else:
-        target = expandtemplate(rule['target'], env)
+        target = _in_cwd(expandtemplate(rule['target'], env), cwd)
         _put_actions(makedirs_cache, rule['action'], rule.get('overwrite', False),
                      source, target, actions)
 
-def dry_run_links_dsl(rules, env={}):
+def dry_run_links_dsl(rules, env={}, listed_dirs=None, cwd=''):
     """Turns a DSL for creating links/copying files into a list of actions to be taken.
 
     This takes into account filesystem contents and current directory
-    at the time of call.
+    (or `cwd`) at the time of call.
 
     See :func:`execute_links_dsl` for information on the DSL.
 
@@ -211,6 +316,15 @@ def dry_run_links_dsl(rules, env={}):
     env : dict
         Environment to use for variable substitution
 
+    listed_dirs : set (optional)
+        If given, the directories the result of globbing depends on are
+        added to it
+
+    cwd : str (optional)
+        Directory that relative paths in `rules` are relative to, instead
+        of the current directory; the paths in the actions are then
+        relative to it as well (absolute if `cwd` is)
+
     Returns
     -------
 
@@ -221,22 +335,225 @@ def dry_run_links_dsl(rules, env={}):
     """
     assert os.path.sep == '/'
     actions = []
-    excluded = set()
+    excluded = PathMatcher()
     makedirs_cache = set()
+    # directory listings are shared between the rules
+    listings = {}
     for rule in rules:
         if 'select' in rule:
-            _glob_actions(rule, excluded, makedirs_cache, env, actions)
+            _glob_actions(rule, excluded, makedirs_cache, env, actions, listed_dirs,
+                          listings, cwd)
         else:
-            _single_action(rule, excluded, makedirs_cache, env, actions)
+            _single_action(rule, excluded, makedirs_cache, env, actions, listed_dirs, cwd)
     
     return actions
 
 
-def execute_links_dsl(rules, env={}, launcher_program=None, logger=null_logger):
+_PLAN_FUNCTIONS = dict((func.__name__, func) for func in
+                       [silent_makedirs, silent_unlink] + _ACTIONS.values())
+
+def serialize_links_plan(actions, target_dir=None):
+    """Converts a plan (see :func:`dry_run_links_dsl`) to a list that can be
+    stored as JSON
+
+    If `target_dir` is given, the path each action creates (the last
+    element) is stored relative to it.
+    """
+    result = []
+    for action in actions:
+        args = list(action[1:])
+        if target_dir is not None:
+            if args[-1].startswith(target_dir + os.sep):
+                args[-1] = args[-1][len(target_dir) + 1:]
+            else:
+                args[-1] = os.path.relpath(args[-1], target_dir)
+        result.append([action[0].__name__] + args)
+    return result
+
+def deserialize_links_plan(serialized_actions, target_dir=None):
+    """Inverse of :func:`serialize_links_plan`"""
+    result = []
+    for action in serialized_actions:
+        args = list(action[1:])
+        if target_dir is not None:
+            args[-1] = os.path.join(target_dir, args[-1])
+        result.append((_PLAN_FUNCTIONS[action[0]],) + tuple(args))
+    return result
+
+def _get_referenced_vars(obj, result):
+    if isinstance(obj, basestring):
+        for m in Template.pattern.finditer(obj):
+            name = m.group('named') or m.group('braced')
+            if name is not None:
+                result.add(name)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            _get_referenced_vars(value, result)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            _get_referenced_vars(value, result)
+    return result
+
+def _get_plan_key(rules, env):
+    names = _get_referenced_vars(rules, set())
+    return (rules, os.getcwd(), dict((name, env[name]) for name in names if name in env))
+
+def _get_dir_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+    return (st.st_ino, st.st_mtime, st.st_ctime)
+
+def get_links_plan(rules, env={}, cache=null_cache):
+    """Like :func:`dry_run_links_dsl`, but reuses a plan stored in `cache`
+    when the globbed directories have not changed (see module docstring)
+    """
+    key = _get_plan_key(rules, env)
+    plan = cache.get(LINK_PLANS_DOMAIN, key, None)
+    if plan is not None:
+        dir_stamps, serialized_actions = plan
+        if all(_get_dir_stamp(path) == stamp for path, stamp in dir_stamps):
+            return deserialize_links_plan(serialized_actions)
+
+    listed_dirs = set()
+    actions = dry_run_links_dsl(rules, env, listed_dirs)
+    now = time.time()
+    dir_stamps = dict((path, _get_dir_stamp(path)) for path in listed_dirs)
+    if all(stamp is not None and stamp[2] < now - RACY_INTERVAL
+           for stamp in dir_stamps.values()):
+        cache.put(LINK_PLANS_DOMAIN, key, (sorted(dir_stamps.items()),
+                                           serialize_links_plan(actions)))
+    return actions
+
+def _format_action(action):
+    return "%s%r" % (action[0].__name__, action[1:])
+
+def _group_actions(actions):
+    """Splits `actions` into lists of actions that may run concurrently
+
+    Actions are grouped by the directory they create entries in; each
+    group starts with the ``silent_makedirs`` of its directory (if any).
+    If some action creates an entry which is itself one of the target
+    directories (or a parent of one), e.g. a symlink to a directory
+    that other files are created in, all actions are kept in a single
+    group, as order then matters across directories.
+    """
+    groups = {}
+    order = []
+    for action in actions:
+        if action[0] is silent_makedirs:
+            key = action[1]
+        else:
+            key = os.path.dirname(action[-1])
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = []
+            order.append(key)
+        group.append(action)
+
+    dirs = set()
+    for d in order:
+        while d and d not in dirs:
+            dirs.add(d)
+            d = os.path.dirname(d)
+            if d == '/':
+                break
+    for action in actions:
+        if action[0] is not silent_makedirs and action[-1] in dirs:
+            return [actions] if actions else []
+    return [groups[key] for key in order]
+
+def _run_action_group(actions, launcher_program, log_debug):
+    """Runs `actions` in order, stopping at the first failure
+
+    Returns the debug messages (or `None`), the failed action and
+    its error (or `None`), and the paths created.
+    """
+    lines = [] if log_debug else None
+    created = []
+    for action in actions:
+        try:
+            if action[0] is make_launcher:
+                created.extend(make_launcher(*action[1:], launcher_program=launcher_program))
+            else:
+                # the silent_* actions return False for paths that
+                # already existed, which must not be claimed
+                result = action[0](*action[1:])
+                if action[0] not in (silent_makedirs, silent_unlink) and result is not False:
+                    created.append(action[-1])
+        except EnvironmentError, e:
+            return lines, (action, e), created
+        if log_debug:
+            lines.append(_format_action(action))
+    return lines, None, created
+
+def merge_links_plans(plans):
+    """Merges the plans (lists of actions, see :func:`dry_run_links_dsl`)
+    of several sets of rules into one
+
+    The result is the same as executing the plans one after another
+    into the same target, but conflicts are resolved up front: the
+    first plan to create a path wins, unless a later plan overwrites
+    it (the ``overwrite`` flag), in which case the later one wins.
+    Only the winning action for each path is kept.
+
+    Returns
+    -------
+
+    actions : list
+        The merged plan
+
+    conflicts : list of (path, kept_source, dropped_source)
+    """
+    winners = {}
+    order = []
+    conflicts = []
+    for plan in plans:
+        pending_unlinks = set()
+        for action in plan:
+            if action[0] is silent_makedirs:
+                continue
+            elif action[0] is silent_unlink:
+                pending_unlinks.add(action[1])
+                continue
+            dest = action[-1]
+            overwrite = dest in pending_unlinks
+            pending_unlinks.discard(dest)
+            previous = winners.get(dest)
+            if previous is None:
+                order.append(dest)
+            elif overwrite:
+                conflicts.append((dest, action[1], previous[1][1]))
+            else:
+                conflicts.append((dest, previous[1][1], action[1]))
+                continue
+            winners[dest] = (overwrite, action)
+
+    actions = []
+    makedirs_cache = set()
+    for dest in order:
+        overwrite, action = winners[dest]
+        path = os.path.dirname(dest)
+        if path != '' and path not in makedirs_cache:
+            actions.append((silent_makedirs, path))
+            makedirs_cache.add(path)
+        if overwrite:
+            actions.append((silent_unlink, dest))
+        actions.append(action)
+    return actions, conflicts
+
+def execute_links_dsl(rules, env={}, launcher_program=None, logger=null_logger,
+                      cache=null_cache, jobs=DEFAULT_LINK_JOBS):
     """Executes the links DSL for linking/copying files
     
     The input is a set of rules which will be applied in order. The
     rules are documented above.
+
+    The actions are carried out by :func:`execute_links_plan`, and
+    the paths created are returned.
     
     Parameters
     ----------
@@ -248,25 +565,74 @@ def execute_links_dsl(rules, env={}, launcher_program=None, logger=null_logger):
         Environment to use for variable substitution.
 
     launcher_program : str or None
-        If the 'launcher' action is used, the path to the launcher executable
-        must be provided.
+        If the 'launcher' action is used, the path to the launcher executable;
+        if `None`, it is compiled (see :func:`make_launcher`).
 
     logger : Logger
 
+    cache : DiskCache (optional)
+        Cache for link plans, see module docstring.
+
+    jobs : int (optional)
+        Maximum number of directories to populate concurrently.
+
     """
-    actions = dry_run_links_dsl(rules, env)
-    for action in actions:
-        action_desc = "%s%r" % (action[0].__name__, action[1:])
-        try:
-            if action[0] is make_launcher:
-                make_launcher(*action[1:], launcher_program=launcher_program)
-            else:
-                action[0](*action[1:])
-            logger.debug(action_desc)
-        except OSError, e:
-            # improve error message to include operation attempted
-            msg = str(e) + " in " + action_desc
-            logger.error(msg)
-            exc_type, exc_val, exc_tb = sys.exc_info()
-            raise OSError, OSError(e.errno, msg), exc_tb
+    actions = get_links_plan(rules, env, cache)
+    return execute_links_plan(actions, launcher_program, logger, jobs)
 
+def execute_links_plan(actions, launcher_program=None, logger=null_logger,
+                       jobs=DEFAULT_LINK_JOBS):
+    """Carries out actions as returned by :func:`dry_run_links_dsl`
+
+    The actions are grouped by target directory; each directory is
+    created once and then populated by one of up to `jobs` threads.
+    On network file systems every operation waits for a round-trip to
+    the server, so this is much faster than running them one by one.
+    If some actions fail, the actions for other directories are still
+    carried out, and a single :exc:`OSError` summarizing the failures is
+    raised at the end.
+
+    See :func:`execute_links_dsl` for the parameters.
+
+    Returns
+    -------
+
+    created : list of str
+        The paths created, so that callers can keep track of what they
+        installed without listing the target directories afterwards.
+        Directories made along the way are not included.
+    """
+    groups = _group_actions(actions)
+    run = partial(_run_action_group, launcher_program=launcher_program,
+                  log_debug=logger.is_enabled_for(DEBUG))
+    if jobs > 1 and len(groups) > 1:
+        pool = ThreadPool(min(jobs, len(groups)))
+        results = pool.imap(run, groups)
+    else:
+        pool = None
+        results = itertools.imap(run, groups)
+    failures = []
+    created = []
+    try:
+        for lines, failure, group_created in results:
+            if lines:
+                logger.log_lines(DEBUG, lines)
+            if failure is not None:
+                failures.append(failure)
+            created.extend(group_created)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if failures:
+        for action, e in failures[:MAX_REPORTED_FAILURES]:
+            logger.error('%s in %s' % (e, _format_action(action)))
+        if len(failures) > MAX_REPORTED_FAILURES:
+            logger.error('...and %d more failures' % (len(failures) - MAX_REPORTED_FAILURES))
+        action, e = failures[0]
+        msg = '%s in %s' % (e, _format_action(action))
+        if len(failures) > 1:
+            msg += ' (and %d more failures)' % (len(failures) - 1)
+        raise OSError(e.errno, msg)
+    return created
@@ -43,20 +43,73 @@ Example::
     Data that can be parsed by the commands (by opening ``install.json``
     and parsing it).
 
+Merged link plans
+-----------------
+
+Most artifacts are installed by a single ``hdist create-links`` command
+(see :mod:`hashdist.core.links`). Rather than running a job for each of
+them, :func:`make_profile` reads their link rules directly and merges
+the actions of all of them into one plan, which is carried out in one
+batched pass (see :func:`~hashdist.core.links.merge_links_plans`).
+Conflicts are resolved explicitly by the order of the artifacts: the
+artifact that comes first wins, unless a later one uses the
+``overwrite`` flag. Artifacts with other install commands run their
+job as before, at their place in the order, so the result is the same
+as installing the artifacts one by one.
+
+Besides ``profile.json``, the profile gets an ownership manifest,
+``profile-manifest.json``, which lists the link actions planned for
+each artifact (``null`` for artifacts installed by other commands).
+
+Updating profiles
+-----------------
+
+Profiles built as artifacts are immutable, so a new one is made whenever
+one of its artifacts changes. For profiles kept outside of the build
+store, :func:`update_profile` instead updates the profile in place:
+the profile path is a symlink to one of two generation directories,
+``<profile>.0`` and ``<profile>.1``. An update brings the inactive
+generation up to date and then switches the symlink to it with
+:func:`~hashdist.core.fileutils.atomic_symlink`, so that users of the
+profile never see a half-finished profile.
+
+The manifest of the inactive generation tells which links it
+contains and which artifact owns them. Since artifacts are immutable,
+the plans of artifacts staying in the profile are taken from the
+manifest; only new artifacts are globbed. The old and new plans are
+merged as described above, and only the paths where the winning action
+changed are removed (followed by any directories that became empty)
+and re-created. Updating one package in a big profile therefore only
+touches the files of that package (and those of the package in the
+generation before). If the inactive generation does not exist yet, or
+any artifact involved is not installed by links, the generation is
+built from scratch with :func:`make_profile`.
+
+Reference
+---------
 
 """
 
 
 import os
 import errno
+import shutil
 from os.path import join as pjoin
 import json
 
 from .build_store import shorten_artifact_id
 from .common import json_formatting_options
-from .fileutils import write_protect, touch
+from .fileutils import (write_protect, touch, silent_unlink, silent_makedirs,
+                        atomic_symlink, remove_files_and_empty_dirs)
+from .links import (dry_run_links_dsl, merge_links_plans, execute_links_plan,
+                    serialize_links_plan, deserialize_links_plan)
 from . import run_job
 
+PROFILE_MANIFEST_FILENAME = 'profile-manifest.json'
+
+# Written by the launcher (see launcher.c) to cache the profile lookup
+LAUNCHER_CACHE_FILENAME = 'launcher.cache'
+
 def make_profile(logger, build_store, artifacts, target_dir, virtuals, cfg):
     """
 
@@ -71,18 +124,66 @@ def make_profile(logger, build_store, artifacts, target_dir, virtuals, cfg):
 
     target_dir : str
         Target directory, must be non-existing or entirely empty
+
+    Returns
+    -------
+
+    installed : list of str
+        The (absolute) paths of the files and symlinks created in the
+        profile. Links are tracked as they are created; only if some
+        artifacts are installed by running their install job is the
+        target directory listed before and after those jobs.
     """
     # order artifacts
     artifacts = run_job.stable_topological_sort(artifacts)
+    target_dir = os.path.abspath(target_dir)
 
-    # process artifacts in opposite order; highes prioritized gets to go last
+    # the artifact coming first has priority; consecutive artifacts
+    # installed by links are merged into one plan
+    pending_plans = []
+    plans = []
+    installed = []
+    files_before_jobs = None
     for artifact in artifacts:
         a_id_desc = shorten_artifact_id(artifact['id'])
-        logger.info('Linking %s into %s' % (a_id_desc, target_dir))
         sub_logger = logger.get_sub_logger(a_id_desc)
-        install_artifact_into_profile(sub_logger, build_store, artifact['id'], target_dir,
-                                      virtuals, cfg)
+        plan = get_artifact_links_plan(sub_logger, build_store, artifact['id'], target_dir,
+                                       virtuals, cfg)
+        plans.append((artifact['id'], plan))
+        if plan is not None:
+            logger.debug('Planning links for %s' % a_id_desc)
+            pending_plans.append(plan)
+        else:
+            installed.extend(_execute_plans(logger, pending_plans, target_dir))
+            pending_plans = []
+            if files_before_jobs is None:
+                files_before_jobs = _list_files(target_dir)
+            logger.info('Installing %s into %s' % (a_id_desc, target_dir))
+            install_artifact_into_profile(sub_logger, build_store, artifact['id'], target_dir,
+                                          virtuals, cfg)
+    installed.extend(_execute_plans(logger, pending_plans, target_dir))
+    if files_before_jobs is not None:
+        installed = set(installed)
+        installed.update(_list_files(target_dir).difference(files_before_jobs))
+        installed = list(installed)
+    installed.extend(_write_profile_files(target_dir, artifacts, plans))
+    return installed
+
+def _list_files(target_dir):
+    # all files and symlinks, including symlinks to directories
+    result = set()
+    for root, dirs, files in os.walk(target_dir):
+        for name in files:
+            result.add(pjoin(root, name))
+        for name in dirs:
+            if os.path.islink(pjoin(root, name)):
+                result.add(pjoin(root, name))
+    return result
 
+def _write_profile_files(target_dir, artifacts, plans):
+    """Writes profile.json, the ownership manifest and the bin marker;
+    returns the paths written
+    """
     # make profile.json
     doc = {'artifacts': artifacts}
     profile_json = pjoin(target_dir, 'profile.json')
@@ -91,10 +192,218 @@ def make_profile(logger, build_store, artifacts, target_dir, virtuals, cfg):
         f.write('\n')
     write_protect(profile_json)
 
-    # marker file for use by launcher
+    # ownership manifest, with paths relative to the profile
+    target_dir = os.path.abspath(target_dir)
+    doc = {'artifacts': [[artifact_id, None if plan is None else
+                          serialize_links_plan(plan, target_dir)]
+                         for artifact_id, plan in plans]}
+    manifest_json = pjoin(target_dir, PROFILE_MANIFEST_FILENAME)
+    with open(manifest_json, 'w') as f:
+        # json.dumps uses the C encoder, json.dump does not
+        f.write(json.dumps(doc) + '\n')
+    write_protect(manifest_json)
+
+    written = [profile_json, manifest_json]
+
+    # marker file for use by launcher, and an empty cache that the
+    # launcher may fill in; it never creates one itself
     if os.path.exists(pjoin(target_dir, 'bin')):
-        touch(pjoin(target_dir, 'bin', 'is-profile-bin'), readonly=True)
+        marker = pjoin(target_dir, 'bin', 'is-profile-bin')
+        touch(marker, readonly=True)
+        cache = pjoin(target_dir, 'bin', LAUNCHER_CACHE_FILENAME)
+        touch(cache)
+        written.extend([marker, cache])
+    return written
+
+def _load_profile_manifest(target_dir):
+    try:
+        f = file(pjoin(target_dir, PROFILE_MANIFEST_FILENAME))
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    with f:
+        doc = json.load(f)
+    return [(artifact_id, None if plan is None else deserialize_links_plan(plan, target_dir))
+            for artifact_id, plan in doc['artifacts']]
+
+def _get_winning_actions(actions):
+    return dict((action[-1], action) for action in actions
+                if action[0] not in (silent_makedirs, silent_unlink))
+
+def update_profile(logger, build_store, artifacts, target, virtuals, cfg):
+    """Creates or updates the profile at `target` (see module docstring)
+
+    Parameters
+    ----------
+    logger : Logger
+
+    build_store : BuildStore
+
+    artifacts : list of dict(id=..., before=...)
+        Lists the artifacts to include together with constraints
+
+    target : str
+        Path of the profile; either non-existing or a symlink set up
+        by an earlier call. The generation directories are created next
+        to it.
+    """
+    target = os.path.abspath(target)
+    if os.path.islink(target):
+        current = os.readlink(target)
+    elif os.path.exists(target):
+        raise Exception('%s exists and is not a symlink to a profile generation' % target)
+    else:
+        current = None
+    generations = [os.path.basename(target) + '.%d' % i for i in range(2)]
+    next_name = generations[1] if current == generations[0] else generations[0]
+    next_dir = pjoin(os.path.dirname(target), next_name)
+
+    artifacts = run_job.stable_topological_sort(artifacts)
+    old_plans = _load_profile_manifest(next_dir) if os.path.isdir(next_dir) else None
+    new_plans = None
+    if old_plans is not None and all(plan is not None for _, plan in old_plans):
+        known = dict(old_plans)
+        new_plans = []
+        for artifact in artifacts:
+            plan = known.get(artifact['id'])
+            if plan is None:
+                a_id_desc = shorten_artifact_id(artifact['id'])
+                plan = get_artifact_links_plan(logger.get_sub_logger(a_id_desc), build_store,
+                                               artifact['id'], next_dir, virtuals, cfg)
+                if plan is None:
+                    new_plans = None
+                    break
+                logger.debug('Planning links for %s' % a_id_desc)
+            new_plans.append((artifact['id'], plan))
+
+    if new_plans is None:
+        logger.info('Building %s from scratch' % next_dir)
+        if os.path.exists(next_dir):
+            shutil.rmtree(next_dir)
+        os.mkdir(next_dir)
+        make_profile(logger, build_store, artifacts, next_dir, virtuals, cfg)
+    else:
+        old_winners = _get_winning_actions(
+            merge_links_plans([plan for _, plan in old_plans])[0])
+        new_actions, conflicts = merge_links_plans([plan for _, plan in new_plans])
+        for path, kept, dropped in conflicts:
+            logger.debug('%s: using %s rather than %s' % (path, kept, dropped))
+        new_winners = _get_winning_actions(new_actions)
+        removed = [dest for dest, action in old_winners.iteritems()
+                   if new_winners.get(dest) != action]
+        added = set(dest for dest, action in new_winners.iteritems()
+                    if old_winners.get(dest) != action)
+        logger.info('Updating %s: removing %d and adding %d links' %
+                    (next_dir, len(removed), len(added)))
+        # the files written last time are re-created below
+        remove_files_and_empty_dirs(
+            removed + [pjoin(next_dir, 'profile.json'),
+                       pjoin(next_dir, PROFILE_MANIFEST_FILENAME),
+                       pjoin(next_dir, 'bin', 'is-profile-bin'),
+                       pjoin(next_dir, 'bin', LAUNCHER_CACHE_FILENAME)], next_dir)
+        added_dirs = set(os.path.dirname(dest) for dest in added)
+        execute_links_plan([action for action in new_actions
+                            if action[-1] in added or
+                            (action[0] is silent_makedirs and action[1] in added_dirs)],
+                           logger=logger)
+        _write_profile_files(next_dir, artifacts, new_plans)
+
+    atomic_symlink(next_name, target)
+
+def _execute_plans(logger, plans, target_dir):
+    if not plans:
+        return []
+    actions, conflicts = merge_links_plans(plans)
+    for path, kept, dropped in conflicts:
+        logger.debug('%s: using %s rather than %s' % (path, kept, dropped))
+    logger.info('Linking %d artifacts into %s (%d conflicts)' %
+                (len(plans), target_dir, len(conflicts)))
+    return execute_links_plan(actions, logger=logger)
+
+def _get_json_key(doc, key):
+    if key in ('', '/'):
+        return doc
+    for step in key.split('/'):
+        doc = doc[step]
+    return doc
+
+def _parse_create_links_command(cmd):
+    """Returns (key, input) if `cmd` is a plain ``hdist create-links`` command,
+    otherwise `None`
+    """
+    if (not isinstance(cmd, list) or len(cmd) < 3 or cmd[0] not in ('hdist', '@hdist') or
+        cmd[1] != 'create-links'):
+        return None
+    key = '/'
+    inputs = []
+    args = cmd[2:]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('--key='):
+            key = arg[len('--key='):]
+        elif arg == '--key' and i + 1 < len(args):
+            i += 1
+            key = args[i]
+        elif arg.startswith('-') or '$' in arg:
+            return None
+        else:
+            inputs.append(arg)
+        i += 1
+    if len(inputs) != 1 or '$' in key:
+        return None
+    return key, inputs[0]
+
+def get_artifact_links_plan(logger, build_store, artifact_id, target_dir, virtuals, cfg):
+    """Returns the actions installing the artifact into the profile, if the
+    install job of the artifact consists of only a ``hdist create-links``
+    command that does not need any imports; otherwise returns `None`
+
+    Artifacts without an install job get an empty plan.
+    """
+    artifact_dir = build_store.resolve(artifact_id)
+    if artifact_dir is None:
+        raise Exception('artifact %s not available' % artifact_id)
+    doc_filename = pjoin(artifact_dir, 'artifact.json')
+    if not os.path.exists(doc_filename):
+        logger.warning('No artifact.json present, skipping')
+        return []
+    with file(doc_filename) as f:
+        doc = json.load(f)
+    job_spec = doc.get('install', None)
+    if not job_spec:
+        return []
+    job_spec = run_job.canonicalize_job_spec(job_spec)
+    if job_spec['import'] or len(job_spec['script']) != 1:
+        return None
+    parsed = _parse_create_links_command(job_spec['script'][0])
+    if parsed is None:
+        return None
+    key, input_filename = parsed
+    if input_filename == 'artifact.json':
+        params_doc = doc
+    else:
+        with file(pjoin(artifact_dir, input_filename)) as f:
+            params_doc = json.load(f)
+    try:
+        rules = _get_json_key(params_doc, key)
+    except KeyError:
+        raise Exception("Key %s not found in JSON document '%s'" % (key, input_filename))
+    if any(rule.get('action') == 'launcher' for rule in rules):
+        # needs $LAUNCHER from the job environment
+        return None
 
+    # same environment as run_job would have set up
+    env = dict(job_spec['env'])
+    env.update(job_spec['env_nohash'])
+    env['ARTIFACT'] = artifact_dir
+    env['PROFILE'] = os.path.abspath(target_dir)
+    env['HDIST_VIRTUALS'] = run_job.pack_virtuals_envvar(virtuals)
+    env['HDIST_CONFIG'] = json.dumps(cfg, separators=(',', ':'))
+    # the job would run in the artifact dir; relative paths are taken
+    # relative to it, so that the plan can be carried out from anywhere
+    return dry_run_links_dsl(rules, env, cwd=artifact_dir)
 
 def install_artifact_into_profile(logger, build_store, artifact_id, target_dir, virtuals, cfg):
     target_dir = os.path.abspath(target_dir)
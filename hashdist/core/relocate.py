@@ -0,0 +1,290 @@
+"""
+:mod:`hashdist.core.relocate` --- Moving artifacts between artifact roots
+=========================================================================
+
+Artifacts embed their own absolute path in many places: ``#!``-lines of
+scripts, Makefiles, ``.pc``-files, RPATHs and string constants in
+binaries, and so on. In order to unpack a pre-built artifact under a
+different ``builder/artifacts`` root, all of these occurrences must be
+rewritten.
+
+After each build, the artifact is scanned for its own path and the
+result is stored as ``relocations.json`` in the artifact::
+
+    {
+      "prefix" : "/home/dagss/.hdist/opt/zlib/4nio",
+      "text" : ["lib/pkgconfig/zlib.pc"],
+      "binary" : {"lib/libz.so.1.2.7" : [4211, 4378]},
+      "symlinks" : ["share/doc/zlib"]
+    }
+
+**prefix**:
+    The path of the artifact at the time of the scan.
+
+**text**:
+    Files (relative to the artifact) containing `prefix` and no NUL
+    characters; all occurrences are replaced.
+
+**binary**:
+    Files containing NUL characters, with the byte offsets of each
+    occurrence of `prefix`. An occurrence is assumed to be the start of a
+    NUL-terminated C string (which may contain further occurrences, as
+    in RPATHs) and is rewritten where it is; the string is padded with NUL
+    characters so that the file size and all other offsets are
+    unchanged. This is only possible if the new path is not
+    longer than `prefix`.
+
+**symlinks**:
+    Symlinks whose target is `prefix` or a path below it.
+
+Only occurrences of `prefix` followed by a path boundary (``/``, NUL,
+a quote, whitespace, ``:`` or the end of the file) are considered, so
+that e.g. ``/opt/foo/abcdef`` is not mistaken for an occurrence of
+``/opt/foo/abcd``.
+
+:func:`relocate_artifact` then only needs to touch the listed files,
+and updates the table to the new location. Files are replaced rather
+than modified, so that hard links shared with other paths (such as
+those in tarballs of deduplicated artifacts) are left alone.
+
+Reference
+---------
+
+"""
+
+import os
+from os.path import join as pjoin
+import re
+import errno
+import json
+import stat
+
+from .common import json_formatting_options
+from .fileutils import write_protect, atomic_write
+
+RELOCATIONS_FILENAME = 'relocations.json'
+
+# Files never scanned; build.json and the table itself must describe the
+# build as it happened
+SKIP_FILES = frozenset([RELOCATIONS_FILENAME, 'build.json', 'build.log.gz', 'build.log.idx'])
+
+# Files are scanned in chunks of this size
+CHUNK_SIZE = 1 << 20
+
+# Characters that may follow an occurrence of the prefix
+PATH_BOUNDARY_CHARS = frozenset('/\0"\' \t\n\r\f\v:')
+
+
+class RelocationError(Exception):
+    pass
+
+
+def _prefix_re(prefix):
+    """Regular expression matching `prefix` followed by a path boundary"""
+    return re.compile(re.escape(prefix) + r'(?=[/\0"\'\s:]|\Z)')
+
+def _scan_file(f, sub):
+    """Returns the offsets of the (non-overlapping) occurrences of `sub`
+    followed by a path boundary in the file object `f`, and whether it
+    contains NUL characters
+
+    The file is read in chunks of :data:`CHUNK_SIZE`; the last
+    ``len(sub)`` bytes of each are kept to find occurrences spanning
+    two chunks, and to see the character after them.
+    """
+    offsets = []
+    has_nul = False
+    buf = ''
+    base = 0 # file offset of buf
+    eof = False
+    while not eof:
+        chunk = f.read(CHUNK_SIZE)
+        eof = not chunk
+        has_nul = has_nul or '\0' in chunk
+        buf += chunk
+        keep_from = max(0, len(buf) - len(sub))
+        i = buf.find(sub)
+        while i != -1:
+            end = i + len(sub)
+            if end == len(buf) and not eof:
+                # the next character is not read yet
+                keep_from = i
+                break
+            if end == len(buf) or buf[end] in PATH_BOUNDARY_CHARS:
+                offsets.append(base + i)
+                keep_from = max(keep_from, end)
+                i = buf.find(sub, end)
+            else:
+                i = buf.find(sub, i + 1)
+        base += keep_from
+        buf = buf[keep_from:]
+    return offsets, has_nul
+
+def scan_relocations(artifact_dir, prefix=None):
+    """Finds all occurrences of `prefix` in the artifact
+
+    Parameters
+    ----------
+
+    artifact_dir : str
+        Artifact to scan
+
+    prefix : str
+        Path to look for; defaults to `artifact_dir`
+
+    Returns
+    -------
+
+    table : dict
+        The relocation table (see module docstring)
+    """
+    if prefix is None:
+        prefix = artifact_dir
+    table = {'prefix': prefix, 'text': [], 'binary': {}, 'symlinks': []}
+    for dirpath, dirnames, filenames in os.walk(artifact_dir):
+        for name in sorted(dirnames + filenames):
+            path = pjoin(dirpath, name)
+            relpath = os.path.relpath(path, artifact_dir)
+            if relpath in SKIP_FILES:
+                continue
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(path)
+                if target == prefix or target.startswith(prefix + '/'):
+                    table['symlinks'].append(relpath)
+            elif stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    offsets, has_nul = _scan_file(f, prefix)
+                if not offsets:
+                    continue
+                if has_nul:
+                    table['binary'][relpath] = offsets
+                else:
+                    table['text'].append(relpath)
+    return table
+
+def write_relocations(artifact_dir, table):
+    filename = pjoin(artifact_dir, RELOCATIONS_FILENAME)
+    if os.path.exists(filename):
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IWUSR)
+    with open(filename, 'w') as f:
+        json.dump(table, f, **json_formatting_options)
+        f.write('\n')
+    write_protect(filename)
+
+def load_relocations(artifact_dir):
+    """Returns the relocation table of the artifact, or `None` if it has none
+    """
+    try:
+        f = open(pjoin(artifact_dir, RELOCATIONS_FILENAME))
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    with f:
+        return json.load(f)
+
+def record_relocations(artifact_dir):
+    """Scans the artifact for its own path and stores the relocation table
+    in it; called after each build
+    """
+    table = scan_relocations(artifact_dir)
+    write_relocations(artifact_dir, table)
+    return table
+
+def can_relocate(table, new_prefix):
+    """Whether the occurrences in binary files leave room for `new_prefix`"""
+    return not table['binary'] or len(new_prefix) <= len(table['prefix'])
+
+
+def _replace_file(path, data):
+    """Replaces the file at `path` by a new file with the same mode
+
+    Files may be hard links shared with other paths (see
+    :mod:`hashdist.core.dedup`), so they are never modified in place.
+    """
+    with atomic_write(path, stat.S_IMODE(os.stat(path).st_mode)) as f:
+        f.write(data)
+
+
+def _rewrite_binary(data, offsets, old_re, old_prefix, new_prefix):
+    chunks = []
+    pos = 0
+    for offset in offsets:
+        if data[offset:offset + len(old_prefix)] != old_prefix:
+            raise RelocationError('relocation table does not match file contents at offset %d'
+                                  % offset)
+        if offset < pos:
+            # another occurrence within a string already rewritten
+            continue
+        end = data.find('\0', offset)
+        if end == -1:
+            end = len(data)
+        string = data[offset:end]
+        new_string = old_re.sub(new_prefix.replace('\\', '\\\\'), string)
+        chunks.append(data[pos:offset])
+        chunks.append(new_string)
+        chunks.append('\0' * (len(string) - len(new_string)))
+        pos = end
+    chunks.append(data[pos:])
+    return ''.join(chunks)
+
+def apply_relocations(artifact_dir, table, new_prefix):
+    """Rewrites the occurrences listed in `table` to `new_prefix`
+
+    Raises `RelocationError` if `new_prefix` does not fit in binary files;
+    this is checked before anything is modified.
+    """
+    old_prefix = table['prefix'].encode('utf-8') if isinstance(table['prefix'], unicode) \
+                 else table['prefix']
+    if old_prefix == new_prefix:
+        return
+    if not can_relocate(table, new_prefix):
+        raise RelocationError('cannot relocate binary files from %s to the longer path %s' %
+                              (old_prefix, new_prefix))
+
+    old_re = _prefix_re(old_prefix)
+    replacement = new_prefix.replace('\\', '\\\\')
+    for relpath in table['text']:
+        path = pjoin(artifact_dir, relpath)
+        with open(path, 'rb') as f:
+            data = f.read()
+        _replace_file(path, old_re.sub(replacement, data))
+
+    for relpath, offsets in sorted(table['binary'].items()):
+        path = pjoin(artifact_dir, relpath)
+        with open(path, 'rb') as f:
+            data = f.read()
+        new_data = _rewrite_binary(data, sorted(offsets), old_re, old_prefix, new_prefix)
+        assert len(new_data) == len(data)
+        _replace_file(path, new_data)
+
+    for relpath in table['symlinks']:
+        path = pjoin(artifact_dir, relpath)
+        target = os.readlink(path)
+        os.unlink(path)
+        os.symlink(new_prefix + target[len(old_prefix):], path)
+
+def relocate_artifact(artifact_dir, old_prefix, new_prefix):
+    """Relocates an artifact that was moved from `old_prefix` to `new_prefix`
+
+    The relocation table stored in the artifact is used if present (and
+    updated), otherwise the artifact is scanned for `old_prefix` first.
+
+    Returns
+    -------
+
+    success : bool
+        `False` if the artifact can not be relocated because `new_prefix`
+        is too long to patch into binary files. Nothing has been modified
+        in that case.
+    """
+    table = load_relocations(artifact_dir)
+    if table is None or table['prefix'] != old_prefix:
+        table = scan_relocations(artifact_dir, old_prefix)
+    if not can_relocate(table, new_prefix):
+        return False
+    apply_relocations(artifact_dir, table, new_prefix)
+    table['prefix'] = new_prefix
+    write_relocations(artifact_dir, table)
+    return True
@@ -115,7 +115,8 @@ are affected:
     if one manages to escaoe $ORIGIN properly for the build system,
     any auto-detection will tend to prepend absolute RPATHs
     anyway. See experiences in mess.rst. If on wishes '$ORIGIN' in the
-    RPATH then ``patchelf`` should be used.
+    RPATH then ``hdist build-postprocess --rpath=relative`` should be
+    used after the build (see :mod:`hashdist.core.elf`).
 
 **HDIST_VIRTUALS**:
     The mapping of virtual artifacts to concrete artifact IDs that has
@@ -188,6 +189,17 @@ Rules:
  * All forms above can be prepended with ``@`` on the command-string to silence
    logging the running environment (this may silence even more in the future).
 
+ * ``{"parallel": [command, ...]}``: Runs the commands concurrently and
+   waits for all of them to finish. Only the ``["executable", ...]`` and
+   ``["executable>filename", ...]`` forms (optionally with ``@``) are
+   allowed, since variable assignments and ``cd`` would have no
+   well-defined ordering. Log output is attributed to each command
+   through a sub-logger named by its position in the block and the
+   executable name (e.g., ``0-make``). If any command fails, the others
+   are terminated and the block fails. ``hdist`` commands are run in a
+   separate Python process rather than in-process, and ``hdist logpipe``
+   is not available (create the log pipe before the block instead).
+
 
 The ``hdist`` command is given special treatment and is executed in the
 same process, with logging set up to the logger of the job runner.
@@ -243,20 +255,22 @@ import fcntl
 from os.path import join as pjoin
 import shutil
 import subprocess
-from glob import glob
 from string import Template
 from pprint import pformat
 import tempfile
 import errno
 import select
+import signal
+import contextlib
 from StringIO import StringIO
 import json
 
 from ..hdist_logging import CRITICAL, ERROR, WARNING, INFO, DEBUG
 
 from .common import working_directory
+from .build_timings import null_timings
 
-LOG_PIPE_BUFSIZE = 4096
+LOG_PIPE_BUFSIZE = 64 * 1024
 
 
 class InvalidJobSpecError(ValueError):
@@ -265,7 +279,8 @@ class InvalidJobSpecError(ValueError):
 class JobFailedError(RuntimeError):
     pass
 
-def run_job(logger, build_store, job_spec, override_env, virtuals, cwd, config):
+def run_job(logger, build_store, job_spec, override_env, virtuals, cwd, config,
+            timings=null_timings):
     """Runs a job in a controlled environment, according to rules documented above.
 
     Parameters
@@ -296,6 +311,10 @@ def run_job(logger, build_store, job_spec, override_env, virtuals, cwd, config):
         serialied and put into the HDIST_CONFIG environment variable
         for use by ``hdist``.
 
+    timings : BuildTimings (optional)
+        If provided, a step is recorded for each command run.
+        See :mod:`hashdist.core.build_timings`.
+
     Returns
     -------
 
@@ -311,7 +330,7 @@ def run_job(logger, build_store, job_spec, override_env, virtuals, cwd, config):
     env.update(override_env)
     env['HDIST_VIRTUALS'] = pack_virtuals_envvar(virtuals)
     env['HDIST_CONFIG'] = json.dumps(config, separators=(',', ':'))
-    executor = ScriptExecution(logger)
+    executor = ScriptExecution(logger, timings)
     try:
         out_env = executor.run(job_spec['script'], env, cwd)
     finally:
@@ -415,11 +434,11 @@ def get_imports_env(build_store, virtuals, imports):
             env['%s_ID' % dep_ref] = dep_id
 
         if dep['in_env']:
-            bin_dir = pjoin(dep_dir, 'bin')
-            if os.path.exists(bin_dir):
-                PATH.append(bin_dir)
+            layout = build_store.get_import_layout(dep_id, dep_dir)
+            if layout['bin']:
+                PATH.append(pjoin(dep_dir, 'bin'))
 
-            libdirs = glob(pjoin(dep_dir, 'lib*'))
+            libdirs = [pjoin(dep_dir, x) for x in layout['libdirs']]
             if len(libdirs) == 1:
                 HDIST_LDFLAGS.append('-L' + libdirs[0])
                 HDIST_LDFLAGS.append('-Wl,-R,' + libdirs[0])
@@ -427,9 +446,8 @@ def get_imports_env(build_store, virtuals, imports):
                 raise InvalidJobSpecError('in_hdist_compiler_paths set for artifact %s with '
                                           'more than one library dir (%r)' % (dep_id, libdirs))
 
-            incdir = pjoin(dep_dir, 'include')
-            if os.path.exists(incdir):
-                HDIST_CFLAGS.append('-I' + incdir)
+            if layout['include']:
+                HDIST_CFLAGS.append('-I' + pjoin(dep_dir, 'include'))
 
     env['PATH'] = os.path.pathsep.join(PATH)
     env['HDIST_CFLAGS'] = ' '.join(HDIST_CFLAGS)
@@ -521,13 +539,20 @@ class ScriptExecution(object):
 
     logger : Logger
 
+    timings : BuildTimings
+        Each command run is recorded as a step in `timings`.
+
+    Attributes
+    ----------
+
     rpc_dir : str
         A temporary directory on a local filesystem. Currently used for creating
         pipes with the "hdist logpipe" command.
     """
     
-    def __init__(self, logger):
+    def __init__(self, logger, timings=null_timings):
         self.logger = logger
+        self.timings = timings
         self.log_fifo_filenames = {}
         self.rpc_dir = tempfile.mkdtemp(prefix='hdist-sandbox-')
 
@@ -558,6 +583,9 @@ class ScriptExecution(object):
         """
         env = dict(env)
         for script_line in script:
+            if isinstance(script_line, dict):
+                self.run_parallel(script_line, env, cwd)
+                continue
             if not isinstance(script_line, list):
                 raise TypeError("expected a list but got %r: %r" % (type(script_line), script_line))
             if len(script_line) == 0:
@@ -618,6 +646,90 @@ class ScriptExecution(object):
                     self.run_command([cmd] + args, env, cwd, silent=silent)
         return env
 
+    def run_parallel(self, block, env, cwd):
+        """Executes a ``{"parallel": [...]}`` block of the script
+
+        Raises `subprocess.CalledProcessError` for the first command
+        that fails, after the remaining ones have been terminated.
+        """
+        if block.keys() != ['parallel'] or not isinstance(block['parallel'], list):
+            raise ValueError('expected {"parallel": [command, ...]} but got %r' % block)
+        commands = []
+        for i, script_line in enumerate(block['parallel']):
+            if (not isinstance(script_line, list) or len(script_line) == 0 or
+                not all(isinstance(x, basestring) for x in script_line)):
+                raise ValueError('parallel block may only contain commands: %r' % script_line)
+            cmd = script_line[0]
+            silent = cmd.startswith('@')
+            if silent:
+                cmd = cmd[1:]
+            if '=' in cmd or cmd == 'cd':
+                raise ValueError('assignments and cd not allowed in parallel block: %r' %
+                                 script_line)
+            args = [substitute(x, env) for x in script_line[1:]]
+            stdout_filename = None
+            if '>' in cmd:
+                cmd, stdout_filename = cmd.split('>')
+                stdout_filename = substitute(stdout_filename, env)
+                if not os.path.isabs(stdout_filename):
+                    stdout_filename = pjoin(cwd, stdout_filename)
+                stdout_filename = os.path.realpath(stdout_filename)
+                if stdout_filename.startswith(self.rpc_dir):
+                    raise NotImplementedError("Cannot currently use stream re-direction to write to "
+                                              "a log-pipe (doing the write from a "
+                                              "sub-process is OK)")
+            cmd = substitute(cmd, env)
+            if cmd == 'hdist':
+                if args[:1] == ['logpipe']:
+                    raise ValueError('"hdist logpipe" not allowed in parallel block')
+                command_lst = hdist_subprocess_command(args)
+            else:
+                command_lst = [cmd] + args
+            sublogger = self.logger.get_sub_logger('%d-%s' % (i, os.path.basename(cmd)))
+            commands.append((command_lst, stdout_filename, silent, sublogger))
+
+        self.logger.debug('running %d commands in parallel' % len(commands))
+        for command_lst, stdout_filename, silent, sublogger in commands:
+            sublogger.debug('running %r' % command_lst)
+        self.logger.debug('cwd: ' + cwd)
+        if not all(silent for command_lst, stdout_filename, silent, sublogger in commands):
+            self.logger.debug('environment:')
+            for line in pformat(env).splitlines():
+                self.logger.debug('  ' + line)
+
+        with self.timings.step('parallel', commands=[c[0] for c in commands]):
+            self._run_parallel(commands, env, cwd)
+
+    def _run_parallel(self, commands, env, cwd):
+        procs = []
+        stdout_files = []
+        with sigchld_wakeup_fd() as wakeup_fd:
+            mux = LogMultiplexer(wakeup_fd)
+            try:
+                for command_lst, stdout_filename, silent, sublogger in commands:
+                    stdout = None
+                    if stdout_filename is not None:
+                        stdout = file(stdout_filename, 'a')
+                        stdout_files.append(stdout)
+                    proc = self.spawn(command_lst, env, cwd, stdout)
+                    procs.append(proc)
+                    mux.add_process(proc, sublogger, stdout)
+                self.add_log_fifos(mux, self.logger)
+                failed_proc = mux.run(procs, fail_fast=True)
+            finally:
+                mux.close()
+                for f in stdout_files:
+                    f.close()
+                for proc in procs:
+                    if proc.poll() is None:
+                        proc.terminate()
+                    proc.wait()
+
+        if failed_proc is not None:
+            command_lst, stdout_filename, silent, sublogger = commands[procs.index(failed_proc)]
+            sublogger.error("command failed (code=%d); raising" % failed_proc.returncode)
+            raise subprocess.CalledProcessError(failed_proc.returncode, command_lst)
+
     def run_command(self, command_lst, env, cwd, stdout_to=None, silent=False):
         """Runs a single command of the job script
 
@@ -648,6 +760,11 @@ class ScriptExecution(object):
             logger.debug('environment:')
             for line in pformat(env).splitlines():
                 logger.debug('  ' + line)
+        with self.timings.step('command', command=command_lst):
+            self._run_command(command_lst, env, cwd, stdout_to)
+
+    def _run_command(self, command_lst, env, cwd, stdout_to):
+        logger = self.logger
         if command_lst[0] == 'hdist':
             # run hdist cli in-process special case the 'hdist'
             # command and run it in the same process do not emit
@@ -679,132 +796,51 @@ class ScriptExecution(object):
         and any number of log FIFO pipes available to the called process into
         a single Logger instance. Optionally captures stdout instead of logging it.
         """
-        logger = self.logger
+        with sigchld_wakeup_fd() as wakeup_fd:
+            proc = self.spawn(command_lst, env, cwd, stdout_to)
+            mux = LogMultiplexer(wakeup_fd)
+            try:
+                mux.add_process(proc, self.logger, stdout_to)
+                self.add_log_fifos(mux, self.logger)
+                mux.run([proc])
+            finally:
+                mux.close()
+
+        retcode = proc.wait()
+        if retcode != 0:
+            raise subprocess.CalledProcessError(retcode, command_lst)
+
+    def spawn(self, command_lst, env, cwd, stdout_to):
+        """Launches a command with stdout and stderr connected to pipes
+
+        If `stdout_to` is a real file (has a ``fileno``), the command
+        writes to it directly rather than through a pipe.
+        """
+        if stdout_to is not None and hasattr(stdout_to, 'fileno'):
+            stdout_to.flush()
+            stdout = stdout_to
+        else:
+            stdout = subprocess.PIPE
         try:
-            proc = subprocess.Popen(command_lst,
+            return subprocess.Popen(command_lst,
                                     cwd=cwd,
                                     env=env,
                                     stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
+                                    stdout=stdout,
                                     stderr=subprocess.PIPE,
                                     close_fds=True)
         except OSError, e:
             if e.errno == errno.ENOENT:
                 # fix error message up a bit since the situation is so confusing
-                logger.error('command "%s" not found in PATH' % command_lst[0])
+                self.logger.error('command "%s" not found in PATH' % command_lst[0])
                 raise OSError(e.errno, 'command "%s" not found in PATH (cwd: "%s")' %
                               (command_lst[0], cwd), cwd)
             else:
                 raise
 
-        # Weave together input from stdout, stderr, and any attached log
-        # pipes.  To avoid any deadlocks with unbuffered stderr
-        # interlaced with use of log pipe etc. we avoid readline(), but
-        # instead use os.open to read and handle line-assembly ourselves...
-
-        stdout_fd, stderr_fd = proc.stdout.fileno(), proc.stderr.fileno()
-        poller = select.poll()
-        poller.register(stdout_fd)
-        poller.register(stderr_fd)
-
-        # Set up { fd : (logger, level) }
-        loggers = {stdout_fd: (logger, DEBUG), stderr_fd: (logger, DEBUG)}
-        buffers = {stdout_fd: '', stderr_fd: ''}
-
-        # The FIFO pipes are a bit tricky as they need to the re-opened whenever
-        # any client closes. This also modified the loggers dict and fd_to_logpipe
-        # dict.
-
-        fd_to_logpipe = {} # stderr/stdout not re-opened
-        
-        def open_fifo(fifo_filename, logger, level):
-            # need to open in non-blocking mode to avoid waiting for printing client process
-            fd = os.open(fifo_filename, os.O_NONBLOCK|os.O_RDONLY)
-            # remove non-blocking after open to treat all streams uniformly in
-            # the reading code
-            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_RDONLY)
-            loggers[fd] = (logger, level)
-            buffers[fd] = ''
-            fd_to_logpipe[fd] = fifo_filename
-            poller.register(fd)
-
-        def flush_buffer(fd):
-            buf = buffers[fd]
-            if buf:
-                # flush buffer in case last line not terminated by '\n'
-                sublogger, level = loggers[fd]
-                sublogger.log(level, buf)
-            del buffers[fd]
-
-        def close_fifo(fd):
-            flush_buffer(fd)
-            poller.unregister(fd)
-            os.close(fd)
-            del loggers[fd]
-            del fd_to_logpipe[fd]
-            
-        def reopen_fifo(fd):
-            fifo_filename = fd_to_logpipe[fd]
-            logger, level = loggers[fd]
-            close_fifo(fd)
-            open_fifo(fifo_filename, logger, level)
-
+    def add_log_fifos(self, mux, logger):
         for (header, level), fifo_filename in self.log_fifo_filenames.items():
-            sublogger = logger.get_sub_logger(header)
-            open_fifo(fifo_filename, sublogger, level)
-            
-        while True:
-            # Python poll() doesn't return when SIGCHLD is received;
-            # and there's the freak case where a process first
-            # terminates stdout/stderr, then trying to write to a log
-            # pipe, so we should track child termination the proper
-            # way. Being in Python, it's easiest to just poll every
-            # 50 ms; the majority of the time is spent in poll() so
-            # it doesn't really increase log message latency
-            events = poller.poll(50)
-            if len(events) == 0:
-                if proc.poll() is not None:
-                    break # child terminated
-            for fd, reason in events:
-                if reason & select.POLLHUP and not (reason & select.POLLIN):
-                    # we want to continue receiving PULLHUP|POLLIN until all
-                    # is read
-                    if fd in fd_to_logpipe:
-                        reopen_fifo(fd)
-                    elif fd in (stdout_fd, stderr_fd):
-                        poller.unregister(fd)
-                elif reason & select.POLLIN:
-                    if stdout_to is not None and fd == stdout_fd:
-                        # Just forward
-                        buf = os.read(fd, LOG_PIPE_BUFSIZE)
-                        stdout_to.write(buf)
-                    else:
-                        # append new bytes to what's already been read on this fd; and
-                        # emit any completed lines
-                        new_bytes = os.read(fd, LOG_PIPE_BUFSIZE)
-                        assert new_bytes != '' # after all, we did poll
-                        buffers[fd] += new_bytes
-                        lines = buffers[fd].splitlines(True) # keepends=True
-                        if lines[-1][-1] != '\n':
-                            buffers[fd] = lines[-1]
-                            del lines[-1]
-                        else:
-                            buffers[fd] = ''
-                        # have list of lines, emit them to logger
-                        sublogger, level = loggers[fd]
-                        for line in lines:
-                            if line[-1] == '\n':
-                                line = line[:-1]
-                            sublogger.log(level, line)
-
-        flush_buffer(stderr_fd)
-        flush_buffer(stdout_fd)
-        for fd in fd_to_logpipe.keys():
-            close_fifo(fd)
-
-        retcode = proc.wait()
-        if retcode != 0:
-            raise subprocess.CalledProcessError(retcode, command_lst)
+            mux.add_fifo(fifo_filename, logger.get_sub_logger(header), level)
 
     def hdist_command(self, argv, env, cwd, logger):
         if len(argv) >= 2 and argv[1] == 'logpipe':
@@ -826,3 +862,298 @@ class ScriptExecution(object):
             self.log_fifo_filenames[sublogger_name, level] = fifo_filename
         sys.stdout.write(fifo_filename)
         
+
+
+# Runs the hdist command-line tool (with arguments in sys.argv[1:])
+# using the copy of Hashdist this module is part of
+_HDIST_SUBPROCESS_CODE = ('import sys, os; sys.path.insert(0, %r); sys.argv[0] = "hdist"; '
+                          'from hashdist.cli import main; '
+                          'sys.exit(main(sys.argv, os.environ))')
+
+def hdist_subprocess_command(args):
+    """Returns the command line for running ``hdist`` with `args` in a
+    separate Python process
+    """
+    hashdist_parent_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    return [sys.executable, '-c', _HDIST_SUBPROCESS_CODE % hashdist_parent_dir] + list(args)
+
+
+@contextlib.contextmanager
+def sigchld_wakeup_fd():
+    """Context manager yielding a file descriptor that becomes readable
+    whenever a child process terminates
+
+    This lets the :class:`LogMultiplexer` sleep until something
+    happens rather than waking up periodically to check on its
+    children. Signal handlers can only be installed from the main
+    thread; in other threads `None` is yielded instead.
+    """
+    r, w = os.pipe()
+    for fd in (r, w):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    try:
+        old_wakeup_fd = signal.set_wakeup_fd(w)
+    except ValueError:
+        # not the main thread
+        os.close(r)
+        os.close(w)
+        yield None
+        return
+    # The handler must not be SIG_IGN, as that would make the kernel
+    # reap children for us; an actual (no-op) handler is needed for the
+    # wakeup fd to be written to.
+    old_handler = signal.signal(signal.SIGCHLD, _ignore_signal)
+    signal.siginterrupt(signal.SIGCHLD, False)
+    try:
+        yield r
+    finally:
+        signal.signal(signal.SIGCHLD, old_handler if old_handler is not None else signal.SIG_DFL)
+        signal.set_wakeup_fd(old_wakeup_fd)
+        os.close(r)
+        os.close(w)
+
+def _ignore_signal(signum, frame):
+    pass
+
+
+if hasattr(select, 'epoll'):
+    class _Poller(object):
+        IN, HUP = select.EPOLLIN, select.EPOLLHUP | select.EPOLLERR
+
+        def __init__(self):
+            self._epoll = select.epoll()
+
+        def register(self, fd):
+            self._epoll.register(fd, select.EPOLLIN)
+
+        def unregister(self, fd):
+            self._epoll.unregister(fd)
+
+        def poll(self, timeout):
+            return self._epoll.poll(timeout)
+
+        def close(self):
+            self._epoll.close()
+else:
+    class _Poller(object):
+        IN, HUP = select.POLLIN, select.POLLHUP | select.POLLERR
+
+        def __init__(self):
+            self._poll = select.poll()
+
+        def register(self, fd):
+            self._poll.register(fd, select.POLLIN)
+
+        def unregister(self, fd):
+            self._poll.unregister(fd)
+
+        def poll(self, timeout):
+            return self._poll.poll(int(timeout * 1000))
+
+        def close(self):
+            pass
+
+
+class LogMultiplexer(object):
+    """
+    Event loop weaving together output from child processes' stdout and
+    stderr and from log FIFOs into loggers.
+
+    To avoid any deadlocks with unbuffered stderr interlaced with use of
+    log pipe etc. we avoid readline(), but instead use os.read and
+    handle line-assembly ourselves. Complete lines are passed on to the
+    logger in batches (one :meth:`Logger.log_lines` call per read).
+
+    Parameters
+    ----------
+
+    wakeup_fd : int or None
+        File descriptor that becomes readable when a child terminates
+        (see :func:`sigchld_wakeup_fd`). If `None`, children are checked
+        for termination every 50 ms instead.
+    """
+
+    # Python poll() doesn't return when SIGCHLD is received; and
+    # there's the freak case where a process first terminates
+    # stdout/stderr, then trying to write to a log pipe, so we should
+    # track child termination the proper way. Without a wakeup fd we
+    # poll every 50 ms; with one, the timeout is merely a safety net.
+    POLL_INTERVAL = 0.05
+    WAKEUP_POLL_INTERVAL = 1.0
+
+    def __init__(self, wakeup_fd=None):
+        self.wakeup_fd = wakeup_fd
+        self.poller = _Poller()
+        self.loggers = {} # { fd : (logger, level) }
+        self.buffers = {} # { fd : [chunk, ...] } of incomplete last line
+        self.captures = {} # { fd : stream } for stdout captured rather than logged
+        self.fifos = {} # { fd : fifo filename }, re-opened whenever a client closes
+        self.child_fds = set() # stdout/stderr, closed by their file objects
+        if wakeup_fd is not None:
+            self.poller.register(wakeup_fd)
+
+    def add_process(self, proc, logger, stdout_to=None):
+        """Forwards stderr of `proc`, and stdout unless it was redirected
+        elsewhere, to `logger` on DEBUG level
+
+        If `stdout_to` is given, stdout is copied to it verbatim instead
+        (unless `proc` writes to it directly).
+        """
+        if proc.stdout is not None:
+            if stdout_to is not None:
+                self._register_capture(proc.stdout.fileno(), stdout_to)
+            else:
+                self._register_stream(proc.stdout.fileno(), logger, DEBUG)
+        self._register_stream(proc.stderr.fileno(), logger, DEBUG)
+
+    def add_fifo(self, fifo_filename, logger, level):
+        # need to open in non-blocking mode to avoid waiting for printing client process
+        fd = os.open(fifo_filename, os.O_NONBLOCK|os.O_RDONLY)
+        # remove non-blocking after open to treat all streams uniformly in
+        # the reading code
+        fcntl.fcntl(fd, fcntl.F_SETFL, os.O_RDONLY)
+        self.loggers[fd] = (logger, level)
+        self.buffers[fd] = []
+        self.fifos[fd] = fifo_filename
+        self.poller.register(fd)
+
+    def _register_stream(self, fd, logger, level):
+        self.loggers[fd] = (logger, level)
+        self.buffers[fd] = []
+        self.child_fds.add(fd)
+        self.poller.register(fd)
+
+    def _register_capture(self, fd, stream):
+        self.captures[fd] = stream
+        self.child_fds.add(fd)
+        self.poller.register(fd)
+
+    def _flush_buffer(self, fd):
+        # flush buffer in case last line not terminated by '\n'
+        buf = ''.join(self.buffers.pop(fd))
+        logger, level = self.loggers.pop(fd)
+        if buf:
+            logger.log(level, buf)
+
+    def _close_fd(self, fd):
+        self.poller.unregister(fd)
+        if fd in self.captures:
+            del self.captures[fd]
+        else:
+            self._flush_buffer(fd)
+        if fd in self.fifos:
+            del self.fifos[fd]
+            os.close(fd)
+        else:
+            self.child_fds.discard(fd)
+
+    def _reopen_fifo(self, fd):
+        fifo_filename = self.fifos[fd]
+        logger, level = self.loggers[fd]
+        self._close_fd(fd)
+        self.add_fifo(fifo_filename, logger, level)
+
+    def _read(self, fd):
+        new_bytes = os.read(fd, LOG_PIPE_BUFSIZE)
+        if not new_bytes:
+            return False
+        if fd in self.captures:
+            # Just forward
+            self.captures[fd].write(new_bytes)
+            return True
+        # append new bytes to what's already been read on this fd; and
+        # emit any completed lines
+        buf = self.buffers[fd]
+        end = new_bytes.rfind('\n')
+        if end == -1:
+            buf.append(new_bytes)
+            return True
+        if buf:
+            buf.append(new_bytes[:end])
+            complete = ''.join(buf)
+            del buf[:]
+        else:
+            complete = new_bytes[:end]
+        if end + 1 < len(new_bytes):
+            buf.append(new_bytes[end + 1:])
+        logger, level = self.loggers[fd]
+        logger.log_lines(level, complete.split('\n'))
+        return True
+
+    def _poll(self, timeout):
+        while True:
+            try:
+                return self.poller.poll(timeout)
+            except (IOError, OSError, select.error), e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def _drain_wakeup_fd(self):
+        try:
+            while os.read(self.wakeup_fd, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run(self, procs, fail_fast=False):
+        """Forwards output until all of `procs` have terminated and
+        everything they wrote to their stdout and stderr has been logged
+
+        If `fail_fast` is set, the remaining processes are terminated
+        as soon as one of them fails; the first process that failed is
+        returned (or `None`). Output is still forwarded until all have
+        terminated.
+        """
+        timeout = (self.POLL_INTERVAL if self.wakeup_fd is None
+                   else self.WAKEUP_POLL_INTERVAL)
+        # Set when a child may have terminated; we then keep going without
+        # blocking until all pending output has been read
+        maybe_exited = False
+        failed_proc = None
+        while True:
+            events = self._poll(0 if maybe_exited else timeout)
+            got_data = False
+            for fd, reason in events:
+                if fd == self.wakeup_fd:
+                    self._drain_wakeup_fd()
+                    maybe_exited = True
+                elif reason & self.poller.IN:
+                    # we want to continue receiving HUP|IN until all is read
+                    if self._read(fd):
+                        got_data = True
+                    elif fd in self.fifos:
+                        self._reopen_fifo(fd)
+                    else:
+                        self._close_fd(fd)
+                elif reason & self.poller.HUP:
+                    if fd in self.fifos:
+                        self._reopen_fifo(fd)
+                    else:
+                        self._close_fd(fd)
+                        if not self.child_fds:
+                            maybe_exited = True
+            if not events or maybe_exited:
+                returncodes = [proc.poll() for proc in procs]
+                if fail_fast and failed_proc is None:
+                    for proc, returncode in zip(procs, returncodes):
+                        if returncode is not None and returncode != 0:
+                            failed_proc = proc
+                            for other in procs:
+                                if other.poll() is None:
+                                    other.terminate()
+                            break
+                if not got_data:
+                    if None not in returncodes:
+                        break # children terminated
+                    maybe_exited = False
+        return failed_proc
+
+    def close(self):
+        """Flushes incomplete lines and closes log FIFOs"""
+        for fd in sorted(self.child_fds, reverse=True) + sorted(self.fifos):
+            self._close_fd(fd)
+        if self.wakeup_fd is not None:
+            self.poller.unregister(self.wakeup_fd)
+        self.poller.close()
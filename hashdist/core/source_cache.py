@@ -100,7 +100,7 @@ import stat
 
 from ..deps import sh
 from .hasher import Hasher, format_digest, HashingReadStream, HashingWriteStream
-from .fileutils import silent_makedirs
+from .fileutils import silent_makedirs, write_if_changed
 
 pjoin = os.path.join
 
@@ -261,7 +261,7 @@ class SourceCache(object):
         handler = self._get_handler(type)
         handler.fetch(url, type, hash)
 
-    def unpack(self, key, target_path, unsafe_mode=False, strip=0):
+    def unpack(self, key, target_path, unsafe_mode=False, strip=0, overwrite=False):
         """
         Unpacks the sources identified by `key` to `target_path`
 
@@ -298,6 +298,11 @@ class SourceCache(object):
             extracted file. Set to 1 to remove the typical
             ``projectname-2.2`` directory in tarballs.
 
+        overwrite : bool (default: False)
+            Whether existing files may be overwritten (tarballs and git
+            sources always overwrite). Files that already have the right
+            contents are left untouched.
+
         """
         if not os.path.exists(target_path):
             os.makedirs(target_path)
@@ -305,7 +310,7 @@ class SourceCache(object):
             raise ValueError("Key must be on form 'type:hash'")
         type, hash = key.split(':')
         handler = self._get_handler(type)
-        handler.unpack(type, hash, target_path, unsafe_mode, strip)
+        handler.unpack(type, hash, target_path, unsafe_mode, strip, overwrite)
 
 
 class GitSourceCache(object):
@@ -434,7 +439,7 @@ class GitSourceCache(object):
 
         return 'git:%s' % commit
 
-    def unpack(self, type, hash, target_path, unsafe_mode, strip):
+    def unpack(self, type, hash, target_path, unsafe_mode, strip, overwrite=False):
         assert type == 'git'
         if strip != 0:
             raise NotImplementedError('unpacking with git does not support strip != 0')
@@ -569,14 +574,14 @@ class ArchiveSourceCache(object):
                 hdist_pack(files, f)
         return key
     
-    def unpack(self, type, hash, target_dir, unsafe_mode, strip):
+    def unpack(self, type, hash, target_dir, unsafe_mode, strip, overwrite=False):
         infile = self.open_file(type, hash)
         with infile:
             if type == 'files':
                 if strip != 0:
                     raise NotImplementedError('unpacking with git does not support strip != 0')
                 files = hdist_unpack(infile, 'files:%s' % hash)
-                scatter_files(files, target_dir)
+                scatter_files(files, target_dir, overwrite)
             else:
                 tar_cmd = list(self.archive_types[type][1])
                 if strip != 0:
@@ -706,11 +711,13 @@ def hdist_unpack(stream, key):
         raise CorruptSourceCacheError('hdist-pack does not match key "%s"' % key)
     return files
         
-def scatter_files(files, target_dir):
+def scatter_files(files, target_dir, overwrite=False):
     """
     Given a list of filenames and their contents, write them to the file system.
 
-    Will not overwrite files (raises an OSError(errno.EEXIST)).
+    Will not overwrite files (raises an OSError(errno.EEXIST)) unless
+    `overwrite` is set, in which case files already having the right
+    contents are left untouched.
 
     This is typically used together with :func:`hdist_unpack`.
 
@@ -731,6 +738,9 @@ def scatter_files(files, target_dir):
             os.makedirs(dirname)
             existing_dir_cache.add(dirname)
 
+        if overwrite:
+            write_if_changed(pjoin(dirname, basename), contents, 0600)
+            continue
         # IIUC in Python 3.3+ one can do this with the 'x' file mode, but need to do it
         # ourselves currently
         fd = os.open(pjoin(dirname, basename), os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0600)
@@ -2,7 +2,7 @@ from nose.tools import eq_
 
 from .utils import temp_working_dir
 
-from ..ant_glob import ant_iglob
+from ..ant_glob import ant_iglob, ant_iglob_many, expand_braces, PathMatcher
 
 import os
 from os.path import join as pjoin
@@ -48,3 +48,68 @@ def test_dirs():
         eq_(['a0', 'b0', 'c0'], sorted(ant_iglob('*')))
         eq_([], sorted(ant_iglob('*', include_dirs=False)))
 
+
+def test_many():
+    with temp_working_dir() as d:
+        makefiles('a0/b0/f a0/b0/g a0/b1/f a1/f'.split())
+        listings = {}
+        listed_dirs = set()
+        eq_(['a0/b0/f', 'a0/b0/g', 'a0/b1/f', 'a1/f'],
+            sorted(ant_iglob_many(['a0/b0/f', 'a0/*/f', 'a0/b0/*', 'a1/f', 'a1/missing',
+                                   'missing/f'],
+                                  listed_dirs=listed_dirs, listings=listings)))
+        # literal components are looked up without listing their directory
+        eq_(['a0', 'a0/b0'], sorted(listings.keys()))
+        eq_(['.', 'a0', 'a0/b0', 'a0/b1', 'a1'], sorted(listed_dirs))
+        # listings are reused
+        listings['a0/b0'] = ['f']
+        eq_(['a0/b0/f'], sorted(ant_iglob('a0/b0/*', listings=listings)))
+        # absolute and relative patterns together
+        eq_([pjoin(d, 'a1/f'), 'a0/b1/f'],
+            sorted(ant_iglob_many([pjoin(d, 'a1/f'), 'a0/b1/*'])))
+
+def test_syntax():
+    with temp_working_dir() as d:
+        makefiles('lib/libz.a lib/libz.so lib/libm.so.6 lib/libbz2.so lib/x.txt'.split())
+        def check(expected, pattern):
+            eq_(sorted(expected), sorted(ant_iglob(pattern)))
+        yield check, ['lib/libz.a', 'lib/libz.so', 'lib/libm.so.6'], 'lib/lib?.*'
+        yield check, ['lib/libz.a', 'lib/libz.so'], 'lib/lib[xyz].*'
+        yield check, ['lib/libm.so.6'], 'lib/lib[!xyz].*'
+        yield check, ['lib/libz.a', 'lib/libm.so.6'], 'lib/lib?.{a,so.*}'
+        yield check, ['lib/libz.so', 'lib/libbz2.so', 'lib/x.txt'], '{lib/lib{z,bz2}.so,**/*.txt}'
+
+def test_literal_paths():
+    with temp_working_dir() as d:
+        makefiles(['include/foo[1].h', 'include/foo1.h', 'share/a{b}', 'share/ab', 'x?y'])
+        eq_(['include/foo[1].h'], list(ant_iglob('include/foo[1].h')))
+        eq_([pjoin(d, 'share/a{b}')], list(ant_iglob(pjoin(d, 'share/a{b}'))))
+        eq_(['x?y'], list(ant_iglob('x?y')))
+        # patterns that are not existing paths are still globbed
+        eq_(['include/foo1.h'], list(ant_iglob('include/foo[1].h*')))
+        eq_(['share/ab'], list(ant_iglob('share/a{b,c}')))
+
+def test_expand_braces():
+    eq_(['a', 'b'], expand_braces('{a,b}'))
+    eq_(['xa1', 'xa2', 'xb1', 'xb2'], expand_braces('x{a,b}{1,2}'))
+    eq_(['a/c', 'a/d', 'b'], expand_braces('{a/{c,d},b}'))
+    eq_(['{a,b'], expand_braces('{a,b'))
+
+def test_exclude():
+    with temp_working_dir() as d:
+        makefiles('a/f.txt a/g.txt a/big/x.txt a/big/deep/y.txt b/f.txt'.split())
+        exclude = PathMatcher()
+        exclude.add('a/big/**')
+        exclude.add('**/g.txt')
+        exclude.add_path('b/f.txt')
+        listed_dirs = set()
+        eq_(['a/f.txt'], sorted(ant_iglob('**/*.txt', listed_dirs=listed_dirs, exclude=exclude)))
+        # the excluded tree was not walked
+        eq_(['.', 'a', 'b'], sorted(listed_dirs))
+        assert exclude.match('a/big/deep/y.txt')
+        assert exclude.match('a/big/deep', is_dir=True)
+        assert not exclude.match('a/big', is_dir=True)
+        # directories are only matched by patterns that include them
+        exclude.add('c/*', include_dirs=False)
+        assert exclude.match('c/f')
+        assert not exclude.match('c/d', is_dir=True)
@@ -0,0 +1,256 @@
+import os
+from os.path import join as pjoin
+import functools
+import contextlib
+import tempfile
+import shutil
+import threading
+import json
+import tarfile
+import SimpleHTTPServer
+import SocketServer
+
+from nose.tools import eq_, assert_raises
+
+from StringIO import StringIO
+
+from ...hdist_logging import Logger, INFO
+from .utils import logger
+from .. import build_store, artifact_cache, relocate
+
+
+def make_store(tempdir, name, cache_url, logger=logger):
+    root = pjoin(tempdir, name)
+    config = {
+        'builder/artifacts': pjoin(root, 'opt'),
+        'builder/build-temp': pjoin(root, 'bld'),
+        'global/db': pjoin(root, 'db'),
+        'builder/artifact-dir-pattern': '{name}/{shorthash}',
+        'builder/artifact-cache': cache_url,
+        }
+    bldr = build_store.BuildStore.create_from_config(config, logger, create_dirs=True)
+    return bldr, config
+
+def capturing_logger():
+    stream = StringIO()
+    return Logger(INFO, streams=[(stream, False)]), stream
+
+def fixture(func):
+    @functools.wraps(func)
+    def decorated():
+        tempdir = tempfile.mkdtemp()
+        try:
+            os.mkdir(pjoin(tempdir, 'cache'))
+            return func(tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+    return decorated
+
+def make_spec(script):
+    return {"name": "foo", "version": "na",
+            "build": {"script": [["/bin/sh", "-c", "PATH=/bin:/usr/bin; " + script]]}}
+
+relocatable_spec = make_spec(
+    'mkdir $ARTIFACT/bin && echo "#!$ARTIFACT/bin/python" > $ARTIFACT/bin/script && '
+    'ln -s $ARTIFACT/bin/script $ARTIFACT/link')
+
+@fixture
+def test_directory_cache(tempdir):
+    cache_dir = pjoin(tempdir, 'cache')
+    a, a_config = make_store(tempdir, 'a', cache_dir)
+    artifact_id, a_dir = a.ensure_present(relocatable_spec, a_config)
+    name, digest = artifact_id.split('/')
+    with open(pjoin(cache_dir, name, digest + '.json')) as f:
+        manifest = json.load(f)
+    eq_(a_dir, manifest['artifact_dir'])
+    eq_(artifact_cache.file_sha256(pjoin(cache_dir, name, digest + '.tar.gz')),
+        manifest['sha256'])
+
+    b_logger, log = capturing_logger()
+    b, b_config = make_store(tempdir, 'b', 'file:' + cache_dir, b_logger)
+    b_id, b_dir = b.ensure_present(relocatable_spec, b_config)
+    eq_(artifact_id, b_id)
+    assert b_dir.startswith(pjoin(tempdir, 'b'))
+    assert 'Downloading %s from artifact cache' % artifact_id in log.getvalue()
+    assert 'Building' not in log.getvalue()
+    with open(pjoin(b_dir, 'bin', 'script')) as f:
+        eq_('#!%s/bin/python\n' % b_dir, f.read())
+    eq_(pjoin(b_dir, 'bin', 'script'), os.readlink(pjoin(b_dir, 'link')))
+    eq_(b_dir, b.resolve(artifact_id))
+
+@fixture
+def test_binary_relocation(tempdir):
+    cache_dir = pjoin(tempdir, 'cache')
+    spec = make_spec('printf "\\000$ARTIFACT/lib\\000" > $ARTIFACT/binary')
+    a, a_config = make_store(tempdir, 'a', cache_dir)
+    a_id, a_dir = a.ensure_present(spec, a_config)
+    # same length
+    b, b_config = make_store(tempdir, 'b', cache_dir)
+    b_id, b_dir = b.ensure_present(spec, b_config)
+    with open(pjoin(b_dir, 'binary')) as f:
+        eq_('\0%s/lib\0' % b_dir, f.read())
+    # longer path does not fit
+    c_logger, log = capturing_logger()
+    c, c_config = make_store(tempdir, 'longer', cache_dir, c_logger)
+    c_id, c_dir = c.ensure_present(spec, c_config)
+    assert 'building from source' in log.getvalue()
+    with open(pjoin(c_dir, 'binary')) as f:
+        eq_('\0%s/lib\0' % c_dir, f.read())
+
+@fixture
+def test_relocation_error(tempdir):
+    cache_dir = pjoin(tempdir, 'cache')
+    a, a_config = make_store(tempdir, 'a', cache_dir)
+    a.ensure_present(relocatable_spec, a_config)
+
+    def failing_relocate(*args):
+        raise relocate.RelocationError('corrupt relocation table')
+    old_relocate = artifact_cache.relocate_artifact
+    artifact_cache.relocate_artifact = failing_relocate
+    try:
+        b_logger, log = capturing_logger()
+        b, b_config = make_store(tempdir, 'b', cache_dir, b_logger)
+        b_id, b_dir = b.ensure_present(relocatable_spec, b_config)
+    finally:
+        artifact_cache.relocate_artifact = old_relocate
+    assert 'corrupt relocation table; building from source' in log.getvalue()
+    with open(pjoin(b_dir, 'bin', 'script')) as f:
+        eq_('#!%s/bin/python\n' % b_dir, f.read())
+
+def make_tarball(filename, members):
+    with tarfile.open(filename, 'w:gz') as tar:
+        for name, kind, arg in members:
+            info = tarfile.TarInfo(name)
+            if kind == 'file':
+                info.size = len(arg)
+                tar.addfile(info, StringIO(arg))
+            else:
+                info.type = {'symlink': tarfile.SYMTYPE, 'hardlink': tarfile.LNKTYPE}[kind]
+                info.linkname = arg
+                tar.addfile(info)
+
+@fixture
+def test_unpack_unsafe(tempdir):
+    outside = pjoin(tempdir, 'outside')
+    os.mkdir(outside)
+    tarball = pjoin(tempdir, 'x.tar.gz')
+    for members in [
+        [('../x', 'file', 'x')],
+        [('/tmp/x', 'file', 'x')],
+        # writing through a symlink, to a directory or a file
+        [('lib', 'symlink', outside), ('lib/x', 'file', 'x')],
+        [('lib', 'symlink', '../outside'), ('lib/x', 'file', 'x')],
+        [('x', 'symlink', pjoin(outside, 'x')), ('x', 'file', 'x')],
+        [('lib', 'symlink', outside), ('x', 'hardlink', 'lib/x')],
+        ]:
+        make_tarball(tarball, members)
+        artifact_dir = tempfile.mkdtemp(dir=tempdir)
+        assert_raises(artifact_cache.ArtifactCacheError, artifact_cache.unpack_artifact,
+                      tarball, artifact_dir)
+        eq_([], os.listdir(outside))
+
+    # symlinks are fine as long as nothing is written through them
+    make_tarball(tarball, [('lib', 'symlink', '/usr/lib'), ('a/x', 'file', 'x'),
+                           ('a/y', 'hardlink', 'a/x')])
+    artifact_dir = tempfile.mkdtemp(dir=tempdir)
+    artifact_cache.unpack_artifact(tarball, artifact_dir)
+    eq_('/usr/lib', os.readlink(pjoin(artifact_dir, 'lib')))
+    eq_(os.stat(pjoin(artifact_dir, 'a', 'x')).st_ino, os.stat(pjoin(artifact_dir, 'a', 'y')).st_ino)
+
+@fixture
+def test_unsafe_tarball_in_cache(tempdir):
+    cache_dir = pjoin(tempdir, 'cache')
+    artifact_id = build_store.as_build_spec(relocatable_spec).artifact_id
+    name, digest = artifact_id.split('/')
+    os.makedirs(pjoin(cache_dir, name))
+    for members in [[('../escape', 'file', 'x')], None]:
+        tarball = pjoin(cache_dir, name, digest + '.tar.gz')
+        if members is None:
+            # corrupt archive
+            with open(tarball, 'w') as f:
+                f.write('not a tarball')
+        else:
+            make_tarball(tarball, members)
+        with open(pjoin(cache_dir, name, digest + '.json'), 'w') as f:
+            json.dump({'artifact_id': artifact_id, 'artifact_dir': '/nonexisting',
+                       'sha256': artifact_cache.file_sha256(tarball),
+                       'size': os.stat(tarball).st_size}, f)
+        b_logger, log = capturing_logger()
+        b, b_config = make_store(tempdir, 'b%d' % len(members or []), cache_dir, b_logger)
+        b_id, b_dir = b.ensure_present(relocatable_spec, b_config)
+        assert 'building from source' in log.getvalue()
+        with open(pjoin(b_dir, 'bin', 'script')) as f:
+            eq_('#!%s/bin/python\n' % b_dir, f.read())
+    assert not os.path.exists(pjoin(tempdir, 'escape'))
+
+class QuietHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class PutHandler(QuietHandler):
+    def do_PUT(self):
+        path = self.translate_path(self.path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        remaining = int(self.headers['Content-Length'])
+        with open(path, 'wb') as f:
+            while remaining > 0:
+                chunk = self.rfile.read(min(remaining, 65536))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        self.send_response(201)
+        self.end_headers()
+
+@contextlib.contextmanager
+def serving(directory, handler):
+    """Serves `directory` over HTTP; yields the URL"""
+    old_cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        server = SocketServer.TCPServer(('127.0.0.1', 0), handler)
+    finally:
+        os.chdir(old_cwd)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        # SimpleHTTPServer serves relative to the process cwd
+        os.chdir(directory)
+        yield 'http://127.0.0.1:%d/' % server.server_address[1]
+    finally:
+        os.chdir(old_cwd)
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+@fixture
+def test_http_cache(tempdir):
+    cache_dir = pjoin(tempdir, 'cache')
+    a, a_config = make_store(tempdir, 'a', cache_dir)
+    artifact_id, a_dir = a.ensure_present(relocatable_spec, a_config)
+
+    with serving(cache_dir, QuietHandler) as url:
+        b_logger, log = capturing_logger()
+        b, b_config = make_store(tempdir, 'b', url, b_logger)
+        b_id, b_dir = b.ensure_present(relocatable_spec, b_config)
+        with open(pjoin(b_dir, 'bin', 'script')) as f:
+            eq_('#!%s/bin/python\n' % b_dir, f.read())
+
+        # not in cache; build, and fail to upload (no PUT support) with a warning
+        c_id, c_dir = b.ensure_present(make_spec('true'), b_config)
+        assert 'Could not upload %s' % c_id in log.getvalue()
+
+@fixture
+def test_http_upload(tempdir):
+    cache_dir = pjoin(tempdir, 'cache')
+    with serving(cache_dir, PutHandler) as url:
+        a_logger, log = capturing_logger()
+        a, a_config = make_store(tempdir, 'a', url, a_logger)
+        artifact_id, a_dir = a.ensure_present(relocatable_spec, a_config)
+    assert 'Could not upload' not in log.getvalue()
+    name, digest = artifact_id.split('/')
+    with open(pjoin(cache_dir, name, digest + '.json')) as f:
+        manifest = json.load(f)
+    eq_(artifact_cache.file_sha256(pjoin(cache_dir, name, digest + '.tar.gz')),
+        manifest['sha256'])
@@ -0,0 +1,62 @@
+import os
+from os.path import join as pjoin
+import gzip
+import json
+
+from nose.tools import eq_
+
+from .utils import temp_dir
+from .. import block_gzip
+
+
+def make_log(n):
+    return ''.join('line %d: compiling file%d.c\n' % (i, i) for i in range(1, n + 1))
+
+def test_roundtrip():
+    text = make_log(5000) + 'ERROR: undefined reference to `frobnicate\'\n' + make_log(10)
+    with temp_dir() as d:
+        filename = pjoin(d, 'build.log.gz')
+        with block_gzip.BlockGzipWriter(filename, block_size=4096) as f:
+            # uneven writes, not aligned with lines
+            for i in range(0, len(text), 1000):
+                f.write(text[i:i + 1000])
+        # a plain gzip file
+        with gzip.open(filename) as f:
+            eq_(text, f.read())
+
+        with open(pjoin(d, 'build.log.idx')) as f:
+            index = json.load(f)
+        blocks = index['blocks']
+        assert len(blocks) > 10
+        # blocks end at line boundaries
+        chunks = [chunk for first_line, chunk in block_gzip.iter_blocks(filename)]
+        eq_(text, ''.join(chunks))
+        assert all(chunk.endswith('\n') for chunk in chunks)
+        eq_([block['line'] for block in blocks],
+            [1 + sum(chunk.count('\n') for chunk in chunks[:i]) for i in range(len(chunks))])
+
+        eq_([(5001, 'ERROR: undefined reference to `frobnicate\'')],
+            list(block_gzip.grep(filename, 'undefined reference')))
+        eq_([(5001, 'ERROR: undefined reference to `frobnicate\'')],
+            list(block_gzip.grep(filename, 'error:', ignore_case=True)))
+        eq_([], list(block_gzip.grep(filename, 'error:')))
+        eq_([(123, 'line 123: compiling file123.c')],
+            list(block_gzip.grep(filename, 'file123.c')))
+        # only the block with the match needs to be decompressed
+        eq_(1, len(list(block_gzip.iter_blocks(filename, 'frobnicate'))))
+
+def test_long_lines():
+    text = 'x' * 20000 + '\n' + 'y' * 100 + '\n' + 'z' * 5000
+    with temp_dir() as d:
+        filename = pjoin(d, 'build.log.gz')
+        with block_gzip.BlockGzipWriter(filename, block_size=4096) as f:
+            f.write(text)
+        eq_(text, ''.join(chunk for first_line, chunk in block_gzip.iter_blocks(filename)))
+        eq_([(2, 'y' * 100)], list(block_gzip.grep(filename, 'yyy')))
+
+def test_no_index():
+    with temp_dir() as d:
+        filename = pjoin(d, 'build.log.gz')
+        with gzip.open(filename, 'wb') as f:
+            f.write(make_log(10))
+        eq_([(3, 'line 3: compiling file3.c')], list(block_gzip.grep(filename, 'file3.')))
@@ -7,6 +7,7 @@ from textwrap import dedent
 from pprint import pprint
 import gzip
 import json
+import fcntl
 
 from nose.tools import assert_raises, eq_
 from nose import SkipTest
@@ -14,6 +15,7 @@ from nose import SkipTest
 from .utils import logger, temp_dir, temp_working_dir
 from . import utils
 
+from ..cache import DiskCache
 from .. import source_cache, build_store, InvalidBuildSpecError, BuildFailedError, InvalidJobSpecError
 from ..common import SHORT_ARTIFACT_ID_LEN
 
@@ -120,7 +122,9 @@ def test_basic(tempdir, sc, bldr, config):
     assert not bldr.is_present(spec)
     name, path = bldr.ensure_present(spec, config)
     assert bldr.is_present(spec)
-    assert ['bar', 'build.json', 'build.log.gz', 'hello'] == sorted(os.listdir(path))
+    assert (['bar', 'build-timings.json', 'build.json', 'build.log.gz', 'build.log.idx',
+             'hello', 'relocations.json'] ==
+            sorted(os.listdir(path)))
     with file(pjoin(path, 'hello')) as f:
         got = sorted(f.readlines())
         assert ''.join(got) == dedent('''\
@@ -141,6 +145,77 @@ def test_basic(tempdir, sc, bldr, config):
     with file(pjoin(path, 'bar', 'foo')) as f:
         assert f.read() == 'foobarfoo'
 
+    # timings
+    with file(pjoin(path, 'build-timings.json')) as f:
+        timings = json.load(f)
+    assert timings['artifact_id'] == name
+    eq_(['script', 'compress-log', 'relocations'],
+        [step['name'] for step in timings['steps']])
+    commands = timings['steps'][0]['steps']
+    eq_(['/bin/bash', 'build.sh'], commands[2]['command'])
+    assert all(step['wall'] >= 0 for step in commands)
+
+
+@fixture()
+def test_import_layout(tempdir, sc, bldr, config):
+    spec = {"name": "foo", "version": "na",
+            "build": {"script": [["/bin/mkdir", "-p", "$ARTIFACT/bin", "$ARTIFACT/lib64"]]}}
+    artifact_id, path = bldr.ensure_present(spec, config)
+    expected = {'bin': True, 'include': False, 'libdirs': ['lib64']}
+    layout_filename = bldr._get_artifact_link(artifact_id) + build_store.IMPORT_LAYOUT_SUFFIX
+    with file(layout_filename) as f:
+        eq_(expected, json.load(f))
+    eq_(expected, bldr.get_import_layout(artifact_id, path))
+    # artifacts registered without a layout record are probed
+    os.unlink(layout_filename)
+    eq_(expected, bldr.get_import_layout(artifact_id, path))
+
+@fixture()
+def test_artifact_index(tempdir, sc, bldr, config):
+    spec = {"name": "foo", "version": "na", "build": {"script": []}}
+    artifact_id, path = bldr.ensure_present(spec, config)
+    eq_(path, bldr.resolve(artifact_id))
+    # artifacts registered by another BuildStore are found through the link
+    other = build_store.BuildStore.create_from_config(config, logger)
+    other.load_index()
+    assert os.path.exists(other.index_filename)
+    spec2 = {"name": "bar", "version": "na", "build": {"script": []}}
+    artifact_id2, path2 = bldr.ensure_present(spec2, config)
+    eq_(path2, other.resolve(artifact_id2))
+    # snapshot is used by a fresh BuildStore (shard mtimes are too recent
+    # to be trusted, so force it)
+    with file(other.index_filename) as f:
+        doc = json.load(f)
+    for shard in doc['shards']:
+        doc['shards'][shard]['mtime'] = os.stat(pjoin(bldr.ba_db_dir, shard)).st_mtime
+    doc['shards'][bldr._get_artifact_link(artifact_id).split(os.sep)[-2]]['entries'].clear()
+    with file(other.index_filename, 'w') as f:
+        json.dump(doc, f)
+    fresh = build_store.BuildStore.create_from_config(config, logger)
+    eq_(path, fresh.resolve(artifact_id))
+    # a single lookup reads the link rather than loading the shard
+    eq_({}, fresh._index_shards)
+    fresh.load_index()
+    eq_(path, fresh.resolve(artifact_id)) # miss in snapshot falls back to link
+    # manual removal is healed even if indexed
+    shutil.rmtree(path)
+    assert other.resolve(artifact_id) is None
+    assert not os.path.lexists(bldr._get_artifact_link(artifact_id))
+
+@fixture()
+def test_status_many(tempdir, sc, bldr, config):
+    spec = {"name": "foo", "version": "na", "build": {"script": []}}
+    missing_spec = {"name": "foo", "version": "nb", "build": {"script": []}}
+    artifact_id, path = bldr.ensure_present(spec, config)
+    missing_id = build_store.as_build_spec(missing_spec).artifact_id
+    eq_({artifact_id: True, missing_id: False}, bldr.status_many([spec, missing_id]))
+    # registered by another BuildStore after the shard has been indexed
+    other = build_store.BuildStore.create_from_config(config, logger)
+    eq_({missing_id: False}, other.status_many([missing_id]))
+    bldr.ensure_present(missing_spec, config)
+    eq_({artifact_id: True, missing_id: True}, other.status_many([artifact_id, missing_id]))
+    shutil.rmtree(path)
+    eq_({artifact_id: False}, other.status_many([artifact_id]))
 
 @fixture()
 def test_failing_build_and_multiple_commands(tempdir, sc, bldr, config):
@@ -239,6 +314,141 @@ def test_source_unpack_options(tempdir, sc, bldr, config):
     with file(pjoin(path, 'b')) as f:
         assert f.read() == "Welcome!"
 
+@fixture()
+def test_build_roots(tempdir, sc, bldr, config):
+    fast_root = pjoin(tempdir, 'fast')
+    bldr = build_store.BuildStore.create_from_config(
+        config, logger, build_roots=[fast_root, pjoin(tempdir, 'missing', 'fast')],
+        cache=DiskCache(pjoin(tempdir, 'cache')))
+    eq_([fast_root, pjoin(tempdir, 'missing', 'fast'), pjoin(tempdir, 'bld')],
+        bldr.get_build_roots())
+
+    def build(n):
+        spec = {"name": "foo", "version": "na",
+                "build": {"script": [["/bin/sh", "-c", "echo $BUILD > $ARTIFACT/build_dir"],
+                                     ["/bin/sh", "-c", "echo %d" % n]]}}
+        artifact_id, path = bldr.ensure_present(spec, config)
+        with file(pjoin(path, 'build_dir')) as f:
+            return os.path.dirname(f.read().strip()), build_store.BuildSpec(spec)
+
+    # never built, assumed to fit
+    root, spec = build(0)
+    eq_(fast_root, root)
+    estimate = bldr.estimate_build_size(spec)
+    assert 0 < estimate < build_store.DEFAULT_BUILD_SIZE_ESTIMATE
+
+    # does not fit anywhere but the default build dir
+    bldr.record_build_size(spec, 2**62)
+    root, spec = build(1)
+    eq_(pjoin(tempdir, 'bld'), root)
+
+    os.mkdir(pjoin(fast_root, 'leftover'))
+    bldr.delete_all()
+    eq_([], os.listdir(fast_root))
+
+@fixture()
+def test_build_size_not_measured_with_one_root(tempdir, sc, bldr, config):
+    spec = {"name": "foo", "version": "na",
+            "build": {"script": [["/bin/sh", "-c", "echo x > $BUILD/x"]]}}
+    bldr.ensure_present(spec, config)
+    eq_(build_store.DEFAULT_BUILD_SIZE_ESTIMATE,
+        bldr.estimate_build_size(build_store.BuildSpec(spec)))
+
+@fixture()
+def test_delete_all(tempdir, sc, bldr, config):
+    ids = []
+    for i in range(3):
+        spec = {"name": "foo%d" % i, "version": "na",
+                "build": {"script": [["/bin/sh", "-c", "echo %d > $ARTIFACT/x" % i]]}}
+        ids.append(bldr.ensure_present(spec, config, keep_build='always'))
+    # leftovers of an interrupted earlier run
+    os.makedirs(pjoin(tempdir, 'opt', '.trash', 'tmp1234', '0', 'foo'))
+    assert len(os.listdir(pjoin(tempdir, 'bld'))) == 3
+
+    freed = bldr.delete_all(jobs=2)
+    assert freed > 0
+    for artifact_id, path in ids:
+        assert bldr.resolve(artifact_id) is None
+        assert not os.path.exists(path)
+    eq_([], os.listdir(pjoin(tempdir, 'bld')))
+    eq_([], os.listdir(pjoin(tempdir, 'db', 'artifacts')))
+    eq_(['foo0', 'foo1', 'foo2'], sorted(os.listdir(pjoin(tempdir, 'opt'))))
+    eq_(['artifacts', 'locks'], sorted(os.listdir(pjoin(tempdir, 'db'))))
+
+@fixture()
+def test_dedup(tempdir, sc, bldr, config):
+    bldr = build_store.BuildStore.create_from_config(config, logger, dedup=True)
+    paths = []
+    for version in ['1', '2']:
+        spec = {"name": "foo", "version": version,
+                "build": {"script": [["/bin/sh", "-c",
+                                      "echo hello > $ARTIFACT/x; /bin/chmod a-w $ARTIFACT/x"]]}}
+        artifact_id, path = bldr.ensure_present(spec, config)
+        paths.append(path)
+    eq_(os.stat(pjoin(paths[0], 'x')).st_ino, os.stat(pjoin(paths[1], 'x')).st_ino)
+    eq_(0, bldr.dedup_store())
+    bldr.delete_all()
+    eq_(['foo'], os.listdir(pjoin(tempdir, 'opt')))
+
+@fixture()
+def test_incremental_build(tempdir, sc, bldr, config):
+    def build(script):
+        script_key = sc.put({'build.sh': script})
+        spec = {"name": "foo", "version": "na",
+                "sources": [{"target": ".", "key": script_key}],
+                "files": [{"target": "unchanged", "text": ["same"]}],
+                "build": {
+                    "script": [
+                        ["hdist", "build-unpack-sources"],
+                        ["hdist", "build-write-files"],
+                        ["/bin/bash", "build.sh"]
+                    ]
+                }}
+        return bldr.ensure_present(spec, config, incremental=True)
+
+    script = dedent("""\
+    /bin/echo -n x >> counter
+    /bin/cp counter ${ARTIFACT}/counter
+    /usr/bin/stat -c %Y unchanged > ${ARTIFACT}/mtime
+    """)
+    first_id, first_path = build(script)
+    build_dir = pjoin(tempdir, 'bld', 'foo-na-incremental')
+    assert os.path.exists(pjoin(build_dir, 'counter'))
+    with file(pjoin(first_path, 'build-flags.json')) as f:
+        eq_({'incremental': True, 'reproducible': False, 'build_dir': build_dir}, json.load(f))
+
+    os.utime(pjoin(build_dir, 'unchanged'), (0, 0))
+    second_id, second_path = build(script + 'true\n')
+    assert first_id != second_id
+    with file(pjoin(second_path, 'counter')) as f:
+        eq_('xx', f.read())
+    with file(pjoin(second_path, 'mtime')) as f:
+        eq_('0', f.read().strip())
+
+    # a build that is not incremental does not accept the artifact
+    spec = json.load(file(pjoin(second_path, 'build.json')))
+    third_id, third_path = bldr.ensure_present(spec, config)
+    eq_(second_id, third_id)
+    assert not os.path.exists(pjoin(third_path, 'build-flags.json'))
+    with file(pjoin(third_path, 'counter')) as f:
+        eq_('x', f.read())
+    eq_(third_path, bldr.resolve(third_id))
+    # but an incremental one does
+    eq_((third_id, third_path), build(script + 'true\n'))
+
+@fixture()
+def test_incremental_build_lock(tempdir, sc, bldr, config):
+    # the lock is on the shared build directory, not on the spec
+    for doc in [{"name": "foo", "version": "na", "build": {"script": []}},
+                {"name": "foo", "version": "na", "build": {"script": [["true"]]}}]:
+        with bldr.incremental_build_lock(build_store.as_build_spec(doc)):
+            fd = os.open(pjoin(bldr.locks_dir, 'foo-na-incremental.lock'), os.O_RDWR)
+            try:
+                with assert_raises(IOError):
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            finally:
+                os.close(fd)
+
 
 # To test more complex relationship with packages we need to automate a bit:
 
@@ -0,0 +1,133 @@
+"""
+Stress test of concurrent builds in one build store.
+
+Running this module directly runs a larger benchmark and prints
+throughput numbers::
+
+    python -m hashdist.core.test.test_build_store_concurrency --procs 8 --specs 200
+
+"""
+import os
+from os.path import join as pjoin
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+from StringIO import StringIO
+
+from nose.tools import eq_
+
+from ...hdist_logging import Logger, INFO
+from .. import build_store
+
+
+def make_config(tempdir):
+    return {
+        'builder/artifacts': pjoin(tempdir, 'opt'),
+        'builder/build-temp': pjoin(tempdir, 'bld'),
+        'global/db': pjoin(tempdir, 'db'),
+        'builder/artifact-dir-pattern': '{name}/{shorthash}',
+        }
+
+def make_spec(tempdir, i, build_time):
+    # every build appends to a file outside of the store so that
+    # duplicated builds can be counted
+    script = ('echo built >> %s/count-%d; /bin/sleep %s; echo %d > $ARTIFACT/result' %
+              (tempdir, i, build_time, i))
+    return {"name": "spec%d" % i, "version": "na",
+            "build": {"script": [["/bin/sh", "-c", script]]}}
+
+def _worker(args):
+    tempdir, worker, indices, build_time = args
+    logger = Logger(INFO, streams=[(StringIO(), False)])
+    config = make_config(tempdir)
+    bldr = build_store.BuildStore.create_from_config(config, logger)
+    results = []
+    for i in indices:
+        artifact_id, path = bldr.ensure_present(make_spec(tempdir, i, build_time), config)
+        results.append((i, artifact_id, path))
+    return results
+
+def run_stress(tempdir, nprocs, nspecs, build_time=0):
+    """Runs `nprocs` processes each building all `nspecs` specs (in
+    different orders), and checks that the store ends up consistent
+
+    Returns a dict of statistics.
+    """
+    config = make_config(tempdir)
+    build_store.BuildStore.create_from_config(config, Logger(INFO, streams=[]),
+                                              create_dirs=True)
+    tasks = []
+    for worker in range(nprocs):
+        # overlapping, differently ordered sequences of specs
+        indices = range(nspecs)
+        shift = worker * nspecs // nprocs
+        indices = indices[shift:] + indices[:shift]
+        if worker % 2:
+            indices.reverse()
+        tasks.append((tempdir, worker, indices, build_time))
+    pool = multiprocessing.Pool(nprocs)
+    t0 = time.time()
+    try:
+        results = pool.map(_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    wall = time.time() - t0
+
+    # everybody got the same artifact dir for each spec
+    paths = {}
+    for worker_results in results:
+        for i, artifact_id, path in worker_results:
+            eq_(paths.setdefault(i, path), path)
+            with open(pjoin(path, 'result')) as f:
+                eq_(str(i), f.read().strip())
+
+    # each spec was built exactly once
+    builds = 0
+    for i in range(nspecs):
+        with open(pjoin(tempdir, 'count-%d' % i)) as f:
+            n = len(f.readlines())
+        eq_(1, n, 'spec%d built %d times' % (i, n))
+        builds += n
+
+    # no orphaned artifact or build dirs, and no lock files left
+    artifact_dirs = set()
+    for name in os.listdir(pjoin(tempdir, 'opt')):
+        for shorthash in os.listdir(pjoin(tempdir, 'opt', name)):
+            artifact_dirs.add(pjoin(tempdir, 'opt', name, shorthash))
+    eq_(set(paths.values()), artifact_dirs)
+    eq_([], os.listdir(pjoin(tempdir, 'bld')))
+    eq_([], os.listdir(pjoin(tempdir, 'db', build_store.LOCKS_DIRNAME)))
+
+    requests = nprocs * nspecs
+    return {'wall': wall, 'builds': builds, 'requests': requests,
+            'builds_per_s': builds / wall, 'requests_per_s': requests / wall}
+
+def test_concurrent_ensure_present():
+    tempdir = tempfile.mkdtemp()
+    try:
+        stats = run_stress(tempdir, nprocs=4, nspecs=8, build_time=0.05)
+        eq_(8, stats['builds'])
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='Benchmark concurrent builds in a build store')
+    ap.add_argument('--procs', type=int, default=8)
+    ap.add_argument('--specs', type=int, default=100)
+    ap.add_argument('--build-time', type=float, default=0,
+                    help='seconds each build sleeps')
+    ap.add_argument('--dir', help='where to put the store (default: a temporary dir)')
+    args = ap.parse_args()
+    tempdir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        stats = run_stress(tempdir, args.procs, args.specs, args.build_time)
+    finally:
+        shutil.rmtree(tempdir)
+    sys.stdout.write('%d processes, %d specs: %.2f s\n' % (args.procs, args.specs, stats['wall']))
+    sys.stdout.write('  %.1f builds/s, %.1f ensure_present calls/s\n' %
+                     (stats['builds_per_s'], stats['requests_per_s']))
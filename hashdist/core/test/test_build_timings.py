@@ -0,0 +1,44 @@
+import time
+
+from nose.tools import assert_raises, eq_
+
+from ..build_timings import BuildTimings, find_critical_path
+
+def test_nested_steps():
+    timings = BuildTimings()
+    with timings.step('outer', x=1):
+        with timings.step('inner'):
+            time.sleep(0.01)
+    try:
+        with timings.step('failing'):
+            raise ValueError()
+    except ValueError:
+        pass
+    outer, failing = timings.steps
+    eq_('outer', outer['name'])
+    eq_(1, outer['x'])
+    eq_(['inner'], [step['name'] for step in outer['steps']])
+    assert outer['wall'] >= outer['steps'][0]['wall'] >= 0.01
+    assert failing['failed']
+    assert 'failed' not in outer
+    doc = timings.as_document(artifact_id='foo/bar')
+    eq_('foo/bar', doc['artifact_id'])
+    eq_(outer['wall'] + failing['wall'], doc['wall'])
+
+def test_find_critical_path():
+    durations = {'libc': 1, 'gcc': 10, 'zlib': 2, 'python': 5, 'numpy': 3, 'hdf5': 20}
+    dependencies = {
+        'libc': [],
+        'gcc': ['libc'],
+        'zlib': ['gcc'],
+        'hdf5': ['zlib'],
+        'python': ['zlib'],
+        'numpy': ['python'],
+        }
+    eq_((33, ['libc', 'gcc', 'zlib', 'hdf5']), find_critical_path(durations, dependencies))
+    durations['numpy'] = 30
+    eq_((48, ['libc', 'gcc', 'zlib', 'python', 'numpy']),
+        find_critical_path(durations, dependencies))
+    eq_((0, []), find_critical_path({}, {}))
+    with assert_raises(ValueError):
+        find_critical_path({}, {'a': ['b'], 'b': ['a']})
@@ -8,7 +8,9 @@ from textwrap import dedent
 
 from nose.tools import assert_raises, eq_, ok_
 from .utils import (temp_working_dir, temp_working_dir_fixture,
-                    cat)
+                    cat, logger)
+from .test_build_store import fixture
+from .test_profile import make_links_artifact
 from ..fileutils import touch
 
 from .. import build_tools
@@ -119,3 +121,59 @@ def test_python_shebang(d):
             intp = runit(entry_point)
             assert "%s/my-python/bin/python" % d == intp
 
+
+@temp_working_dir_fixture
+def test_postprocess(d):
+    import marshal
+    for dirname in ['artifact/bin', 'artifact/lib/pkg', 'outside']:
+        makedirs(pjoin(d, dirname))
+    with open(pjoin(d, 'artifact', 'bin', 'script'), 'w') as f:
+        f.write('#!/usr/bin/env python\nprint 1\n')
+    os.chmod(pjoin(d, 'artifact', 'bin', 'script'), 0o755)
+    with open(pjoin(d, 'artifact', 'lib', 'pkg', 'mod.py'), 'w') as f:
+        f.write('x = 1\n')
+    with open(pjoin(d, 'artifact', 'lib', 'pkg', 'bad.py'), 'w') as f:
+        f.write('x = = 1\n')
+    with open(pjoin(d, 'outside', 'file'), 'w') as f:
+        f.write('x')
+    os.symlink(pjoin(d, 'outside', 'file'), pjoin(d, 'artifact', 'link'))
+    os.symlink(pjoin(d, 'artifact', 'lib'), pjoin(d, 'artifact', 'dirlink'))
+
+    files = build_tools.run_postprocess(pjoin(d, 'artifact'),
+                                        [build_tools.postprocess_write_protect], jobs=4)
+    kinds = dict((os.path.relpath(f.filename, pjoin(d, 'artifact')), f.kind) for f in files)
+    eq_({'bin/script': 'file', 'lib/pkg/mod.py': 'file', 'lib/pkg/bad.py': 'file',
+         'link': 'symlink', 'dirlink': 'symlink'}, kinds)
+    scripts = [f.filename for f in files if f.is_script]
+    eq_([pjoin(d, 'artifact', 'bin', 'script')], scripts)
+    eq_(0o555, os.stat(pjoin(d, 'artifact', 'bin', 'script')).st_mode & 0o777)
+    # symlinks are not followed
+    assert os.stat(pjoin(d, 'outside', 'file')).st_mode & 0o200
+
+    py_files = [f.filename for f in files if f.filename.endswith('.py')]
+    eq_(1, build_tools.compile_pyc_files(py_files, pjoin(d, 'artifact'), jobs=2, readonly=True))
+    pyc = pjoin(d, 'artifact', 'lib', 'pkg', 'mod.pyc')
+    assert not os.stat(pyc).st_mode & 0o222
+    with open(pyc, 'rb') as f:
+        f.read(8)
+        eq_('lib/pkg/mod.py', marshal.load(f).co_filename)
+    assert not os.path.exists(pjoin(d, 'artifact', 'lib', 'pkg', 'bad.pyc'))
+
+@fixture()
+def test_push_pop_build_profile(tempdir, sc, bldr, config):
+    a_id, a_dir = make_links_artifact(bldr, config, 'a', ['bin/a', 'bin/tool'])
+    target = pjoin(tempdir, 'artifact')
+    makedirs(pjoin(target, 'bin'))
+    with open(pjoin(target, 'bin', 'tool'), 'w') as f:
+        f.write('mine')
+    with open(pjoin(tempdir, 'build.json'), 'w') as f:
+        json.dump({'build': {'import': [{'id': a_id, 'before': []}]}}, f)
+    manifest = pjoin(tempdir, 'manifest.json')
+
+    build_tools.push_build_profile(config, logger, {}, pjoin(tempdir, 'build.json'),
+                                   manifest, target)
+    eq_(pjoin(a_dir, 'bin', 'a'), os.readlink(pjoin(target, 'bin', 'a')))
+    build_tools.pop_build_profile(manifest, target)
+    # the file that was there before is not claimed by the push
+    eq_(['tool'], os.listdir(pjoin(target, 'bin')))
+    eq_('mine', cat(pjoin(target, 'bin', 'tool')))
@@ -19,6 +19,7 @@ def test_ini():
 
         [builder]
         artifact-dir-pattern = ~/str
+        dedup = Yes
         ''')
     
     with temp_dir() as d:
@@ -32,4 +33,6 @@ def test_ini():
             assert cfg['global/cache'] == pjoin(d, 'subdir')
             assert cfg['global/db'] == os.path.expanduser('~/subdir')
             assert cfg['builder/artifact-dir-pattern'] == '~/str'
+            assert cfg['builder/dedup'] is True
+            assert cfg['builder/artifact-cache'] == ''
 
@@ -0,0 +1,64 @@
+import os
+from os.path import join as pjoin
+
+from nose.tools import eq_
+
+from .utils import temp_dir, logger
+from .. import dedup
+from ..fileutils import write_protect
+
+
+def make_file(path, contents, readonly=True):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(contents)
+    if readonly:
+        write_protect(path)
+
+def inode(path):
+    return os.lstat(path).st_ino
+
+def test_dedup_artifacts():
+    with temp_dir() as root:
+        a, b, c = [pjoin(root, x) for x in ['a', 'b', 'c']]
+        make_file(pjoin(a, 'include', 'foo.h'), 'shared header' * 1000)
+        make_file(pjoin(a, 'LICENSE'), 'license')
+        make_file(pjoin(a, 'writable'), 'same')
+        make_file(pjoin(b, 'foo.h'), 'shared header' * 1000)
+        make_file(pjoin(b, 'LICENSE'), 'license')
+        make_file(pjoin(b, 'writable'), 'same', readonly=False)
+        make_file(pjoin(b, 'other'), 'other')
+        make_file(pjoin(b, 'empty'), '')
+        os.symlink('LICENSE', pjoin(b, 'link'))
+        os.chmod(pjoin(b, 'other'), 0o555)
+
+        index = dedup.DedupIndex(root, logger)
+        saved = index.dedup_artifacts([a, b])
+        assert saved >= len('shared header' * 1000)
+        eq_(inode(pjoin(a, 'include', 'foo.h')), inode(pjoin(b, 'foo.h')))
+        eq_(inode(pjoin(a, 'LICENSE')), inode(pjoin(b, 'LICENSE')))
+        # writable files are write-protected and shared as well
+        eq_(inode(pjoin(a, 'writable')), inode(pjoin(b, 'writable')))
+        assert not os.lstat(pjoin(b, 'writable')).st_mode & 0o222
+        assert os.path.islink(pjoin(b, 'link'))
+        with open(pjoin(b, 'foo.h')) as f:
+            eq_('shared header' * 1000, f.read())
+        eq_(set([a, b]), index.get_deduplicated())
+
+        # incremental: only the new artifact is processed
+        make_file(pjoin(c, 'LICENSE'), 'license')
+        make_file(pjoin(a, 'late'), 'license') # not seen, a is done
+        index.dedup_artifacts([a, b, c])
+        eq_(inode(pjoin(a, 'LICENSE')), inode(pjoin(c, 'LICENSE')))
+        assert inode(pjoin(a, 'late')) != inode(pjoin(a, 'LICENSE'))
+        index.dedup_artifacts([a], rescan=True)
+        eq_(inode(pjoin(a, 'late')), inode(pjoin(a, 'LICENSE')))
+
+        # entries only referenced by the index are pruned
+        eq_(0, index.prune())
+        for name in os.listdir(b):
+            os.unlink(pjoin(b, name))
+        os.rmdir(b)
+        eq_(1, index.prune()) # 'other' was only in b
+        eq_(set([a, c]), index.get_deduplicated())
@@ -0,0 +1,112 @@
+import sys
+import os
+from os.path import join as pjoin
+import subprocess
+
+from nose import SkipTest
+from nose.tools import eq_, assert_raises
+
+from .utils import temp_working_dir_fixture
+from .. import elf, build_tools
+
+GCC = '/usr/bin/gcc'
+
+def compile_program(d, new_dtags):
+    if not os.path.exists(GCC):
+        raise SkipTest('needs %s' % GCC)
+    libdir = pjoin(d, 'opt', 'foo', 'h1', 'lib')
+    bindir = pjoin(d, 'opt', 'app', 'h2', 'bin')
+    os.makedirs(libdir)
+    os.makedirs(bindir)
+    with open('foo.c', 'w') as f:
+        f.write('int foo(void) { return 42; }\n')
+    with open('app.c', 'w') as f:
+        f.write('#include <stdio.h>\nint foo(void);\n'
+                'int main(void) { printf("%d\\n", foo()); return 0; }\n')
+    subprocess.check_call([GCC, '-shared', '-fPIC', '-o', pjoin(libdir, 'libfoo.so'), 'foo.c'])
+    rpath = ':'.join([libdir, pjoin(d, 'unused'), libdir])
+    subprocess.check_call([GCC, '-o', pjoin(bindir, 'app'), 'app.c', '-L' + libdir, '-lfoo',
+                           '-Wl,-R,' + rpath,
+                           '-Wl,--%s-new-dtags' % ('enable' if new_dtags else 'disable')])
+    return pjoin(bindir, 'app'), rpath
+
+def run(program):
+    p = subprocess.Popen([program], stdout=subprocess.PIPE, env={})
+    out, _ = p.communicate()
+    return p.wait(), out.strip()
+
+@temp_working_dir_fixture
+def test_read_dynamic(d):
+    program, rpath = compile_program(d, new_dtags=False)
+    with open(program, 'rb') as f:
+        dynamic = elf.read_dynamic(f)
+    assert 'libfoo.so' in dynamic.needed
+    eq_([(elf.DT_RPATH, rpath)], [(tag, value) for tag, offset, value in dynamic.rpaths])
+    with open('foo.c', 'rb') as f:
+        assert_raises(elf.InvalidElfError, elf.read_dynamic, f)
+
+@temp_working_dir_fixture
+def test_relative_rpath(d):
+    for new_dtags in [False, True]:
+        program, rpath = compile_program(pjoin(d, str(new_dtags)), new_dtags)
+        eq_((0, '42'), run(program))
+
+        f = build_tools.classify_file(program)
+        build_tools.postprocess_relative_rpath(f, pjoin(d, str(new_dtags), 'opt'))
+        with open(program, 'rb') as f:
+            rpaths = elf.read_dynamic(f).rpaths
+        # entries outside of the store are kept unless asked otherwise
+        eq_(['$ORIGIN/../../../foo/h1/lib:%s' % pjoin(d, str(new_dtags), 'unused')],
+            [value for tag, offset, value in rpaths])
+        f = build_tools.classify_file(program)
+        build_tools.postprocess_relative_rpath(f, pjoin(d, str(new_dtags), 'opt'),
+                                               drop_unused=True)
+        with open(program, 'rb') as f:
+            rpaths = elf.read_dynamic(f).rpaths
+        eq_(['$ORIGIN/../../../foo/h1/lib'], [value for tag, offset, value in rpaths])
+
+        # still runs after moving the artifact store
+        os.rename(pjoin(d, str(new_dtags), 'opt'), pjoin(d, str(new_dtags), 'moved'))
+        eq_((0, '42'), run(pjoin(d, str(new_dtags), 'moved', 'app', 'h2', 'bin', 'app')))
+
+@temp_working_dir_fixture
+def test_rpath_too_long(d):
+    program, rpath = compile_program(d, new_dtags=False)
+    with open(program, 'rb') as f:
+        before = f.read()
+    assert_raises(ValueError, elf.rewrite_rpaths, program, lambda value, dynamic: value + ':x')
+    with open(program, 'rb') as f:
+        eq_(before, f.read())
+
+@temp_working_dir_fixture
+def test_library_rpath_kept(d):
+    # $ORIGIN of a library is the directory it was loaded through, so a
+    # library loaded through a profile must keep its absolute RPATH
+    program, rpath = compile_program(d, new_dtags=False)
+    libdir = pjoin(d, 'opt', 'bar', 'h3', 'lib')
+    os.makedirs(libdir)
+    with open('bar.c', 'w') as f:
+        f.write('int foo(void);\nint bar(void) { return foo() + 1; }\n')
+    lib = pjoin(libdir, 'libbar.so')
+    subprocess.check_call([GCC, '-shared', '-fPIC', '-o', lib, 'bar.c',
+                           '-Wl,-soname,libbar.so', '-L' + pjoin(d, 'opt', 'foo', 'h1', 'lib'),
+                           '-lfoo', '-Wl,-R,' + pjoin(d, 'opt', 'foo', 'h1', 'lib'),
+                           '-Wl,--disable-new-dtags'])
+    with open(lib, 'rb') as f:
+        dynamic = elf.read_dynamic(f)
+    assert not elf.is_executable(dynamic)
+    with open(program, 'rb') as f:
+        assert elf.is_executable(elf.read_dynamic(f))
+
+    build_tools.postprocess_relative_rpath(build_tools.classify_file(lib), pjoin(d, 'opt'),
+                                           drop_unused=True)
+    with open(lib, 'rb') as f:
+        eq_(dynamic.rpaths, elf.read_dynamic(f).rpaths)
+
+    os.makedirs(pjoin(d, 'profile', 'lib'))
+    os.symlink(lib, pjoin(d, 'profile', 'lib', 'libbar.so'))
+    p = subprocess.Popen([sys.executable, '-c', 'import ctypes, sys; '
+                          'print ctypes.CDLL(sys.argv[1]).bar()',
+                          pjoin(d, 'profile', 'lib', 'libbar.so')],
+                         stdout=subprocess.PIPE, env={})
+    eq_('43', p.communicate()[0].strip())
@@ -1,5 +1,7 @@
 import os
 from os.path import join as pjoin
+import sys
+import time
 
 from nose.tools import assert_raises
 
@@ -25,3 +27,49 @@ def test_rmtree_up_to():
         # Parent is exclusive
         fileutils.rmtree_up_to(d, d)
         assert os.path.exists(d)
+
+def test_trash():
+    with temp_dir() as d:
+        for name in ['a', 'b', 'c']:
+            os.makedirs(pjoin(d, name, 'sub'))
+            with open(pjoin(d, name, 'sub', 'file'), 'w') as f:
+                f.write('x' * 10000)
+        os.link(pjoin(d, 'a', 'sub', 'file'), pjoin(d, 'hardlink'))
+        trash = fileutils.Trash(d)
+        for name in ['a', 'b', 'c']:
+            assert trash.move(pjoin(d, name)) is not None
+        assert trash.move(pjoin(d, 'nonexisting')) is None
+        assert sorted(os.listdir(d)) == ['.trash', 'hardlink']
+
+        calls = []
+        freed = fileutils.empty_trash([d], jobs=2,
+                                      progress=lambda *args: calls.append(args))
+        assert os.listdir(d) == ['hardlink']
+        assert [(i, 3) for i in [1, 2, 3]] == [call[:2] for call in calls]
+        assert calls[-1][2] == freed
+        # the file still linked from outside does not count
+        assert 2 * 10000 <= freed < 3 * 10000 + 10 * 4096
+
+def test_remove_deep_tree():
+    with temp_dir() as d:
+        depth = sys.getrecursionlimit() + 100
+        path = pjoin(d, 'tree')
+        os.mkdir(path)
+        for i in range(depth):
+            path = pjoin(path, 'x')
+            os.mkdir(path)
+        with open(pjoin(path, 'file'), 'w') as f:
+            f.write('x' * 10000)
+        assert fileutils.remove_tree(pjoin(d, 'tree')) >= 10000
+        assert os.listdir(d) == []
+
+def test_empty_trash_in_background():
+    with temp_dir() as d:
+        os.makedirs(pjoin(d, 'a', 'sub'))
+        fileutils.Trash(d).move(pjoin(d, 'a'))
+        fileutils.empty_trash_in_background([d])
+        for i in range(100):
+            if not os.listdir(d):
+                break
+            time.sleep(0.05)
+        assert os.listdir(d) == []
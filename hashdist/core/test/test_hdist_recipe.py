@@ -9,7 +9,9 @@ from ..hdist_recipe import ensure_hdist_cli_artifact
 @fixture()
 def test_hdist_cli_artifact(tempdir, sc, bldr, config):
     hdist_id, hdist_path = ensure_hdist_cli_artifact(bldr, config)
-    assert sorted(os.listdir(hdist_path)) == ['bin', 'build.json', 'build.log.gz', 'pypkg']
+    assert sorted(os.listdir(hdist_path)) == ['bin', 'build-timings.json', 'build.json',
+                                             'build.log.gz', 'build.log.idx', 'pypkg',
+                                             'relocations.json']
     with file(pjoin(hdist_path, 'bin', 'hdist')) as f:
         hdist_bin = f.read()
     assert hdist_bin.startswith('#!' + sys.executable)
@@ -3,13 +3,16 @@ from os import symlink
 from os.path import join as pjoin
 import os
 import shutil
+from StringIO import StringIO
 
-from nose.tools import assert_raises
+from nose.tools import assert_raises, eq_
 
 from .utils import temp_working_dir, temp_dir, working_directory, eqsorted_, cat
 from .test_ant_glob import makefiles
 
 from .. import links
+from ..cache import DiskCache
+from ...hdist_logging import Logger, DEBUG, INFO
 from ..links import (silent_makedirs, silent_unlink, silent_absolute_symlink,
                      silent_relative_symlink, silent_copy)
 from pprint import pprint
@@ -64,6 +67,16 @@ def test_dry_run_simple():
                            (silent_copy, 'usr/bin/gcc', 'subdir/foo/gcc')
                            ]
 
+        # the same, relative to `cwd` rather than the current directory
+        actions = links.dry_run_links_dsl(rules, env, cwd='/')
+        assert actions == [(silent_makedirs, '/subdir/bin'),
+                           (silent_absolute_symlink, '/bin/cp', '/subdir/bin/cp'),
+                           (silent_absolute_symlink, '/bin/ls', '/subdir/bin/ls'),
+                           (silent_absolute_symlink, '/usr/bin/gcc', '/subdir/bin/gcc'),
+                           (silent_makedirs, '/subdir/foo'),
+                           (silent_copy, '/usr/bin/gcc', '/subdir/foo/gcc')
+                           ]
+
         # overwrite
         for rule in rules:
             rule['overwrite'] = True
@@ -132,8 +145,9 @@ def test_launcher():
         os.chmod('b', 0o777)
         os.chmod('script', 0o777)
         os.symlink('a', 'c')
-        links.execute_links_dsl(rules, {}, launcher_program='/bin/cp')
+        created = links.execute_links_dsl(rules, {}, launcher_program='/bin/cp')
         os.chdir('foo')
+        eqsorted_(os.listdir('.'), [os.path.relpath(path, 'foo') for path in created])
         assert os.path.exists('launcher')
         assert os.stat('launcher').st_mode | 0o111
         assert os.readlink('a') == 'launcher'
@@ -156,3 +170,173 @@ def test_dirs():
         links.execute_links_dsl(rules, {})
         assert os.path.exists('foo')
         assert os.path.islink('foo/a0')
+
+def test_plan_cache():
+    rules = [dict(action='absolute_symlink', select=['src/**/*.txt'], target='$D', prefix='src')]
+    with temp_dir() as cache_dir, temp_working_dir() as d:
+        cache = DiskCache(cache_dir)
+        makefiles(['src/a.txt', 'src/sub/b.txt'])
+        env = dict(D='foo', UNUSED='1')
+        key = links._get_plan_key(rules, env)
+
+        # too recently changed to be stored
+        actions = links.get_links_plan(rules, env, cache)
+        assert cache.get(links.LINK_PLANS_DOMAIN, key, None) is None
+
+        old_racy_interval = links.RACY_INTERVAL
+        links.RACY_INTERVAL = -1
+        try:
+            assert links.get_links_plan(rules, env, cache) == actions
+            assert cache.get(links.LINK_PLANS_DOMAIN, key, None) is not None
+            # only referenced variables are part of the key
+            env['UNUSED'] = '2'
+            eq_(key, links._get_plan_key(rules, env))
+            cache.memory_cache.clear()
+            assert links.get_links_plan(rules, env, cache) == actions
+
+            # a new file deep in the tree invalidates the plan, even if
+            # the modification time is reset
+            st = os.stat('src/sub')
+            makefiles(['src/sub/c.txt'])
+            os.utime('src/sub', (st.st_atime, st.st_mtime))
+            links.execute_links_dsl(rules, env, cache=cache)
+            eqsorted_(['foo/a.txt', 'foo/sub/b.txt', 'foo/sub/c.txt'], findfiles('foo'))
+        finally:
+            links.RACY_INTERVAL = old_racy_interval
+
+def test_group_actions():
+    actions = [(silent_makedirs, 'foo/a'),
+               (silent_absolute_symlink, 'x', 'foo/a/x'),
+               (silent_makedirs, 'foo/b'),
+               (silent_unlink, 'foo/b/y'),
+               (silent_absolute_symlink, 'y', 'foo/b/y'),
+               (silent_absolute_symlink, 'z', 'foo/a/z')]
+    eq_([[actions[0], actions[1], actions[5]], actions[2:5]], links._group_actions(actions))
+    # linking a directory that other actions create entries in
+    actions.append((silent_absolute_symlink, 'src', 'foo/b'))
+    eq_([actions], links._group_actions(actions))
+    eq_([], links._group_actions([]))
+
+def test_parallel_execution():
+    rules = [dict(action='relative_symlink', select='src/**/*', target='foo', prefix='src'),
+             dict(action='copy', source='src/d0/f0', target='foo/copy', overwrite=True)]
+    with temp_working_dir() as d:
+        makefiles(['src/d%d/f%d' % (i, j) for i in range(5) for j in range(5)])
+        stream = StringIO()
+        logger = Logger(DEBUG, streams=[(stream, False)])
+        links.execute_links_dsl(rules, {}, logger=logger, jobs=4)
+        eqsorted_(findfiles('src'), [x.replace('foo/', 'src/') for x in findfiles('foo')
+                                     if x != 'foo/copy'])
+        assert not os.path.islink('foo/copy')
+        eq_('../../src/d1/f2', os.readlink('foo/d1/f2'))
+        assert "silent_relative_symlink('src/d4/f4', 'foo/d4/f4')" in stream.getvalue()
+
+def test_failure_summary():
+    rules = [dict(action='copy', select='src/*/*', target='foo', prefix='src')]
+    with temp_working_dir() as d:
+        makefiles(['src/a/f', 'src/b/f', 'src/c/f'])
+        makefiles(['foo/b', 'foo/c'])
+        stream = StringIO()
+        logger = Logger(INFO, streams=[(stream, False)])
+        with assert_raises(OSError) as cm:
+            links.execute_links_dsl(rules, {}, logger=logger, jobs=2)
+        assert '(and 1 more failures)' in str(cm.exception)
+        # the other directory was still populated
+        assert os.path.exists('foo/a/f')
+        eq_(2, stream.getvalue().count('ERROR'))
+
+def test_exclude_subtree():
+    rules = [dict(action='exclude', select=['src/skip/**', 'src/*.{o,a}']),
+             dict(action='relative_symlink', select='src/**/*', target='foo', prefix='src')]
+    with temp_working_dir() as d:
+        makefiles(['src/a.c', 'src/a.o', 'src/b.a', 'src/sub/b.c', 'src/skip/c.c',
+                   'src/skip/deep/d.c'])
+        links.execute_links_dsl(rules, {})
+        eqsorted_(['foo/a.c', 'foo/sub/b.c'], findfiles('foo'))
+
+def write_executable(filename, text):
+    with open(filename, 'w') as f:
+        f.write(text)
+    os.chmod(filename, 0o755)
+
+def run_program(*args):
+    from subprocess import Popen, PIPE
+    p = Popen(args, stdout=PIPE, env={})
+    out, _ = p.communicate()
+    eq_(0, p.wait())
+    return out.strip()
+
+def test_compiled_launcher():
+    from nose import SkipTest
+    if not any(os.path.exists(cc) for cc in links.FALLBACK_COMPILERS):
+        raise SkipTest('needs a C compiler')
+    with temp_working_dir() as d:
+        # a program that prints the argv[0] it gets
+        with open('argv0.c', 'w') as f:
+            f.write('#include <stdio.h>\nint main(int c, char **v) '
+                    '{ printf("%s %s\\n", v[0], v[1]); return 0; }\n')
+        os.makedirs('art/bin')
+        from subprocess import check_call
+        cc = [cc for cc in links.FALLBACK_COMPILERS if os.path.exists(cc)][0]
+        check_call([cc, '-o', 'art/bin/argv0', 'argv0.c'])
+        rules = [dict(action='launcher', select=['art/bin/*'], target='profile/bin',
+                      prefix='art/bin')]
+        # the launcher is only taken from the launcher artifact
+        with assert_raises(TypeError):
+            links.execute_links_dsl(rules, {})
+        os.makedirs('launcher/bin')
+        links.compile_launcher('launcher/bin/launcher')
+        links.execute_links_dsl(rules, {}, launcher_program='launcher/bin/launcher')
+        assert os.path.exists('profile/bin/launcher')
+        assert not os.path.exists('profile/bin/launcher.cache')
+        eq_('%s/profile/bin/argv0 x' % d, run_program(pjoin(d, 'profile/bin/argv0'), 'x'))
+
+def test_compiled_launcher_scripts():
+    from nose import SkipTest
+    from ..build_tools import classify_file, postprocess_launcher_shebangs
+    if not any(os.path.exists(cc) for cc in links.FALLBACK_COMPILERS):
+        raise SkipTest('needs a C compiler')
+    with temp_working_dir() as d:
+        for dirname in ['launcher', 'python/bin', 'app/bin', 'profile/bin', 'other/bin']:
+            os.makedirs(dirname)
+        links.compile_launcher('launcher/launcher')
+        write_executable('python/bin/python', '#!/bin/sh\necho artifact "$@"\n')
+        for profile in ['profile', 'other']:
+            write_executable(pjoin(profile, 'bin', 'python'), '#!/bin/sh\necho %s "$@"\n' % profile)
+            with open(pjoin(profile, 'profile.json'), 'w') as f:
+                f.write('{}')
+        write_executable('app/bin/script', '#!%s/python/bin/python -u\n' % d)
+        postprocess_launcher_shebangs(classify_file(pjoin(d, 'app/bin/script')),
+                                      pjoin(d, 'launcher/launcher'))
+        symlink(pjoin(d, 'app/bin/script'), 'profile/bin/script')
+        real = pjoin(d, 'app/bin/script.real')
+
+        # outside of a profile, the interpreter is found relative to the script
+        eq_('artifact -u %s x' % real, run_program(pjoin(d, 'app/bin/script'), 'x'))
+        eq_('profile -u %s x' % real, run_program(pjoin(d, 'profile/bin/script'), 'x'))
+
+        # the cache is used when present and valid, in profile bin dirs only
+        for dirname in ['profile/bin', 'app/bin']:
+            with open(pjoin(dirname, 'launcher.cache'), 'w') as f:
+                pass
+        with open('profile/bin/is-profile-bin', 'w') as f:
+            pass
+        eq_('artifact -u %s x' % real, run_program(pjoin(d, 'app/bin/script'), 'x'))
+        eq_('', cat('app/bin/launcher.cache'))
+        eq_('profile -u %s x' % real, run_program(pjoin(d, 'profile/bin/script'), 'x'))
+        eq_(os.path.realpath('profile'), cat('profile/bin/launcher.cache').strip())
+        with open('profile/bin/launcher.cache', 'w') as f:
+            f.write(os.path.realpath('other') + '\n')
+        eq_('other -u %s x' % real, run_program(pjoin(d, 'profile/bin/script'), 'x'))
+        os.unlink('other/profile.json')
+        eq_('profile -u %s x' % real, run_program(pjoin(d, 'profile/bin/script'), 'x'))
+
+        # a profile found through a later link in the chain is specific to
+        # that chain, and is not cached for the directory of the first link
+        os.makedirs('loose/bin')
+        for name in ['launcher.cache', 'is-profile-bin']:
+            with open(pjoin('loose/bin', name), 'w') as f:
+                pass
+        symlink(pjoin(d, 'profile/bin/script'), 'loose/bin/script')
+        eq_('profile -u %s x' % real, run_program(pjoin(d, 'loose/bin/script'), 'x'))
+        eq_('', cat('loose/bin/launcher.cache'))
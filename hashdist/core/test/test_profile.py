@@ -0,0 +1,121 @@
+import os
+import shutil
+from os.path import join as pjoin
+
+from nose.tools import eq_
+
+from .utils import logger, cat
+from .test_build_store import fixture
+
+from .. import profile
+from ..links import silent_absolute_symlink
+
+
+def make_links_artifact(bldr, config, name, files, overwrite=False):
+    links = [{"action": "symlink", "select": "$ARTIFACT/*/**/*", "prefix": "$ARTIFACT",
+              "target": "$PROFILE", "overwrite": overwrite}]
+    spec = {
+        "name": name, "version": "n",
+        "build": {"script": [["hdist", "build-write-files"]]},
+        "files": [{"target": "$ARTIFACT/artifact.json",
+                   "object": {"install": {"script": [["@hdist", "create-links",
+                                                      "--key=install/links", "artifact.json"]],
+                                          "links": links}}}] +
+                 [{"target": "$ARTIFACT/%s" % filename, "text": [name]} for filename in files]
+        }
+    return bldr.ensure_present(spec, config)
+
+@fixture()
+def test_merged_profile(tempdir, sc, bldr, config):
+    a_id, a_dir = make_links_artifact(bldr, config, 'a', ['bin/tool', 'share/a'])
+    b_id, b_dir = make_links_artifact(bldr, config, 'b', ['bin/tool', 'bin/b'])
+    c_id, c_dir = bldr.ensure_present({
+        "name": "c", "version": "n",
+        "build": {"script": [["hdist", "build-write-files"]]},
+        "files": [{"target": "$ARTIFACT/artifact.json",
+                   "object": {"install": {"script": [
+                       ["/bin/sh", "-c", "echo c > $PROFILE/bin/c"]]}}}]}, config)
+    d_id, d_dir = make_links_artifact(bldr, config, 'd', ['bin/tool', 'share/d'], overwrite=True)
+
+    eq_(None, profile.get_artifact_links_plan(logger, bldr, c_id, 'p', {}, config))
+    plan = profile.get_artifact_links_plan(logger, bldr, b_id, 'p', {}, config)
+    assert (silent_absolute_symlink, pjoin(b_dir, 'bin', 'b'),
+            pjoin(os.path.abspath('p'), 'bin', 'b')) in plan
+
+    target = pjoin(tempdir, 'profile')
+    artifacts = [{"id": x, "before": []} for x in [a_id, b_id, c_id, d_id]]
+    installed = profile.make_profile(logger, bldr, artifacts, target, {}, config)
+    eq_(sorted(list_profile(target).keys()),
+        sorted(os.path.relpath(path, target) for path in installed))
+    # a comes before b; d comes after c but overwrites
+    eq_(pjoin(d_dir, 'bin', 'tool'), os.readlink(pjoin(target, 'bin', 'tool')))
+    eq_(pjoin(b_dir, 'bin', 'b'), os.readlink(pjoin(target, 'bin', 'b')))
+    eq_('c\n', cat(pjoin(target, 'bin', 'c')))
+    eq_(['a', 'd'], sorted(os.listdir(pjoin(target, 'share'))))
+    assert os.path.exists(pjoin(target, 'profile.json'))
+    # the launcher only caches its profile lookup in profile bin dirs
+    eq_('', cat(pjoin(target, 'bin', 'launcher.cache')))
+
+    # without the overwrite, the first artifact wins
+    target = pjoin(tempdir, 'profile2')
+    artifacts = [{"id": x, "before": []} for x in [b_id, a_id]]
+    profile.make_profile(logger, bldr, artifacts, target, {}, config)
+    eq_(pjoin(b_dir, 'bin', 'tool'), os.readlink(pjoin(target, 'bin', 'tool')))
+
+def list_profile(path):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            filename = pjoin(dirpath, name)
+            if os.path.islink(filename):
+                result[os.path.relpath(filename, path)] = os.readlink(filename)
+            elif not os.path.isdir(filename):
+                result[os.path.relpath(filename, path)] = None
+    return result
+
+@fixture()
+def test_update_profile(tempdir, sc, bldr, config):
+    a_id, a_dir = make_links_artifact(bldr, config, 'a', ['bin/tool', 'share/a/x'])
+    b_id, b_dir = make_links_artifact(bldr, config, 'b', ['bin/tool', 'bin/b'])
+    d_id, d_dir = make_links_artifact(bldr, config, 'd', ['bin/tool', 'share/d'], overwrite=True)
+    target = pjoin(tempdir, 'profile')
+
+    def update(ids):
+        artifacts = [{"id": x, "before": []} for x in ids]
+        profile.update_profile(logger, bldr, artifacts, target, {}, config)
+        # same result as building the profile from scratch
+        fresh = pjoin(tempdir, 'fresh')
+        profile.make_profile(logger, bldr, artifacts, fresh, {}, config)
+        expected = list_profile(fresh)
+        shutil.rmtree(fresh)
+        got = list_profile(target + '/')
+        eq_(expected.keys(), got.keys())
+        for path, link in expected.items():
+            eq_(link, got[path])
+
+    update([a_id, b_id])
+    eq_('profile.0', os.readlink(target))
+    update([a_id, d_id])
+    eq_('profile.1', os.readlink(target))
+
+    # profile.0 is updated incrementally; the links of b are kept
+    b_stat = os.lstat(pjoin(tempdir, 'profile.0', 'bin', 'b'))
+    with open(pjoin(tempdir, 'profile.0', 'bin', 'launcher.cache'), 'w') as f:
+        f.write('/stale\n')
+    update([b_id, d_id])
+    eq_('', cat(pjoin(target, 'bin', 'launcher.cache')))
+    eq_('profile.0', os.readlink(target))
+    eq_(pjoin(d_dir, 'bin', 'tool'), os.readlink(pjoin(target, 'bin', 'tool')))
+    eq_(b_stat.st_ino, os.lstat(pjoin(target, 'bin', 'b')).st_ino)
+    assert not os.path.exists(pjoin(target, 'share', 'a'))
+
+    # artifacts without an install section do not force a rebuild
+    e_id, e_dir = bldr.ensure_present({
+        "name": "e", "version": "n",
+        "build": {"script": [["hdist", "build-write-files"]]},
+        "files": [{"target": "$ARTIFACT/artifact.json", "object": {}}]}, config)
+    eq_([], profile.get_artifact_links_plan(logger, bldr, e_id, target, {}, config))
+    update([b_id, d_id, e_id])
+    update([b_id, d_id, e_id])
+    eq_('profile.0', os.readlink(target))
+    eq_(b_stat.st_ino, os.lstat(pjoin(target, 'bin', 'b')).st_ino)
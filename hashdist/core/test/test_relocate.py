@@ -0,0 +1,144 @@
+import os
+from os.path import join as pjoin
+import shutil
+
+from nose.tools import eq_, assert_raises
+
+from .utils import temp_dir
+from .. import relocate
+from ..fileutils import write_protect
+
+
+def make_artifact(artifact_dir):
+    os.makedirs(pjoin(artifact_dir, 'bin'))
+    os.makedirs(pjoin(artifact_dir, 'lib'))
+    with open(pjoin(artifact_dir, 'bin', 'script'), 'w') as f:
+        f.write('#!%s/bin/python\n# %s\n' % (artifact_dir, artifact_dir))
+    with open(pjoin(artifact_dir, 'lib', 'libfoo.so'), 'w') as f:
+        f.write('\x7fELF\0\0%s/lib:%s/lib64\0more\0%s\0' % ((artifact_dir,) * 3))
+    with open(pjoin(artifact_dir, 'lib', 'unrelated'), 'w') as f:
+        f.write('nothing to see here')
+    write_protect(pjoin(artifact_dir, 'bin', 'script'))
+    os.symlink(pjoin(artifact_dir, 'lib', 'libfoo.so'), pjoin(artifact_dir, 'lib', 'libfoo.so.1'))
+    os.symlink('libfoo.so', pjoin(artifact_dir, 'lib', 'libfoo.so.2'))
+
+def test_scan_and_relocate():
+    with temp_dir() as d:
+        old = pjoin(d, 'aaaaaaaa', 'foo')
+        make_artifact(old)
+        table = relocate.record_relocations(old)
+        eq_(['bin/script'], table['text'])
+        eq_(['lib/libfoo.so'], table['binary'].keys())
+        eq_(3, len(table['binary']['lib/libfoo.so']))
+        eq_(['lib/libfoo.so.1'], table['symlinks'])
+
+        new = pjoin(d, 'bbbb', 'foo')
+        os.makedirs(os.path.dirname(new))
+        os.rename(old, new)
+        assert relocate.relocate_artifact(new, old, new)
+        with open(pjoin(new, 'bin', 'script')) as f:
+            eq_('#!%s/bin/python\n# %s\n' % (new, new), f.read())
+        assert not os.stat(pjoin(new, 'bin', 'script')).st_mode & 0o222
+        with open(pjoin(new, 'lib', 'libfoo.so')) as f:
+            pad = '\0' * (len(old) - len(new))
+            eq_('\x7fELF\0\0%s/lib:%s/lib64%s\0more\0%s%s\0' % (new, new, 2 * pad, new, pad),
+                f.read())
+        eq_(pjoin(new, 'lib', 'libfoo.so'), os.readlink(pjoin(new, 'lib', 'libfoo.so.1')))
+        eq_('libfoo.so', os.readlink(pjoin(new, 'lib', 'libfoo.so.2')))
+        eq_(new, relocate.load_relocations(new)['prefix'])
+
+        # binaries can not be relocated to a longer path; nothing is touched
+        longer = pjoin(d, 'cccccccccccc', 'foo')
+        os.makedirs(os.path.dirname(longer))
+        os.rename(new, longer)
+        assert not relocate.relocate_artifact(longer, new, longer)
+        with open(pjoin(longer, 'bin', 'script')) as f:
+            eq_('#!%s/bin/python\n# %s\n' % (new, new), f.read())
+        with assert_raises(relocate.RelocationError):
+            relocate.apply_relocations(longer, relocate.load_relocations(longer), longer)
+
+def test_relocate_without_table():
+    with temp_dir() as d:
+        old = pjoin(d, 'a', 'foo')
+        make_artifact(old)
+        new = pjoin(d, 'b', 'foo')
+        os.makedirs(os.path.dirname(new))
+        os.rename(old, new)
+        assert relocate.relocate_artifact(new, old, new)
+        with open(pjoin(new, 'bin', 'script')) as f:
+            eq_('#!%s/bin/python\n# %s\n' % (new, new), f.read())
+
+def test_relocate_hard_links():
+    with temp_dir() as d:
+        old = pjoin(d, 'a', 'foo')
+        make_artifact(old)
+        os.link(pjoin(old, 'lib', 'libfoo.so'), pjoin(old, 'lib', 'libfoo-copy.so'))
+        os.link(pjoin(old, 'bin', 'script'), pjoin(old, 'bin', 'script-copy'))
+        relocate.record_relocations(old)
+        outside = pjoin(d, 'outside.so')
+        os.link(pjoin(old, 'lib', 'libfoo.so'), outside)
+        new = pjoin(d, 'b', 'foo')
+        os.makedirs(os.path.dirname(new))
+        os.rename(old, new)
+        assert relocate.relocate_artifact(new, old, new)
+        for name in ['bin/script', 'bin/script-copy']:
+            with open(pjoin(new, name)) as f:
+                eq_('#!%s/bin/python\n# %s\n' % (new, new), f.read())
+        with open(pjoin(new, 'lib', 'libfoo.so')) as f:
+            data = f.read()
+        with open(pjoin(new, 'lib', 'libfoo-copy.so')) as f:
+            eq_(data, f.read())
+        assert old not in data
+        # the other link to the file is untouched
+        with open(outside) as f:
+            assert old in f.read()
+
+def test_scan_in_chunks():
+    with temp_dir() as d:
+        prefix = pjoin(d, 'foo')
+        os.makedirs(prefix)
+        data = 'x' * 5 + prefix + prefix + ':' + 'y' * 6 + prefix + '\0' + prefix[:-1]
+        with open(pjoin(prefix, 'file'), 'w') as f:
+            f.write(data)
+        expected = [5, 5 + len(prefix), 12 + 2 * len(prefix)]
+        old_chunk_size = relocate.CHUNK_SIZE
+        try:
+            for chunk_size in [1, 2, 3, 7, len(prefix), 1000]:
+                relocate.CHUNK_SIZE = chunk_size
+                table = relocate.scan_relocations(prefix)
+                eq_({'file': expected}, table['binary'])
+        finally:
+            relocate.CHUNK_SIZE = old_chunk_size
+
+def test_path_boundary():
+    with temp_dir() as d:
+        old = pjoin(d, 'a', 'foo')
+        os.makedirs(old)
+        with open(pjoin(old, 'script'), 'w') as f:
+            f.write('%sdef/bin "%s" %s' % (old, old, old))
+        with open(pjoin(old, 'other'), 'w') as f:
+            f.write('%sdef/bin' % old)
+        with open(pjoin(old, 'lib.so'), 'w') as f:
+            f.write('%sdef\0%s/lib:%sdef/lib\0' % (old, old, old))
+        os.symlink(old + 'def', pjoin(old, 'link'))
+
+        old_chunk_size = relocate.CHUNK_SIZE
+        try:
+            for chunk_size in [1, 3, len(old), 1000]:
+                relocate.CHUNK_SIZE = chunk_size
+                table = relocate.scan_relocations(old)
+                eq_(['script'], table['text'])
+                eq_({'lib.so': [len(old) + 4]}, table['binary'])
+                eq_([], table['symlinks'])
+        finally:
+            relocate.CHUNK_SIZE = old_chunk_size
+
+        new = pjoin(d, 'b', 'foo')
+        os.makedirs(os.path.dirname(new))
+        os.rename(old, new)
+        assert relocate.relocate_artifact(new, old, new)
+        with open(pjoin(new, 'script')) as f:
+            eq_('%sdef/bin "%s" %s' % (old, new, new), f.read())
+        with open(pjoin(new, 'lib.so')) as f:
+            eq_('%sdef\0%s/lib:%sdef/lib\0' % (old, new, old), f.read())
+        eq_(old + 'def', os.readlink(pjoin(new, 'link')))
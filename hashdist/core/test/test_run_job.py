@@ -1,5 +1,7 @@
 import sys
 import os
+import time
+import subprocess
 from os.path import join as pjoin
 from nose.tools import eq_, assert_raises
 from pprint import pprint
@@ -164,6 +166,81 @@ def test_log_pipe_stress(tempdir, sc, build_store, cfg):
     assert all(x == NMSGS for x in stdout_bins)
     assert all(x == NMSGS for x in stderr_bins)
     
+@build_store_fixture()
+def test_parallel_block(tempdir, sc, build_store, cfg):
+    job_spec = {
+        "script": [
+            ["FOO=foo"],
+            {"parallel": [
+                env_to_stderr + ["FOO"],
+                ["$echo>out", "hi"],
+                ["hdist>help.txt", "help"]
+            ]}
+        ]}
+    logger = MemoryLogger()
+    run_job.run_job(logger, build_store, job_spec, {"echo": "/bin/echo"}, {}, tempdir, cfg)
+    assert "DEBUG:0-%s:ENV:FOO='foo'" % os.path.basename(sys.executable) in logger.lines
+    with file(pjoin(tempdir, 'out')) as f:
+        eq_('hi\n', f.read())
+    with file(pjoin(tempdir, 'help.txt')) as f:
+        assert 'usage: hdist' in f.read()
+
+@build_store_fixture()
+def test_parallel_block_fails_fast(tempdir, sc, build_store, cfg):
+    job_spec = {
+        "script": [
+            {"parallel": [
+                ["/bin/sleep", "20"],
+                [sys.executable, "-c", "import sys; sys.stderr.write('failing'); sys.exit(3)"]
+            ]}
+        ]}
+    logger = MemoryLogger()
+    t0 = time.time()
+    with assert_raises(subprocess.CalledProcessError) as cm:
+        run_job.run_job(logger, build_store, job_spec, {}, {}, tempdir, cfg)
+    assert time.time() - t0 < 10
+    eq_(3, cm.exception.returncode)
+    assert 'DEBUG:1-%s:failing' % os.path.basename(sys.executable) in logger.lines
+
+@build_store_fixture()
+def test_parallel_block_validation(tempdir, sc, build_store, cfg):
+    for block in [{"parallel": [["FOO=bar"]]},
+                  {"parallel": [["cd", "foo"]]},
+                  {"parallel": [[["/bin/true"]]]},
+                  {"parallel": [["hdist", "logpipe", "mylog", "WARNING"]]},
+                  {"parallel": [], "foo": []}]:
+        with assert_raises(ValueError):
+            run_job.run_job(test_logger, build_store, {"script": [block]}, {}, {}, tempdir, cfg)
+
+def test_log_multiplexer_line_assembly():
+    # Lines split across several writes, a line that is never terminated,
+    # and running both with (main thread) and without SIGCHLD wakeups
+    script = ("import sys, time\n"
+              "for chunk in ['a', 'b\\nc', '\\n\\nd\\ne', 'f']:\n"
+              "    sys.stderr.write(chunk); sys.stderr.flush(); time.sleep(0.01)\n")
+
+    def check():
+        logger = MemoryLogger()
+        ex = run_job.ScriptExecution(logger)
+        try:
+            ex.logged_check_call([sys.executable, '-c', script], os.environ, '/', None)
+        finally:
+            ex.close()
+        eq_(['DEBUG:ab', 'DEBUG:c', 'DEBUG:', 'DEBUG:d', 'DEBUG:ef'], logger.lines)
+
+    check()
+    results = []
+    def thread_main():
+        try:
+            check()
+        except BaseException, e:
+            results.append(e)
+    import threading
+    t = threading.Thread(target=thread_main)
+    t.start()
+    t.join()
+    assert not results, results
+
 @build_store_fixture()
 def test_notimplemented_redirection(tempdir, sc, build_store, cfg):
     job_spec = {
@@ -83,6 +83,10 @@ class MemoryLogger(Logger):
         msg = "%s:%s" % (getLevelName(level), msg)
         self.lines.append(msg)
 
+    def log_lines(self, level, lines):
+        for line in lines:
+            self.log(level, line)
+
 
 #
 # Mock archives
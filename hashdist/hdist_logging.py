@@ -104,6 +104,7 @@ class Logger(object):
         self.heading = ':'.join(names) if names else ''
         self.level = level
         self.streams = streams
+        self._formatted_headings = {}
 
     def get_sub_logger(self, name):
         return Logger(self.level, self.names + (name,), self.streams)
@@ -114,9 +115,11 @@ class Logger(object):
     def pop_stream(self):
         self.streams.pop()
 
-    def log(self, level, msg, *args):
-        if args:
-            msg = msg % args
+    def _get_formatted_heading(self, level):
+        try:
+            return self._formatted_headings[level]
+        except KeyError:
+            pass
         heading = self.heading
         lname = get_level_name(level)
         if lname and heading:
@@ -125,11 +128,38 @@ class Logger(object):
             heading = lname
         heading = '[%s] ' % heading if heading else '[hashdist] '
         heading = colorize(heading, get_log_color(level))
+        self._formatted_headings[level] = heading
+        return heading
+
+    def is_enabled_for(self, level):
+        """Whether messages of `level` are written to any stream, so that
+        expensive formatting of messages can be skipped otherwise
+        """
+        return any(is_raw or level >= self.level for stream, is_raw in self.streams)
+
+    def log(self, level, msg, *args):
+        if args:
+            msg = msg % args
         for stream, is_raw in self.streams:
             if is_raw:
                 stream.write(msg + "\n")
             elif level >= self.level:
-                stream.write('%s%s\n' % (heading, msg))
+                stream.write('%s%s\n' % (self._get_formatted_heading(level), msg))
+
+    def log_lines(self, level, lines):
+        """Logs each of `lines` as a separate message
+
+        Has the same result as calling :meth:`log` for each line, but
+        writes to each stream only once.
+        """
+        if not lines:
+            return
+        for stream, is_raw in self.streams:
+            if is_raw:
+                stream.write('\n'.join(lines) + '\n')
+            elif level >= self.level:
+                heading = self._get_formatted_heading(level)
+                stream.write(''.join(['%s%s\n' % (heading, line) for line in lines]))
 
     def debug(self, msg, *args):
         self.log(DEBUG, msg, *args)
@@ -24,6 +24,9 @@ def stack_script_cli(root_recipe):
                         help='keep build directory even if there is no error')
     parser.add_argument('-K', '--keep-never', action='store_true',
                         help='never keep build directory, even if there is an error')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='reuse a persistent build directory per package; '
+                        'the results are not reproducible')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='verbose mode')
     parser.add_argument('-s', '--status', action='store_true',
@@ -51,14 +54,16 @@ def stack_script_cli(root_recipe):
     cache = DiskCache.create_from_config(config, logger)
 
     root_recipe.initialize(logger, cache)
-    sys.stderr.write('Status:\n\n%s\n\n' % root_recipe.format_tree(build_store))
-    if build_store.is_present(root_recipe.get_build_spec()):
+    status = root_recipe.get_status(build_store)
+    sys.stderr.write('Status:\n\n%s\n\n' % root_recipe.format_tree(status=status))
+    if status[root_recipe.get_real_artifact_id()]:
         sys.stderr.write('Everything up to date!\n')
     else:
         sys.stderr.write('Build needed\n')
 
     if not args.status:
-        build_recipes(build_store, source_cache, config, [root_recipe], keep_build=args.keep)
+        build_recipes(build_store, source_cache, config, [root_recipe],
+                      keep_build=args.keep, incremental=args.incremental)
 
     artifact_dir = build_store.resolve(root_recipe.get_artifact_id())
     if not artifact_dir:
@@ -146,12 +146,35 @@ class Recipe(object):
         for fetch in self.source_fetches:
             fetch.fetch_into(source_cache)
 
-    def format_tree(self, build_store=None, use_colors=True):
+    def get_status(self, build_store):
+        """Returns a dict telling whether the artifact of this recipe and each
+        of its recursive dependencies is present in `build_store`
+        (see :meth:`BuildStore.status_many`)
+        """
+        build_specs = {}
+        def collect(recipe):
+            artifact_id = recipe.get_real_artifact_id()
+            if artifact_id not in build_specs:
+                build_specs[artifact_id] = recipe.get_build_spec()
+                for dep in recipe.dependencies.values():
+                    collect(dep)
+        collect(self)
+        return build_store.status_many(build_specs.values())
+
+    def format_tree(self, build_store=None, use_colors=True, status=None):
+        """Formats the dependency tree of this recipe for display
+
+        If `build_store` is given, each line is annotated with whether the
+        artifact is present; this can also be given in `status` as
+        returned by :meth:`get_status`.
+        """
         lines = []
-        self._format_tree(lines, {}, 0, build_store, use_colors)
+        if status is None and build_store is not None:
+            status = self.get_status(build_store)
+        self._format_tree(lines, {}, 0, status, use_colors)
         return '\n'.join(lines)
 
-    def _format_tree(self, lines, visited, level, build_store, use_colors):
+    def _format_tree(self, lines, visited, level, status, use_colors):
         indent_str = '  '
         indent = indent_str * level
         build_spec = self.get_build_spec()
@@ -160,12 +183,12 @@ class Recipe(object):
         def add_line(left, right):
             lines.append('%-70s%s' % (left, right))
 
-        if build_store is None:
-            status = ''
+        if status is None:
+            status_str = ''
         else:
-            status = (colorize(' [ok]', 'bold-blue', use_colors)
-                      if build_store.is_present(build_spec)
-                      else colorize(' [needs build]', 'bold-red', use_colors))
+            status_str = (colorize(' [ok]', 'bold-blue', use_colors)
+                          if status[artifact_id]
+                          else colorize(' [needs build]', 'bold-red', use_colors))
         
         if artifact_id in visited:
             display_name = visited[artifact_id]
@@ -173,7 +196,7 @@ class Recipe(object):
         else:
             display_name = self.get_display_name()
             desc = '%s%s' % (indent, display_name)
-        add_line(desc, status)
+        add_line(desc, status_str)
 
         visited[artifact_id] = display_name
         
@@ -183,7 +206,7 @@ class Recipe(object):
             if dep.get_real_artifact_id() in visited:
                 repeated.append(dep.get_display_name())
             else:
-                dep._format_tree(lines, visited, level + 1, build_store, use_colors)
+                dep._format_tree(lines, visited, level + 1, status, use_colors)
         if repeated:
             add_line(indent + indent_str + ','.join(repeated),
                      colorize(' (see above)', 'yellow', use_colors))